@@ -17,9 +17,12 @@ from airsenal.framework.utils import (
     get_next_fixture_for_player,
     get_player,
     get_recent_scores_for_player,
+    clear_player_lists,
 )
 
 from airsenal.framework.schema import engine, SessionSquad, SessionBudget, Player
+from airsenal.framework.player_catalog import clear_player_catalogs
+from airsenal.framework.prediction_matrix import clear_prediction_matrices
 
 from airsenal.framework.squad import Squad
 
@@ -34,6 +37,11 @@ DBSESSION = scoped_session(sessionmaker(bind=engine))
 
 def remove_db_session(dbsession=DBSESSION):
     dbsession.remove()
+    # the database may be updated by other processes between requests, so don't
+    # keep players, prices or predictions cached from this one
+    clear_player_catalogs()
+    clear_player_lists()
+    clear_prediction_matrices()
 
 
 def create_response(orig_response, dbsession=DBSESSION):
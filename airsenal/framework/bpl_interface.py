@@ -2,16 +2,21 @@
 Interface to the NumPyro team model in bpl-next:
 https://github.com/anguswilliams91/bpl-next
 """
+import hashlib
+import os
+import pickle
+
 from bpl import ExtendedDixonColesMatchPredictor
 
 import numpy as np
 import pandas as pd
 
-from airsenal.framework.schema import Result, FifaTeamRating, session
+from airsenal import TMPDIR
+from airsenal.framework.schema import Result, Fixture, FifaTeamRating, session
 from airsenal.framework.utils import (
     get_fixtures_for_gameweek,
     get_fixture_teams,
-    is_future_gameweek,
+    is_future_gameweek_clause,
 )
 from airsenal.framework.season import (
     CURRENT_SEASON,
@@ -20,28 +25,34 @@ from airsenal.framework.season import (
 
 np.random.seed(42)
 
+TEAM_MODEL_CACHE_DIR = os.path.join(TMPDIR, "airsenal_team_model")
+# maximum number of fitted team models to keep in the cache
+TEAM_MODEL_CACHE_SIZE = 20
+
 
 def get_result_dict(season, gameweek, dbsession):
     """
-    query the match table and put results into pandas dataframe,
-    to train the team-level model.
-    """
-    results = [
-        s
-        for s in dbsession.query(Result).all()
-        if s.fixture
-        and not is_future_gameweek(
-            s.fixture.season,
-            s.fixture.gameweek,
-            current_season=season,
-            next_gameweek=gameweek,
+    query the match table and put results into numpy arrays,
+    to train the team-level model. Only results before gameweek in season are
+    returned, filtered in a single query joining results to fixtures.
+    """
+    results = (
+        dbsession.query(
+            Fixture.home_team, Fixture.away_team, Result.home_score, Result.away_score
         )
-    ]
+        .join(Fixture, Result.fixture_id == Fixture.fixture_id)
+        .filter(~is_future_gameweek_clause(season, gameweek))
+        .order_by(Result.result_id)
+        .all()
+    )
+    home_team, away_team, home_goals, away_goals = (
+        zip(*results) if results else ([], [], [], [])
+    )
     return {
-        "home_team": np.array([r.fixture.home_team for r in results]),
-        "away_team": np.array([r.fixture.away_team for r in results]),
-        "home_goals": np.array([r.home_score for r in results]),
-        "away_goals": np.array([r.away_score for r in results]),
+        "home_team": np.array(home_team),
+        "away_team": np.array(away_team),
+        "home_goals": np.array(home_goals),
+        "away_goals": np.array(away_goals),
     }
 
 
@@ -99,13 +110,91 @@ def add_new_teams_to_model(team_model, season, dbsession):
     return team_model
 
 
-def get_fitted_team_model(season, gameweek, dbsession):
+def get_training_data_hash(training_data):
+    """
+    Hash of the training data for the team model (as returned by
+    get_training_data), used as the key for cached fitted models.
+    """
+    h = hashlib.sha256(ExtendedDixonColesMatchPredictor.__name__.encode())
+    for key in ["home_team", "away_team", "home_goals", "away_goals"]:
+        values = np.asarray(training_data[key])
+        h.update(key.encode())
+        h.update(str(values.dtype).encode())
+        h.update(values.tobytes())
+    for team, covariates in sorted(training_data.get("team_covariates", {}).items()):
+        h.update(team.encode())
+        h.update(np.asarray(covariates, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def load_cached_team_model(key, cache_dir=TEAM_MODEL_CACHE_DIR):
     """
-    get the fitted team model using the past results and the FIFA rankings
+    Load the fitted team model saved in the cache with key, or return None if
+    there isn't one.
+    """
+    cache_file = os.path.join(cache_dir, "team_model_{}.pkl".format(key))
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, "rb") as f:
+            team_model = pickle.load(f)
+    except Exception as e:
+        # e.g. file written by a different version of bpl - just refit
+        print("Failed to load cached team model {}: {}".format(cache_file, e))
+        return None
+    # mark as recently used so it's not the next to be evicted
+    os.utime(cache_file)
+    return team_model
+
+
+def save_cached_team_model(
+    team_model, key, cache_dir=TEAM_MODEL_CACHE_DIR, max_size=TEAM_MODEL_CACHE_SIZE
+):
+    """
+    Save a fitted team model in the cache with key, then remove the least
+    recently used models until there are at most max_size in the cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = os.path.join(cache_dir, "team_model_{}.pkl".format(key))
+    # write to a temporary file first so other processes never see a partial file
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(tmp_file, "wb") as f:
+        pickle.dump(team_model, f)
+    os.replace(tmp_file, cache_file)
+
+    cached = [
+        os.path.join(cache_dir, filename)
+        for filename in os.listdir(cache_dir)
+        if filename.startswith("team_model_") and filename.endswith(".pkl")
+    ]
+    cached.sort(key=os.path.getmtime, reverse=True)
+    for old_file in cached[max_size:]:
+        try:
+            os.remove(old_file)
+        except FileNotFoundError:
+            pass
+
+
+def get_fitted_team_model(
+    season, gameweek, dbsession, use_cache=True, cache_dir=TEAM_MODEL_CACHE_DIR
+):
+    """
+    get the fitted team model using the past results and the FIFA rankings.
+    If use_cache is True, a model previously fitted to the same training data is
+    loaded from cache_dir instead of refitting it.
     """
-    print("Fitting team model...")
     training_data = get_training_data(season, gameweek, dbsession)
-    team_model = create_and_fit_team_model(training_data)
+    team_model = None
+    if use_cache:
+        key = get_training_data_hash(training_data)
+        team_model = load_cached_team_model(key, cache_dir)
+        if team_model is not None:
+            print("Using cached team model")
+    if team_model is None:
+        print("Fitting team model...")
+        team_model = create_and_fit_team_model(training_data)
+        if use_cache:
+            save_cached_team_model(team_model, key, cache_dir)
     return add_new_teams_to_model(team_model, season, dbsession)
 
 
@@ -136,20 +225,53 @@ def fixture_probabilities(
     )
 
 
-def get_goal_probabilities_for_fixtures(fixtures, team_model, max_goals=10):
-    """Get the probability that each team in a fixture scores any number of goals up
-    to max_goals."""
+def get_goal_probability_tensor(fixtures, team_model, max_goals=10):
+    """Get the probability that each team in each fixture scores any number of goals
+    up to max_goals, with a single call to the team model for all fixtures.
+    Returns a (n_fixtures, 2, max_goals + 1) array of probabilities, where the
+    second axis is home team then away team and the third the number of goals, and a
+    dict {fixture_id: index in the first axis}.
+    """
+    fixtures = list(fixtures)
     goals = np.arange(0, max_goals + 1)
-    probs = {}
-    for f in fixtures:
-        home_team_goal_prob = team_model.predict_score_n_proba(
-            goals, f.home_team, f.away_team, home=True
-        )
-        away_team_goal_prob = team_model.predict_score_n_proba(
-            goals, f.away_team, f.home_team, home=False
+    if len(fixtures) == 0:
+        return np.zeros((0, 2, len(goals))), {}
+    n_scores = len(goals) ** 2
+    # every possible scoreline up to max_goals for every fixture
+    home_goals, away_goals = (
+        g.ravel() for g in np.meshgrid(goals, goals, indexing="ij")
+    )
+    home_teams = np.repeat([f.home_team for f in fixtures], n_scores)
+    away_teams = np.repeat([f.away_team for f in fixtures], n_scores)
+    score_probs = np.asarray(
+        team_model.predict_score_proba(
+            home_teams,
+            away_teams,
+            np.tile(home_goals, len(fixtures)),
+            np.tile(away_goals, len(fixtures)),
         )
-        probs[f.fixture_id] = {
-            f.home_team: {g: p for g, p in zip(goals, home_team_goal_prob)},
-            f.away_team: {g: p for g, p in zip(goals, away_team_goal_prob)},
+    ).reshape((len(fixtures), len(goals), len(goals)))
+    # marginal probabilities for the number of goals scored by each team
+    probs = np.stack([score_probs.sum(axis=2), score_probs.sum(axis=1)], axis=1)
+    fixture_index = {f.fixture_id: i for i, f in enumerate(fixtures)}
+    return probs, fixture_index
+
+
+def get_goal_probabilities_dict(fixtures, probs, fixture_index):
+    """Convert the output of get_goal_probability_tensor into a dict
+    {fixture_id: {team: {goals: probability}}}."""
+    goals = range(probs.shape[2])
+    return {
+        f.fixture_id: {
+            f.home_team: dict(zip(goals, probs[fixture_index[f.fixture_id], 0])),
+            f.away_team: dict(zip(goals, probs[fixture_index[f.fixture_id], 1])),
         }
-    return probs
+        for f in fixtures
+    }
+
+
+def get_goal_probabilities_for_fixtures(fixtures, team_model, max_goals=10):
+    """Get the probability that each team in a fixture scores any number of goals up
+    to max_goals, as a dict {fixture_id: {team: {goals: probability}}}."""
+    probs, fixture_index = get_goal_probability_tensor(fixtures, team_model, max_goals)
+    return get_goal_probabilities_dict(fixtures, probs, fixture_index)
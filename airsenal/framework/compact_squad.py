@@ -0,0 +1,158 @@
+"""
+Array-backed squad for the optimisers, which need to copy and modify many squads.
+Players are stored as indices into a PlayerCatalog, and the counts per position
+and per team are kept up to date so the squad constraints are cheap to check.
+"""
+
+import copy
+
+import numpy as np
+
+from airsenal.framework.player import CandidatePlayer
+from airsenal.framework.player_catalog import POSITIONS
+from airsenal.framework.squad import Squad, TOTAL_PER_POSITION
+
+SQUAD_SIZE = 15
+MAX_PER_TEAM = 3
+
+# maximum players per position, in the order of POSITIONS
+_MAX_PER_POSITION = np.array([TOTAL_PER_POSITION[pos] for pos in POSITIONS])
+
+
+class CompactSquad(object):
+    """
+    A squad of up to 15 players from catalog, stored as the catalog indices and
+    purchase prices of the players (in the order they were added) along with the
+    number of players in each position and team and the remaining budget.
+    """
+
+    def __init__(self, catalog, budget=1000):
+        self.catalog = catalog
+        self.indices = np.full(SQUAD_SIZE, -1, dtype=np.int32)
+        self.purchase_prices = np.zeros(SQUAD_SIZE, dtype=np.int32)
+        self.num_players = 0
+        self.num_position = np.zeros(len(POSITIONS), dtype=np.int32)
+        self.num_team = np.zeros(len(catalog.team_names), dtype=np.int32)
+        self.budget = budget
+
+    @classmethod
+    def from_squad(cls, squad, catalog):
+        """
+        Create a CompactSquad with the same players, purchase prices and budget as
+        a Squad. All the players must be in catalog.
+        """
+        compact = cls(catalog)
+        for p in squad.players:
+            compact._append(catalog.index[p.player_id], p.purchase_price)
+        compact.budget = squad.budget
+        return compact
+
+    def to_squad(self, season, gameweek, players=None):
+        """
+        Create a Squad with the same players, purchase prices and budget, e.g. for
+        printing it or saving transfer suggestions. players is an optional dict of
+        {player_id: player object} to copy into the Squad, otherwise CandidatePlayers
+        are created for season and gameweek.
+        """
+        squad = Squad(budget=self.budget)
+        for index, price in zip(self.indices[: self.num_players], self.purchase_prices):
+            player_id = int(self.catalog.player_ids[index])
+            if players and player_id in players:
+                # the player objects are shared between squads, so don't set the
+                # purchase price (or the lineup later) on them directly
+                player = copy.copy(players[player_id])
+            else:
+                player = CandidatePlayer(player_id, season, gameweek)
+            player.purchase_price = int(price)
+            squad.players.append(player)
+            squad.num_position[player.position] += 1
+        return squad
+
+    def copy(self):
+        """
+        Copy the squad, sharing the (read-only) catalog.
+        """
+        new_squad = CompactSquad.__new__(CompactSquad)
+        new_squad.catalog = self.catalog
+        new_squad.indices = self.indices.copy()
+        new_squad.purchase_prices = self.purchase_prices.copy()
+        new_squad.num_players = self.num_players
+        new_squad.num_position = self.num_position.copy()
+        new_squad.num_team = self.num_team.copy()
+        new_squad.budget = self.budget
+        return new_squad
+
+    @property
+    def player_ids(self):
+        return self.catalog.player_ids[self.indices[: self.num_players]]
+
+    def is_complete(self):
+        """
+        See if we have 15 players.
+        """
+        return self.num_players == SQUAD_SIZE
+
+    def contains(self, index):
+        """
+        See if the player at index in the catalog is in the squad.
+        """
+        return bool((self.indices[: self.num_players] == index).any())
+
+    def can_add(self, index, price=None, check_budget=True, check_team=True):
+        """
+        Check whether the player at index in the catalog can be added without
+        breaking the squad constraints, as in Squad.add_player.
+        """
+        if price is None:
+            price = self.catalog.prices[index]
+        if self.contains(index):
+            return False
+        position = self.catalog.position_codes[index]
+        if self.num_position[position] >= _MAX_PER_POSITION[position]:
+            return False
+        if check_budget and price > self.budget:
+            return False
+        if check_team and self.num_team[self.catalog.team_codes[index]] >= MAX_PER_TEAM:
+            return False
+        return True
+
+    def add_player(self, index, price=None, check_budget=True, check_team=True):
+        """
+        Add the player at index in the catalog, at price (or their price in the
+        catalog if not given). Returns False without changing the squad if that
+        would break the squad constraints.
+        """
+        if price is None:
+            price = self.catalog.prices[index]
+        if not self.can_add(index, price, check_budget, check_team):
+            return False
+        self._append(index, price)
+        return True
+
+    def _append(self, index, price):
+        self.indices[self.num_players] = index
+        self.purchase_prices[self.num_players] = price
+        self.num_players += 1
+        self.num_position[self.catalog.position_codes[index]] += 1
+        self.num_team[self.catalog.team_codes[index]] += 1
+        self.budget -= int(price)
+
+    def remove_player(self, index, price):
+        """
+        Remove the player at index in the catalog, selling them for price.
+        Returns False if they're not in the squad.
+        """
+        slots = np.flatnonzero(self.indices[: self.num_players] == index)
+        if len(slots) == 0:
+            return False
+        # keep the remaining players in order
+        keep = np.arange(SQUAD_SIZE) != slots[0]
+        self.indices[:-1] = self.indices[keep]
+        self.purchase_prices[:-1] = self.purchase_prices[keep]
+        self.num_players -= 1
+        self.indices[self.num_players] = -1
+        self.purchase_prices[self.num_players] = 0
+        self.num_position[self.catalog.position_codes[index]] -= 1
+        self.num_team[self.catalog.team_codes[index]] -= 1
+        self.budget += int(price)
+        return True
@@ -6,11 +6,21 @@ Taken from
 https://gist.github.com/FanchenBao/d8577599c46eab1238a81857bb7277c9
 by Fanchen Bao, based on this Stack Overflow thread:
 https://stackoverflow.com/questions/41952413/get-length-of-queue-in-pythons-multiprocessing-library
+
+Also functions to share numpy arrays between processes without copying them.
 """
 
 from multiprocessing.queues import Queue
 import multiprocessing
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # only available from Python 3.8
+    shared_memory = None
+
+import numpy as np
+
 # The following implementation of custom MyQueue to avoid NotImplementedError
 # when calling queue.qsize() in MacOS X comes almost entirely from this github
 # discussion: https://github.com/keras-team/autokeras/issues/368
@@ -76,3 +86,45 @@ class CustomQueue(Queue):
     def empty(self):
         """Reliable implementation of multiprocessing.Queue.empty()"""
         return not self.qsize()
+
+
+def share_arrays(arrays):
+    """
+    Copy a dict of numpy arrays (of numeric or fixed-width string dtypes) into a
+    single block of shared memory.
+    Returns the SharedMemory object, which the caller must close and unlink when
+    the arrays are no longer needed, and a picklable description of the arrays to
+    pass to attach_arrays in other processes.
+    """
+    if shared_memory is None:
+        raise ModuleNotFoundError(
+            "Sharing arrays between processes requires Python 3.8 or later"
+        )
+    layout = []
+    size = 0
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        # align each array to 64 bytes
+        offset = -(-size // 64) * 64
+        layout.append((key, array.dtype.str, array.shape, offset))
+        size = offset + array.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for key, dtype, shape, offset in layout:
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = arrays[key]
+    return shm, (shm.name, layout)
+
+
+def attach_arrays(description):
+    """
+    Attach to arrays shared by share_arrays. Returns the SharedMemory object, which
+    must be kept open while the arrays are used, and a dict of read-only arrays
+    using the shared memory as their buffer.
+    """
+    name, layout = description
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for key, dtype, shape, offset in layout:
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        array.setflags(write=False)
+        arrays[key] = array
+    return shm, arrays
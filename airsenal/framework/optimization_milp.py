@@ -0,0 +1,592 @@
+"""
+Alternative approach to the tree search in fill_transfersuggestion_table, which
+plans the transfers and chips for several gameweeks by solving a single
+mixed-integer linear program (MILP) with the HiGHS solver in scipy.
+
+The tree search tries every combination of the number of transfers in each
+gameweek, and finds the transfers for each combination greedily, so the number of
+strategies it tries grows exponentially with the number of gameweeks. The MILP
+finds the best transfers, starting 11s, captains and chips over the whole
+gameweek range at once.
+"""
+try:
+    from scipy.optimize import Bounds, LinearConstraint, milp
+except ImportError:
+    raise ModuleNotFoundError(
+        "MILP optimisation needs scipy 1.9 or later (for scipy.optimize.milp). "
+        "Upgrade it with 'pip install --upgrade scipy'."
+    )
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from airsenal.framework.compact_squad import MAX_PER_TEAM, SQUAD_SIZE
+from airsenal.framework.optimization_utils import get_discount_factor
+from airsenal.framework.player_catalog import POSITIONS, get_player_catalog
+from airsenal.framework.prediction_matrix import get_prediction_matrix
+from airsenal.framework.season import CURRENT_SEASON
+from airsenal.framework.squad import ACTIVE_PER_POSITION, TOTAL_PER_POSITION, Squad
+
+CHIPS = ["wildcard", "free_hit", "triple_captain", "bench_boost"]
+
+# points deducted for each transfer beyond the free transfers
+HIT_COST = 4
+
+
+class _MILPModel(object):
+    """
+    The variables, linear constraints and objective of a MILP, built up a block at
+    a time and then solved with scipy.optimize.milp. Variables are referred to by
+    their index, and the objective is maximised.
+    """
+
+    def __init__(self):
+        self.lower = []
+        self.upper = []
+        self.integer = []
+        self.objective = []
+        self.rows = []
+        self.cols = []
+        self.coefs = []
+        self.row_lower = []
+        self.row_upper = []
+
+    def add_variables(self, n, lower=0, upper=1, integer=True):
+        """
+        Add n variables (binary by default), returning an array of their indices.
+        lower and upper can be a single value or an array of n values.
+        """
+        start = len(self.lower)
+        self.lower += np.broadcast_to(lower, n).tolist()
+        self.upper += np.broadcast_to(upper, n).tolist()
+        self.integer += [int(integer)] * n
+        self.objective += [0.0] * n
+        return np.arange(start, start + n)
+
+    def add_objective(self, variables, coefs):
+        """
+        Add coefs times variables to the objective.
+        """
+        variables = np.atleast_1d(variables)
+        coefs = np.broadcast_to(coefs, variables.shape)
+        for var, coef in zip(variables.tolist(), coefs.tolist()):
+            self.objective[var] += coef
+
+    def add_constraint(self, terms, lower=-np.inf, upper=np.inf):
+        """
+        Add the constraint lower <= sum(coefs * variables) <= upper, where terms is
+        a list of (variables, coefs) and coefs can be a single value.
+        """
+        row = len(self.row_lower)
+        for variables, coefs in terms:
+            variables = np.atleast_1d(variables)
+            self.rows.append(np.full(len(variables), row))
+            self.cols.append(variables)
+            self.coefs.append(np.broadcast_to(coefs, variables.shape))
+        self.row_lower.append(lower)
+        self.row_upper.append(upper)
+
+    def add_elementwise_constraints(self, terms, lower=-np.inf, upper=np.inf):
+        """
+        Add one constraint for each element of the variable arrays in terms, a list
+        of (variables, coef), i.e. lower[i] <= sum(coef * variables[i]) <= upper[i]
+        for each i. A single variable (e.g. a chip) is used in every constraint.
+        """
+        n = max(np.size(variables) for variables, _ in terms)
+        start = len(self.row_lower)
+        for variables, coef in terms:
+            self.rows.append(np.arange(start, start + n))
+            self.cols.append(np.broadcast_to(variables, n))
+            self.coefs.append(np.full(n, coef, dtype=float))
+        self.row_lower += np.broadcast_to(lower, n).tolist()
+        self.row_upper += np.broadcast_to(upper, n).tolist()
+
+    def solve(self, time_limit=None, mip_gap=None, verbose=False):
+        """
+        Solve the MILP, returning the value of each variable. If time_limit
+        (seconds) is reached the best solution found so far is returned, and
+        mip_gap is the relative gap to the upper bound at which to stop.
+        """
+        matrix = coo_matrix(
+            (
+                np.concatenate(self.coefs),
+                (np.concatenate(self.rows), np.concatenate(self.cols)),
+            ),
+            shape=(len(self.row_lower), len(self.lower)),
+        ).tocsr()
+        options = {"disp": verbose}
+        if time_limit is not None:
+            options["time_limit"] = time_limit
+        if mip_gap is not None:
+            options["mip_rel_gap"] = mip_gap
+        result = milp(
+            -np.array(self.objective),
+            constraints=LinearConstraint(matrix, self.row_lower, self.row_upper),
+            integrality=self.integer,
+            bounds=Bounds(self.lower, self.upper),
+            options=options,
+        )
+        if result.x is None:
+            raise RuntimeError("MILP optimisation failed: {}".format(result.message))
+        return result.x
+
+
+def get_player_pool(squad, gameweeks, tag, season=CURRENT_SEASON):
+    """
+    Players that could be in the squad over gameweeks: those in the player catalog
+    for the first gameweek with some predicted points in gameweeks, and the players
+    already in squad.
+    Returns a dict of arrays, one element per player, with keys "player_ids",
+    "positions" and "teams" (codes, indices in POSITIONS and team_names), "prices"
+    (to buy them), "sell_prices" (their sell price if they're in squad, or their
+    price), "in_squad" and "points" (players x gameweeks), and "team_names".
+    """
+    catalog = get_player_catalog(season, gameweeks[0])
+    matrix = get_prediction_matrix(tag, season)
+    squad_ids = {p.player_id for p in squad.players}
+    points = np.stack(
+        [matrix.get_points(catalog.player_ids, gw) for gw in gameweeks], axis=1
+    )
+    keep = [
+        i
+        for i, player_id in enumerate(catalog.player_ids.tolist())
+        if points[i].sum() > 0 or player_id in squad_ids
+    ]
+    player_ids = catalog.player_ids[keep].tolist()
+    positions = catalog.positions[keep].tolist()
+    teams = catalog.teams[keep].tolist()
+    prices = catalog.prices[keep].tolist()
+    points = points[keep].tolist()
+    # squad players that aren't in the catalog, using their own details
+    for p in squad.players:
+        if p.player_id not in catalog:
+            player_ids.append(p.player_id)
+            positions.append(p.position)
+            teams.append(p.team)
+            prices.append(p.purchase_price)
+            points.append(
+                [p.predicted_points.get(tag, {}).get(gw, 0) for gw in gameweeks]
+            )
+    sell_prices = list(prices)
+    for p in squad.players:
+        sell_prices[player_ids.index(p.player_id)] = squad.get_sell_price_for_player(
+            p, season=season, gameweek=gameweeks[0]
+        )
+    team_names, team_codes = np.unique(teams, return_inverse=True)
+    return {
+        "player_ids": np.array(player_ids),
+        "positions": np.array([POSITIONS.index(pos) for pos in positions]),
+        "teams": team_codes,
+        "team_names": team_names,
+        "prices": np.array(prices, dtype=float),
+        "sell_prices": np.array(sell_prices, dtype=float),
+        "in_squad": np.array([pid in squad_ids for pid in player_ids]),
+        "points": np.array(points, dtype=float).reshape(len(player_ids), -1),
+    }
+
+
+def _add_squad_constraints(model, players, pool):
+    """
+    The players (array of variables, one per player in the pool) must be a valid
+    squad, with the right number of players in each position and at most
+    MAX_PER_TEAM from each team.
+    """
+    for code, pos in enumerate(POSITIONS):
+        in_position = players[pool["positions"] == code]
+        model.add_constraint(
+            [(in_position, 1)], TOTAL_PER_POSITION[pos], TOTAL_PER_POSITION[pos]
+        )
+    for code in range(len(pool["team_names"])):
+        model.add_constraint([(players[pool["teams"] == code], 1)], upper=MAX_PER_TEAM)
+
+
+def _add_lineup(model, playing, pool):
+    """
+    Add variables for a starting 11 with a valid formation and a captain chosen
+    from playing (array of variables, one per player in the pool). Returns the
+    starting and captain variables.
+    """
+    n_players = len(playing)
+    starting = model.add_variables(n_players)
+    model.add_elementwise_constraints([(starting, 1), (playing, -1)], upper=0)
+    model.add_constraint([(starting, 1)], 11, 11)
+    for code, pos in enumerate(POSITIONS):
+        model.add_constraint(
+            [(starting[pool["positions"] == code], 1)], *ACTIVE_PER_POSITION[pos]
+        )
+    captain = model.add_variables(n_players)
+    model.add_elementwise_constraints([(captain, 1), (starting, -1)], upper=0)
+    model.add_constraint([(captain, 1)], 1, 1)
+    return starting, captain
+
+
+def _get_chip_options(chip_gw_dict, gameweeks):
+    """
+    For each chip, whether it must be played (lower bound 1) or may be played
+    (upper bound 1) in each gameweek, given chip_gw_dict in the format from
+    fill_transfersuggestion_table.construct_chip_dict.
+    """
+    options = {}
+    for chip in CHIPS:
+        lower, upper = [], []
+        for gw in gameweeks:
+            gw_chips = chip_gw_dict.get(gw, {})
+            forced = gw_chips.get("chip_to_play") == chip
+            allowed = forced or chip in (gw_chips.get("chips_allowed") or [])
+            lower.append(int(forced))
+            upper.append(int(allowed))
+        options[chip] = (lower, upper)
+    return options
+
+
+def make_transfer_plan_milp(
+    squad,
+    gameweeks,
+    tag,
+    season=CURRENT_SEASON,
+    free_transfers=1,
+    chip_gw_dict={},
+    max_total_hit=None,
+    allow_unused_transfers=True,
+    max_transfers=2,
+    time_limit=None,
+    mip_gap=None,
+    verbose=False,
+):
+    """
+    Find the transfers and chips that maximise the expected points over gameweeks,
+    starting from squad with free_transfers free transfers, by solving a MILP.
+    The variables are the squad after the transfers in each gameweek, the players
+    bought and sold, the starting 11, captain and chips, and the free transfers and
+    hits in each gameweek. The constraints are the same as for the tree search in
+    fill_transfersuggestion_table:
+    * valid squads (players per position and per team) and starting 11s
+    * the bank after each gameweek's transfers can't be negative, using the sell
+    prices of the players in squad and the current prices of other players
+    * one more free transfer each gameweek, up to 2, and HIT_COST points for each
+    transfer beyond them, or at most max_total_hit points in total
+    * at most max_transfers transfers a gameweek, unless playing a wildcard
+    * at least one transfer when there are 2 free transfers, unless
+    allow_unused_transfers is True
+    * chips can be played in the gameweeks allowed by chip_gw_dict (from
+    construct_chip_dict), each chip at most once and one chip a gameweek. A free
+    hit squad only lasts one gameweek and is bought with the squad's sell value,
+    and after a wildcard or free hit there's one free transfer.
+    The points in each gameweek are discounted with get_discount_factor.
+    Proving the solution is optimal can take much longer than finding it, so
+    time_limit (in seconds) and mip_gap (relative gap to the best possible score)
+    can be used to stop the solver early with the best plan found so far.
+
+    Returns a strategy dict in the same format as the tree search's (keyed by
+    gameweek as a string, as when loaded from json): total_score, points_per_gw,
+    players_in, players_out, chips_played and root_gw. For wildcards and free hits
+    all 15 players are out and the whole new squad is in.
+    """
+    pool = get_player_pool(squad, gameweeks, tag, season)
+    n_players = len(pool["player_ids"])
+    prices, sell_prices = pool["prices"], pool["sell_prices"]
+    # big enough to switch off the free hit budget constraint
+    max_squad_cost = SQUAD_SIZE * prices.max()
+    chip_options = _get_chip_options(chip_gw_dict, gameweeks)
+    model = _MILPModel()
+
+    chips = {}
+    for chip in CHIPS:
+        lower, upper = chip_options[chip]
+        chips[chip] = model.add_variables(len(gameweeks), lower, upper)
+        # each chip can only be played once
+        model.add_constraint([(chips[chip], 1)], upper=1)
+    for t in range(len(gameweeks)):
+        # one chip a gameweek
+        model.add_constraint([(chips[chip][t], 1) for chip in CHIPS], upper=1)
+
+    free = model.add_variables(
+        len(gameweeks),
+        [free_transfers] + [1] * (len(gameweeks) - 1),
+        [free_transfers] + [2] * (len(gameweeks) - 1),
+    )
+    hits = model.add_variables(len(gameweeks), 0, np.inf)
+    if max_total_hit is not None:
+        model.add_constraint([(hits, HIT_COST)], upper=max_total_hit)
+
+    variables = []
+    prev_squad, prev_bank = None, None
+    for t, gw in enumerate(gameweeks):
+        discount = get_discount_factor(gameweeks[0], gw)
+        wildcard, free_hit = chips["wildcard"][t], chips["free_hit"][t]
+        gw_vars = {
+            "squad": model.add_variables(n_players),
+            "buy": model.add_variables(n_players),
+            "sell": model.add_variables(n_players),
+            "bank": model.add_variables(1, 0, np.inf, integer=False)[0],
+        }
+        # squad = previous squad + bought - sold
+        if prev_squad is None:
+            model.add_elementwise_constraints(
+                [(gw_vars["squad"], 1), (gw_vars["buy"], -1), (gw_vars["sell"], 1)],
+                pool["in_squad"],
+                pool["in_squad"],
+            )
+        else:
+            model.add_elementwise_constraints(
+                [
+                    (gw_vars["squad"], 1),
+                    (gw_vars["buy"], -1),
+                    (gw_vars["sell"], 1),
+                    (prev_squad, -1),
+                ],
+                0,
+                0,
+            )
+        # don't sell and buy back the same player
+        model.add_elementwise_constraints(
+            [(gw_vars["buy"], 1), (gw_vars["sell"], 1)], upper=1
+        )
+        _add_squad_constraints(model, gw_vars["squad"], pool)
+
+        # bank = previous bank + sales - purchases
+        bank_terms = [
+            (gw_vars["bank"], 1),
+            (gw_vars["sell"], -sell_prices),
+            (gw_vars["buy"], prices),
+        ]
+        if prev_bank is None:
+            model.add_constraint(bank_terms, squad.budget, squad.budget)
+        else:
+            model.add_constraint(bank_terms + [(prev_bank, -1)], 0, 0)
+
+        # transfers beyond the free transfers are hits, unless playing a wildcard
+        # or free hit
+        n_transfers = (gw_vars["buy"], 1)
+        model.add_constraint(
+            [
+                n_transfers,
+                (free[t], -1),
+                (hits[t], -1),
+                (wildcard, -SQUAD_SIZE),
+                (free_hit, -SQUAD_SIZE),
+            ],
+            upper=0,
+        )
+        if max_transfers is not None:
+            model.add_constraint(
+                [n_transfers, (wildcard, -SQUAD_SIZE)], upper=max_transfers
+            )
+        if not allow_unused_transfers:
+            # at least one transfer if there are 2 free transfers
+            model.add_constraint(
+                [n_transfers, (free[t], -1), (wildcard, 1), (free_hit, 1)], lower=-1
+            )
+        if t + 1 < len(gameweeks):
+            # unused free transfers carry over (up to 2), but only one after a
+            # wildcard or free hit
+            model.add_constraint(
+                [
+                    (free[t + 1], 1),
+                    (free[t], -1),
+                    n_transfers,
+                    (hits[t], -1),
+                    (wildcard, -SQUAD_SIZE),
+                    (free_hit, -SQUAD_SIZE),
+                ],
+                upper=1,
+            )
+            model.add_constraint(
+                [(free[t + 1], 1), (wildcard, 1), (free_hit, 1)], upper=2
+            )
+        model.add_objective(hits[t], -HIT_COST * discount)
+
+        # the squad that plays this gameweek, which is different if playing a free
+        # hit
+        if chip_options["free_hit"][1][t]:
+            playing = model.add_variables(n_players)
+            _add_squad_constraints(model, playing, pool)
+            # same as the squad unless playing a free hit
+            model.add_elementwise_constraints(
+                [(playing, 1), (gw_vars["squad"], -1), (free_hit, -1)], upper=0
+            )
+            model.add_elementwise_constraints(
+                [(gw_vars["squad"], 1), (playing, -1), (free_hit, -1)], upper=0
+            )
+            # no transfers to the squad during a free hit
+            model.add_constraint(
+                [n_transfers, (free_hit, SQUAD_SIZE)], upper=SQUAD_SIZE
+            )
+            # the free hit squad costs at most the sell value of the squad plus
+            # the bank
+            if prev_squad is None:
+                model.add_constraint(
+                    [(playing, prices), (free_hit, max_squad_cost)],
+                    upper=max_squad_cost
+                    + squad.budget
+                    + sell_prices[pool["in_squad"]].sum(),
+                )
+            else:
+                model.add_constraint(
+                    [
+                        (playing, prices),
+                        (free_hit, max_squad_cost),
+                        (prev_squad, -sell_prices),
+                        (prev_bank, -1),
+                    ],
+                    upper=max_squad_cost,
+                )
+        else:
+            playing = gw_vars["squad"]
+        gw_vars["playing"] = playing
+
+        # starting 11 and captain
+        points = pool["points"][:, t] * discount
+        starting, captain = _add_lineup(model, playing, pool)
+        model.add_objective(starting, points)
+        model.add_objective(captain, points)
+        gw_vars["starting"] = starting
+        gw_vars["captain"] = captain
+        gw_vars["chip_points"] = []
+        if chip_options["triple_captain"][1][t]:
+            triple_captain = model.add_variables(n_players)
+            model.add_elementwise_constraints(
+                [(triple_captain, 1), (captain, -1)], upper=0
+            )
+            model.add_constraint(
+                [(triple_captain, 1), (chips["triple_captain"][t], -1)], upper=0
+            )
+            model.add_objective(triple_captain, points)
+            gw_vars["chip_points"].append(triple_captain)
+        if chip_options["bench_boost"][1][t]:
+            bench = model.add_variables(n_players)
+            model.add_elementwise_constraints(
+                [(bench, 1), (playing, -1), (starting, 1)], upper=0
+            )
+            model.add_constraint(
+                [(bench, 1), (chips["bench_boost"][t], 11 - SQUAD_SIZE)], upper=0
+            )
+            model.add_objective(bench, points)
+            gw_vars["chip_points"].append(bench)
+
+        variables.append(gw_vars)
+        prev_squad = gw_vars["squad"]
+        prev_bank = gw_vars["bank"]
+
+    solution = np.round(
+        model.solve(time_limit=time_limit, mip_gap=mip_gap, verbose=verbose)
+    )
+    return _get_strategy(solution, variables, chips, hits, pool, gameweeks)
+
+
+def _get_strategy(solution, variables, chips, hits, pool, gameweeks):
+    """
+    Convert the solution of the MILP in make_transfer_plan_milp to a strategy dict.
+    """
+    player_ids = pool["player_ids"]
+    strategy = {
+        "total_score": 0.0,
+        "points_per_gw": {},
+        "players_in": {},
+        "players_out": {},
+        "chips_played": {},
+        "root_gw": gameweeks[0],
+    }
+    prev_squad = pool["in_squad"]
+    for t, gw in enumerate(gameweeks):
+        gw_vars = variables[t]
+        squad = solution[gw_vars["squad"]] > 0.5
+        playing = solution[gw_vars["playing"]] > 0.5
+        chip = None
+        for name in CHIPS:
+            if solution[chips[name][t]] > 0.5:
+                chip = name
+        if chip in ["wildcard", "free_hit"]:
+            players_in = player_ids[playing]
+            players_out = player_ids[prev_squad]
+        else:
+            players_in = player_ids[squad & ~prev_squad]
+            players_out = player_ids[prev_squad & ~squad]
+        discount = get_discount_factor(gameweeks[0], gw)
+        points = pool["points"][:, t]
+        gw_points = points @ solution[gw_vars["starting"]]
+        gw_points += points @ solution[gw_vars["captain"]]
+        for chip_vars in gw_vars["chip_points"]:
+            gw_points += points @ solution[chip_vars]
+        gw_points = (gw_points - HIT_COST * solution[hits[t]]) * discount
+
+        key = str(gw)
+        strategy["points_per_gw"][key] = float(gw_points)
+        strategy["total_score"] += float(gw_points)
+        strategy["players_in"][key] = [int(pid) for pid in players_in]
+        strategy["players_out"][key] = [int(pid) for pid in players_out]
+        strategy["chips_played"][key] = chip
+        prev_squad = squad
+    return strategy
+
+
+def make_new_squad_milp(
+    gw_range,
+    tag,
+    budget=1000,
+    season=CURRENT_SEASON,
+    bench_boost_gw=None,
+    triple_captain_gw=None,
+    sub_weights={"GK": 0.01, "Outfield": (0.4, 0.1, 0.02)},
+    time_limit=None,
+    mip_gap=None,
+    verbose=False,
+    update_func_and_args=None,
+    **kwargs,
+):
+    """
+    Choose the best squad from scratch (for the start of the season, a wildcard or
+    a free hit) by solving a MILP for the squad, and its starting 11 and captain in
+    each gameweek in gw_range, maximising the same score as
+    optimization_pygmo.SquadOpt: the discounted expected points of the starting 11
+    in each gameweek, plus the substitutes' points weighted by sub_weights (the
+    substitute goalkeeper, and the outfield substitutes in order), or all 15
+    players' points in bench_boost_gw.
+    Returns the squad, a Squad of CandidatePlayers.
+    """
+    pool = get_player_pool(Squad(budget=budget), gw_range, tag, season)
+    n_players = len(pool["player_ids"])
+    goalkeeper = pool["positions"] == POSITIONS.index("GK")
+    model = _MILPModel()
+
+    players = model.add_variables(n_players)
+    _add_squad_constraints(model, players, pool)
+    model.add_constraint([(players, pool["prices"])], upper=budget)
+    for t, gw in enumerate(gw_range):
+        points = pool["points"][:, t] * get_discount_factor(gw_range[0], gw)
+        starting, captain = _add_lineup(model, players, pool)
+        model.add_objective(captain, points * (2 if gw == triple_captain_gw else 1))
+        if gw == bench_boost_gw:
+            model.add_objective(players, points)
+            continue
+        model.add_objective(starting, points)
+        # the substitute goalkeeper is the one that isn't starting
+        model.add_objective(players[goalkeeper], sub_weights["GK"] * points[goalkeeper])
+        model.add_objective(
+            starting[goalkeeper], -sub_weights["GK"] * points[goalkeeper]
+        )
+        # outfield substitutes in order, each one a squad player that isn't starting
+        sub_order = [
+            model.add_variables(n_players, upper=(~goalkeeper).astype(int))
+            for _ in sub_weights["Outfield"]
+        ]
+        model.add_elementwise_constraints(
+            [(sub, 1) for sub in sub_order] + [(starting, 1), (players, -1)], upper=0
+        )
+        for sub, weight in zip(sub_order, sub_weights["Outfield"]):
+            model.add_constraint([(sub, 1)], 1, 1)
+            model.add_objective(sub, weight * points)
+
+    solution = np.round(
+        model.solve(time_limit=time_limit, mip_gap=mip_gap, verbose=verbose)
+    )
+    if update_func_and_args:
+        # call function to update progress bar, all the way as there's one step
+        update_func_and_args[0](100, update_func_and_args[2])
+
+    squad = Squad(budget=budget)
+    for player_id in pool["player_ids"][solution[players] > 0.5]:
+        squad.add_player(int(player_id), season=season, gameweek=gw_range[0])
+    if verbose:
+        print(squad)
+    return squad
@@ -13,12 +13,19 @@ except ModuleNotFoundError:
         "'conda install pygmo'. If not see https://esa.github.io/pygmo2/install.html"
     )
 
+import copy
 import uuid
+
+import numpy as np
+
 from airsenal.framework.utils import (
     CURRENT_SEASON,
     list_players,
     get_predicted_points_for_player,
 )
+from airsenal.framework.compact_squad import MAX_PER_TEAM
+from airsenal.framework.player_catalog import get_player_catalog
+from airsenal.framework.prediction_matrix import get_prediction_matrix
 from airsenal.framework.squad import Squad, TOTAL_PER_POSITION
 from airsenal.framework.optimization_utils import get_discount_factor
 
@@ -119,6 +126,14 @@ class SquadOpt:
         if remove_zero:
             self._remove_zero_pts()
         self.n_available_players = len(self.players)
+        self._set_player_arrays()
+
+    def __deepcopy__(self, memo):
+        """PyGMO deep copies problems, e.g. when making populations. Nothing is
+        changed after __init__ so copies share the players (database objects, slow
+        to copy) and arrays rather than copying them.
+        """
+        return copy.copy(self)
 
     def fitness(self, player_ids):
         """PyGMO required function. The objective function to minimise.
@@ -126,55 +141,71 @@ class SquadOpt:
             - 0 if the proposed squad isn't valid
             - weghted sum of gameweek points otherwise
         """
-        # Make squad from player IDs
-        squad = Squad(budget=self.budget)
-        for idx in player_ids:
-            add_ok = squad.add_player(
-                self.players[int(idx)].player_id,
-                season=self.season,
-                gameweek=self.start_gw,
-            )
-            if not add_ok:
-                return [0]
-
+        return [self.batch_fitness(player_ids)[0]]
+
+    def batch_fitness(self, dvs):
+        """PyGMO function. The fitness of many proposed squads at once, where dvs
+        is their player indices one squad after another. Squads are checked and
+        scored with arrays of the players' prices, teams and points rather than by
+        making a Squad for each one, choosing the starting 11, captain and
+        substitutes in the same way as Squad.get_expected_points.
+        """
+        idx = np.asarray(dvs).reshape(-1, self.n_opt_players).astype(int)
+        n_squads = len(idx)
         # fill empty slots with dummy players (if chosen not to optimise full squad)
-        for pos in self.positions:
-            if self.dummy_per_position[pos] > 0:
-                for _ in range(self.dummy_per_position[pos]):
-                    dp = DummyPlayer(
-                        self.gw_range, self.tag, pos, price=self.dummy_sub_cost
-                    )
-                    add_ok = squad.add_player(dp)
-                    if not add_ok:
-                        return [0]
-
-        # Check squad is valid, if not return fitness of zero
-        if not squad.is_complete():
-            return [0]
-
-        #  Calc expected points for all gameweeks
+        idx = np.hstack(
+            [idx, np.broadcast_to(self.dummy_idx, (n_squads, len(self.dummy_idx)))]
+        )
+
+        # Check squads are valid (within budget, no duplicate players, and no more
+        # than MAX_PER_TEAM players from a team), fitness of zero if not
+        valid = self.prices[idx].sum(axis=1) <= self.budget
+        valid &= (np.diff(np.sort(idx, axis=1), axis=1) != 0).all(axis=1)
+        teams = np.sort(self.teams[idx], axis=1)
+        valid &= (teams[:, MAX_PER_TEAM:] != teams[:, :-MAX_PER_TEAM]).all(axis=1)
+
+        #  Calc expected points for all gameweeks
         # - weight each gw points by its gw_weight
         # - weight each sub by their sub_weight
-        score = 0.0
+        score = np.zeros(n_squads)
         for i, gw in enumerate(self.gw_range):
-            gw_weight = self.gw_weight[i]
+            points = self.points[idx, i]
+            # each position's points in descending order
+            pos_points = {
+                pos: -np.sort(-points[:, cols], axis=1)
+                for pos, cols in self.position_cols.items()
+            }
+            # the best 3 DEF, 3 MID and FWD always start, along with the best 3 of
+            # the other outfield players, and the rest are subs in points order
+            others = -np.sort(
+                -np.hstack(
+                    [
+                        pos_points["DEF"][:, 3:],
+                        pos_points["MID"][:, 3:],
+                        pos_points["FWD"][:, 1:],
+                    ]
+                ),
+                axis=1,
+            )
+            gw_score = (
+                pos_points["GK"][:, 0]
+                + pos_points["DEF"][:, :3].sum(axis=1)
+                + pos_points["MID"][:, :3].sum(axis=1)
+                + pos_points["FWD"][:, 0]
+                + others[:, :3].sum(axis=1)
+            )
+            # the highest scoring player is always starting and captain
+            captain_multiplier = 2 if gw == self.triple_captain_gw else 1
+            gw_score += captain_multiplier * points.max(axis=1)
+
             if gw == self.bench_boost_gw:
-                score += gw_weight * squad.get_expected_points(
-                    gw, self.tag, bench_boost=True
-                )
-            elif gw == self.triple_captain_gw:
-                score += gw_weight * squad.get_expected_points(
-                    gw, self.tag, triple_captain=True
-                )
+                gw_score += pos_points["GK"][:, 1] + others[:, 3:].sum(axis=1)
             else:
-                score += gw_weight * squad.get_expected_points(gw, self.tag)
-
-            if gw != self.bench_boost_gw:
-                score += gw_weight * squad.total_points_for_subs(
-                    gw, self.tag, sub_weights=self.sub_weights
-                )
+                gw_score += self.sub_weights["GK"] * pos_points["GK"][:, 1]
+                gw_score += others[:, 3:] @ np.array(self.sub_weights["Outfield"])
+            score += self.gw_weight[i] * gw_score
 
-        return [-score]
+        return np.where(valid, -score, 0.0)
 
     def get_bounds(self):
         """PyGMO required function. Defines min and max value for each parameter."""
@@ -246,6 +277,54 @@ class SquadOpt:
         self.players = players
         self.position_idx = position_idx
 
+    def _set_player_arrays(self):
+        """Arrays of the price, team code and predicted points in each gameweek of
+        the players in self.players followed by the dummy players, for scoring
+        squads in batch_fitness. Also sets the indices of the dummy players
+        (dummy_idx), and the columns of each position in a squad made of a
+        proposed squad followed by the dummy players (position_cols).
+        """
+        catalog = get_player_catalog(self.season, self.start_gw)
+        matrix = get_prediction_matrix(self.tag, self.season)
+        prices = []
+        teams = []
+        for p in self.players:
+            details = catalog.get(p.player_id)
+            if details is None:
+                prices.append(p.price(self.season, self.start_gw))
+                teams.append(p.team(self.season, self.start_gw))
+            else:
+                prices.append(details[3])
+                teams.append(details[1])
+        points = [
+            matrix.get_points([p.player_id for p in self.players], gw)
+            for gw in self.gw_range
+        ]
+
+        # dummy players each in their own team, with zero points
+        n_dummies = sum(self.dummy_per_position.values())
+        self.dummy_idx = np.arange(len(self.players), len(self.players) + n_dummies)
+        prices += [self.dummy_sub_cost] * n_dummies
+        teams += ["DUMMY_{}".format(i) for i in range(n_dummies)]
+        self.prices = np.array(prices)
+        self.teams = np.unique(teams, return_inverse=True)[1]
+        self.points = np.vstack(
+            [np.stack(points, axis=1), np.zeros((n_dummies, len(self.gw_range)))]
+        )
+
+        # proposed squads have players ordered by position, as in get_bounds
+        position_cols = {}
+        start = 0
+        for pos in self.positions:
+            n = self.players_per_position[pos]
+            position_cols[pos] = list(range(start, start + n))
+            start += n
+        for pos in self.positions:
+            n = self.dummy_per_position[pos]
+            position_cols[pos] += list(range(start, start + n))
+            start += n
+        self.position_cols = position_cols
+
     def _get_dummy_per_position(self):
         """No. of dummy players per position needed to complete the squad (if not
         optimising the full squad)
@@ -341,9 +420,13 @@ def make_new_squad_pygmo(
     # Create algorithm to solve problem with
     algo = pg.algorithm(uda=uda)
     algo.set_verbosity(verbose)
+    # evaluate whole populations with SquadOpt.batch_fitness where possible
+    bfe = pg.bfe(pg.member_bfe())
+    if hasattr(uda, "set_bfe"):
+        algo.extract(type(uda)).set_bfe(bfe)
 
     # population of problems
-    pop = pg.population(prob=prob, size=population_size)
+    pop = pg.population(prob=prob, size=population_size, b=bfe)
 
     # solve problem
     pop = algo.evolve(pop)
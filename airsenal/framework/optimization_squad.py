@@ -25,10 +25,28 @@ def make_new_squad(
     **kwargs,
 ):
     """
-    Optimise a new squad from scratch with one of two algorithms:
+    Optimise a new squad from scratch with one of three algorithms:
     - algorithm="normal" : airsenal.framework.optimization_squad.make_new_squad_iter
     - algorithm="genetic": airsenal.framework.optimization_pygmo.make_new_squad_pygmo
+    - algorithm="milp"   : airsenal.framework.optimization_milp.make_new_squad_milp
     """
+    if algorithm == "milp":
+        try:
+            from airsenal.framework.optimization_milp import make_new_squad_milp
+        except ModuleNotFoundError:
+            print("Running optimisation without scipy's MILP solver instead...")
+        else:
+            return make_new_squad_milp(
+                gw_range=gw_range,
+                tag=tag,
+                budget=budget,
+                season=season,
+                bench_boost_gw=bench_boost_gw,
+                triple_captain_gw=triple_captain_gw,
+                verbose=verbose,
+                **kwargs,
+            )
+
     if algorithm == "genetic":
         from airsenal.framework.optimization_pygmo import make_new_squad_pygmo
 
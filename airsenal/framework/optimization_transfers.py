@@ -5,6 +5,11 @@ of using chips.
 import random
 from operator import itemgetter
 
+from airsenal.framework.compact_squad import CompactSquad
+from airsenal.framework.player import CandidatePlayer
+from airsenal.framework.player_catalog import PlayerCatalog
+from airsenal.framework.schema import Player
+from airsenal.framework.squad import select_formation
 from airsenal.framework.utils import (
     NEXT_GAMEWEEK,
     CURRENT_SEASON,
@@ -16,6 +21,181 @@ from airsenal.framework.optimization_utils import get_discount_factor
 from airsenal.framework.optimization_squad import make_new_squad
 
 
+def _to_candidate_player(player, season, gameweek):
+    """
+    Convert a player id, name or database Player to a CandidatePlayer, as in
+    Squad.add_player. Anything else is assumed to be a CandidatePlayer already.
+    """
+    if isinstance(player, Player):
+        # use the id, so the player catalog is used rather than the database
+        player = player.player_id
+    if isinstance(player, (int, str)):
+        return CandidatePlayer(player, season, gameweek)
+    return player
+
+
+def get_transfer_candidates(squad, ordered_player_lists, season, transfer_gw):
+    """
+    Set up a search for the best transfers out of squad, using the players in
+    ordered_player_lists (as returned by get_predicted_points for each position) as
+    replacements.
+    Returns a CompactSquad of the current squad, the candidate replacements as a
+    dict {position: [(catalog index, player),...]} in the same order as
+    ordered_player_lists, a dict {player_id: player object} for creating Squads from
+    the results, and the sell price of each player in the squad {player_id: price}.
+    """
+    squad_players = fastcopy(squad.players)
+    candidates = {}
+    for pos, player_list in ordered_player_lists.items():
+        candidates[pos] = [
+            _to_candidate_player(p, season, transfer_gw) for p, _ in player_list
+        ]
+    catalog = PlayerCatalog.from_players(
+        squad_players + [p for pos_list in candidates.values() for p in pos_list],
+        season,
+        transfer_gw,
+    )
+    players = {}
+    for p in squad_players:
+        players.setdefault(p.player_id, p)
+    for pos, pos_list in candidates.items():
+        for p in pos_list:
+            players.setdefault(p.player_id, p)
+        candidates[pos] = [(catalog.index[p.player_id], p) for p in pos_list]
+    sell_prices = {
+        p.player_id: squad.get_sell_price_for_player(
+            p, season=season, gameweek=transfer_gw
+        )
+        for p in squad.players
+    }
+    return CompactSquad.from_squad(squad, catalog), candidates, players, sell_prices
+
+
+def get_squad_points(
+    squad, tag, gameweek_range, root_gw, bench_boost_gw=None, triple_captain_gw=None
+):
+    """
+    Total expected points for squad over gameweek_range, discounted relative to
+    root_gw, playing the bench boost or triple captain chips in the given gameweeks.
+    """
+    total_points = 0.0
+    for gw in gameweek_range:
+        if gw == bench_boost_gw:
+            total_points += squad.get_expected_points(
+                gw, tag, bench_boost=True
+            ) * get_discount_factor(root_gw, gw)
+        elif gw == triple_captain_gw:
+            total_points += squad.get_expected_points(
+                gw, tag, triple_captain=True
+            ) * get_discount_factor(root_gw, gw)
+        else:
+            total_points += squad.get_expected_points(gw, tag) * get_discount_factor(
+                root_gw, gw
+            )
+    return total_points
+
+
+def _insert_descending(values, x):
+    """
+    Insert x into values (sorted in descending order) after any equal values.
+    """
+    i = 0
+    while i < len(values) and values[i] >= x:
+        i += 1
+    values.insert(i, x)
+
+
+class TransferScorer(object):
+    """
+    Score squads made by transferring a few players out of squad, giving the same
+    points as get_squad_points without creating each new Squad. The points of the
+    players in each position, sorted in descending order, are kept for squad in
+    each gameweek, and only the positions affected by a transfer are updated
+    before choosing the best starting 11 with select_formation.
+    """
+
+    def __init__(
+        self,
+        squad,
+        tag,
+        gameweek_range,
+        root_gw,
+        bench_boost_gw=None,
+        triple_captain_gw=None,
+    ):
+        self.tag = tag
+        self.gameweek_range = gameweek_range
+        self.discount = [get_discount_factor(root_gw, gw) for gw in gameweek_range]
+        self.bench_boost = [gw == bench_boost_gw for gw in gameweek_range]
+        self.triple_captain = [gw == triple_captain_gw for gw in gameweek_range]
+        # sorted points for each gameweek, {position: [points,...]}
+        self.points = []
+        for gw in gameweek_range:
+            gw_points = {"GK": [], "DEF": [], "MID": [], "FWD": []}
+            for p in squad.players:
+                gw_points[p.position].append(self.get_player_points(p).get(gw, 0))
+            for pos_points in gw_points.values():
+                pos_points.sort(reverse=True)
+            self.points.append(gw_points)
+
+    def get_player_points(self, player):
+        """
+        Predicted points for player, {gameweek: points}. Gameweeks where the
+        player has no fixture are missing and count as zero points.
+        """
+        player.calc_predicted_points(self.tag)
+        return player.predicted_points[self.tag]
+
+    def best_points(self, players):
+        """
+        Highest predicted points of any of players in each gameweek, {gameweek:
+        points}, i.e. the points of an imaginary player at least as good as any
+        of them. Scoring a transfer with these points in place of a real player's
+        gives an upper bound on the score of that transfer.
+        """
+        best = {}
+        for gw in self.gameweek_range:
+            best[gw] = max(self.get_player_points(p).get(gw, 0) for p in players)
+        return best
+
+    def score(self, players_out, players_in):
+        """
+        Discounted total points over the gameweek range after replacing the players
+        in players_out with the players in players_in (lists of CandidatePlayers or
+        similar).
+        """
+        return self.score_points(
+            players_out, [(p.position, self.get_player_points(p)) for p in players_in]
+        )
+
+    def score_points(self, players_out, points_in):
+        """
+        As score, but with the players transferred in given by points_in, a list
+        of (position, {gameweek: points}).
+        """
+        total_points = 0.0
+        for i, gw in enumerate(self.gameweek_range):
+            gw_points = dict(self.points[i])
+            for p in players_out:
+                pos_points = list(gw_points[p.position])
+                pos_points.remove(self.get_player_points(p).get(gw, 0))
+                gw_points[p.position] = pos_points
+            for position, p_points in points_in:
+                pos_points = list(gw_points[position])
+                _insert_descending(pos_points, p_points.get(gw, 0))
+                gw_points[position] = pos_points
+            top_points = max(pos_points[0] for pos_points in gw_points.values())
+            if self.bench_boost[i]:
+                # everyone plays, and the highest scoring player is captain
+                gw_score = sum(sum(pos_points) for pos_points in gw_points.values())
+            else:
+                _, gw_score = select_formation(gw_points)
+                gw_score += gw_points["GK"][0]
+            gw_score += top_points * (2 if self.triple_captain[i] else 1)
+            total_points += gw_score * self.discount[i]
+        return total_points
+
+
 def make_optimum_single_transfer(
     squad,
     tag,
@@ -42,55 +222,60 @@ def make_optimum_single_transfer(
     transfer_gw = min(gameweek_range)  # the week we're making the transfer
     best_score = -1.0
     best_pid_out, best_pid_in = 0, 0
+    best_squad = None
     if verbose:
         print("Creating ordered player lists")
     ordered_player_lists = {
         pos: get_predicted_points(gameweek=gameweek_range, position=pos, tag=tag)
         for pos in ["GK", "DEF", "MID", "FWD"]
     }
+    compact_squad, candidates, players, sell_prices = get_transfer_candidates(
+        squad, ordered_player_lists, season, transfer_gw
+    )
+    catalog_index = compact_squad.catalog.index
+    scorer = TransferScorer(
+        squad, tag, gameweek_range, root_gw, bench_boost_gw, triple_captain_gw
+    )
     for p_out in squad.players:
         if update_func_and_args:
             # call function to update progress bar.
             # this was passed as a tuple (func, increment, pid)
             update_func_and_args[0](update_func_and_args[1], update_func_and_args[2])
 
-        new_squad = fastcopy(squad)
+        new_squad = compact_squad.copy()
         position = p_out.position
         if verbose:
             print("Removing player {}".format(p_out.player_id))
-        new_squad.remove_player(p_out.player_id, season=season, gameweek=transfer_gw)
-        for p_in in ordered_player_lists[position]:
-            if p_in[0].player_id == p_out.player_id:
+        new_squad.remove_player(
+            catalog_index[p_out.player_id], sell_prices[p_out.player_id]
+        )
+        for index_in, p_in in candidates[position]:
+            if p_in.player_id == p_out.player_id:
                 continue  # no point in adding the same player back in
-            added_ok = new_squad.add_player(
-                p_in[0], season=season, gameweek=transfer_gw
-            )
+            added_ok = new_squad.add_player(index_in)
             if added_ok:
                 if verbose:
-                    print("Added player {}".format(p_in[0].name))
+                    print("Added player {}".format(p_in.name))
                 break
             else:
                 if verbose:
-                    print("Failed to add {}".format(p_in[0].name))
-        total_points = 0.0
-        for gw in gameweek_range:
-            if gw == bench_boost_gw:
-                total_points += new_squad.get_expected_points(
-                    gw, tag, bench_boost=True
-                ) * get_discount_factor(root_gw, gw)
-            elif gw == triple_captain_gw:
-                total_points += new_squad.get_expected_points(
-                    gw, tag, triple_captain=True
-                ) * get_discount_factor(root_gw, gw)
-            else:
-                total_points += new_squad.get_expected_points(
-                    gw, tag
-                ) * get_discount_factor(root_gw, gw)
+                    print("Failed to add {}".format(p_in.name))
+        if not new_squad.is_complete():
+            raise RuntimeError("Squad is incomplete")
+        total_points = scorer.score([p_out], [p_in])
         if total_points > best_score:
             best_score = total_points
             best_pid_out = p_out.player_id
-            best_pid_in = p_in[0].player_id
+            best_pid_in = p_in.player_id
             best_squad = new_squad
+    if best_squad is None:
+        # no transfer scored better than best_score, so keep the squad as it is
+        return fastcopy(squad), [], []
+    best_squad = fastcopy(best_squad.to_squad(season, transfer_gw, players))
+    # score the best squad in full to pick its lineup and captain
+    get_squad_points(
+        best_squad, tag, gameweek_range, root_gw, bench_boost_gw, triple_captain_gw
+    )
     return best_squad, [best_pid_out], [best_pid_in]
 
 
@@ -110,6 +295,9 @@ def make_optimum_double_transfer(
     possibilities in turn.
     We will order the list of potential subs via the sum of expected points
     over a specified range of gameweeks.
+    Pairs of players out, and first players in, are skipped if even replacing
+    them with the best players in their positions (ignoring budget and team
+    constraints) couldn't beat the best squad found so far.
     """
     if not gameweek_range:
         gameweek_range = [NEXT_GAMEWEEK]
@@ -118,17 +306,31 @@ def make_optimum_double_transfer(
     transfer_gw = min(gameweek_range)  # the week we're making the transfer
     best_score = 0.0
     best_pid_out, best_pid_in = 0, 0
+    best_squad = None
     ordered_player_lists = {
         pos: get_predicted_points(gameweek=gameweek_range, position=pos, tag=tag)
         for pos in ["GK", "DEF", "MID", "FWD"]
     }
+    compact_squad, candidates, players, sell_prices = get_transfer_candidates(
+        squad, ordered_player_lists, season, transfer_gw
+    )
+    catalog_index = compact_squad.catalog.index
+    scorer = TransferScorer(
+        squad, tag, gameweek_range, root_gw, bench_boost_gw, triple_captain_gw
+    )
+    # best points of any player in each position, for upper bounds on the score
+    best_in = {
+        pos: scorer.best_points([p for _, p in pos_candidates])
+        for pos, pos_candidates in candidates.items()
+    }
+    n_explored, n_pruned = 0, 0
     for i in range(len(squad.players) - 1):
         positions_needed = []
         pout_1 = squad.players[i]
 
-        new_squad_remove_1 = fastcopy(squad)
+        new_squad_remove_1 = compact_squad.copy()
         new_squad_remove_1.remove_player(
-            pout_1.player_id, season=season, gameweek=transfer_gw
+            catalog_index[pout_1.player_id], sell_prices[pout_1.player_id]
         )
         for j in range(i + 1, len(squad.players)):
             if update_func_and_args:
@@ -139,59 +341,69 @@ def make_optimum_double_transfer(
                 )
 
             pout_2 = squad.players[j]
-            new_squad_remove_2 = fastcopy(new_squad_remove_1)
+            # what positions do we need to fill?
+            positions_needed = [pout_1.position, pout_2.position]
+            upper_bound = scorer.score_points(
+                [pout_1, pout_2], [(pos, best_in[pos]) for pos in positions_needed]
+            )
+            if upper_bound <= best_score:
+                n_pruned += 1
+                continue
+            new_squad_remove_2 = new_squad_remove_1.copy()
             new_squad_remove_2.remove_player(
-                pout_2.player_id, season=season, gameweek=transfer_gw
+                catalog_index[pout_2.player_id], sell_prices[pout_2.player_id]
             )
             if verbose:
                 print("Removing players {} {}".format(i, j))
-            # what positions do we need to fill?
-            positions_needed = [pout_1.position, pout_2.position]
 
             # now loop over lists of players and add players back in
-            for pin_1 in ordered_player_lists[positions_needed[0]]:
-                if pin_1[0].player_id in [pout_1.player_id, pout_2.player_id]:
+            for index_1, pin_1 in candidates[positions_needed[0]]:
+                if pin_1.player_id in [pout_1.player_id, pout_2.player_id]:
                     continue  # no point in adding same player back in
-                new_squad_add_1 = fastcopy(new_squad_remove_2)
-                added_1_ok = new_squad_add_1.add_player(
-                    pin_1[0], season=season, gameweek=transfer_gw
+                upper_bound = scorer.score_points(
+                    [pout_1, pout_2],
+                    [
+                        (positions_needed[0], scorer.get_player_points(pin_1)),
+                        (positions_needed[1], best_in[positions_needed[1]]),
+                    ],
                 )
+                if upper_bound <= best_score:
+                    n_pruned += 1
+                    continue
+                new_squad_add_1 = new_squad_remove_2.copy()
+                added_1_ok = new_squad_add_1.add_player(index_1)
                 if not added_1_ok:
                     continue
-                for pin_2 in ordered_player_lists[positions_needed[1]]:
-                    new_squad_add_2 = fastcopy(new_squad_add_1)
+                for index_2, pin_2 in candidates[positions_needed[1]]:
                     if (
-                        pin_2[0] == pin_1[0]
-                        or pin_2[0].player_id == pout_1.player_id
-                        or pin_2[0].player_id == pout_2.player_id
+                        index_2 == index_1
+                        or pin_2.player_id == pout_1.player_id
+                        or pin_2.player_id == pout_2.player_id
                     ):
                         continue  # no point in adding same player back in
-                    added_2_ok = new_squad_add_2.add_player(
-                        pin_2[0], season=season, gameweek=transfer_gw
-                    )
-                    if added_2_ok:
+                    if new_squad_add_1.can_add(index_2):
+                        new_squad_add_2 = new_squad_add_1.copy()
+                        new_squad_add_2.add_player(index_2)
                         # calculate the score
-                        total_points = 0.0
-                        for gw in gameweek_range:
-                            if gw == bench_boost_gw:
-                                total_points += new_squad_add_2.get_expected_points(
-                                    gw, tag, bench_boost=True
-                                ) * get_discount_factor(root_gw, gw)
-                            elif gw == triple_captain_gw:
-                                total_points += new_squad_add_2.get_expected_points(
-                                    gw, tag, triple_captain=True
-                                ) * get_discount_factor(root_gw, gw)
-                            else:
-                                total_points += new_squad_add_2.get_expected_points(
-                                    gw, tag
-                                ) * get_discount_factor(root_gw, gw)
+                        n_explored += 1
+                        total_points = scorer.score([pout_1, pout_2], [pin_1, pin_2])
                         if total_points > best_score:
                             best_score = total_points
                             best_pid_out = [pout_1.player_id, pout_2.player_id]
-                            best_pid_in = [pin_1[0].player_id, pin_2[0].player_id]
+                            best_pid_in = [pin_1.player_id, pin_2.player_id]
                             best_squad = new_squad_add_2
                         break
 
+    if verbose:
+        print("Scored {} squads, pruned {} branches".format(n_explored, n_pruned))
+    if best_squad is None:
+        # no pair of transfers scored better than best_score, so keep the squad
+        return fastcopy(squad), [], []
+    best_squad = fastcopy(best_squad.to_squad(season, transfer_gw, players))
+    # score the best squad in full to pick its lineup and captain
+    get_squad_points(
+        best_squad, tag, gameweek_range, root_gw, bench_boost_gw, triple_captain_gw
+    )
     return best_squad, best_pid_out, best_pid_in
 
 
@@ -287,20 +499,9 @@ def make_random_transfers(
                 added_players = []
 
         # calculate the score
-        total_points = 0.0
-        for gw in gw_range:
-            if gw == bench_boost_gw:
-                total_points += new_squad.get_expected_points(
-                    gw, tag, bench_boost=True
-                ) * get_discount_factor(root_gw, gw)
-            elif gw == triple_captain_gw:
-                total_points += new_squad.get_expected_points(
-                    gw, tag, triple_captain=True
-                ) * get_discount_factor(root_gw, gw)
-            else:
-                total_points += new_squad.get_expected_points(
-                    gw, tag
-                ) * get_discount_factor(root_gw, gw)
+        total_points = get_squad_points(
+            new_squad, tag, gw_range, root_gw, bench_boost_gw, triple_captain_gw
+        )
         if total_points > best_score:
             best_score = total_points
             best_pid_out = removed_players
@@ -401,15 +602,12 @@ def make_best_transfers(
         )
 
     # get the expected points total for next gameweek
-    points = (
-        new_squad.get_expected_points(
-            gameweeks[0],
-            tag,
-            triple_captain=(triple_captain_gw is not None),
-            bench_boost=(bench_boost_gw is not None),
-        )
-        * get_discount_factor(root_gw, gameweeks[0])
-    )
+    points = new_squad.get_expected_points(
+        gameweeks[0],
+        tag,
+        triple_captain=(triple_captain_gw is not None),
+        bench_boost=(bench_boost_gw is not None),
+    ) * get_discount_factor(root_gw, gameweeks[0])
 
     if num_transfers == "F":
         # Free Hit changes don't apply to next gameweek, so return the original squad
@@ -3,6 +3,7 @@ Class for a player in FPL
 """
 
 from airsenal.framework.schema import Player
+from airsenal.framework.player_catalog import get_player_catalog
 from airsenal.framework.utils import (
     get_player,
     get_predicted_points_for_player,
@@ -20,18 +21,27 @@ class CandidatePlayer(object):
         self, player, season=CURRENT_SEASON, gameweek=NEXT_GAMEWEEK, dbsession=None
     ):
         """
-        initialize either by name or by ID
+        initialize either by name or by ID. Players given by ID are looked up in the
+        player catalog for the season and gameweek if possible, rather than in the
+        database.
         """
         self.dbsession = dbsession
-        if isinstance(player, Player):
-            pdata = player
+        catalog_data = None
+        if isinstance(player, int):
+            catalog_data = get_player_catalog(season, gameweek, dbsession).get(player)
+        if catalog_data is not None:
+            self.player_id = player
+            self.name, self.team, self.position, self.purchase_price = catalog_data
         else:
-            pdata = get_player(player, self.dbsession)
-        self.player_id = pdata.player_id
-        self.name = pdata.name
-        self.team = pdata.team(season, gameweek)
-        self.position = pdata.position(season)
-        self.purchase_price = pdata.price(season, gameweek)
+            if isinstance(player, Player):
+                pdata = player
+            else:
+                pdata = get_player(player, self.dbsession)
+            self.player_id = pdata.player_id
+            self.name = pdata.name
+            self.team = pdata.team(season, gameweek)
+            self.position = pdata.position(season)
+            self.purchase_price = pdata.price(season, gameweek)
         self.is_starting = True  # by default
         self.is_captain = False  # by default
         self.is_vice_captain = False  # by default
@@ -0,0 +1,217 @@
+"""
+Read-only in-memory catalog of the players available in a season and gameweek,
+so that CandidatePlayer and Squad objects can be created without querying the
+database for every player (e.g. in the inner loops of the optimisers).
+"""
+
+import numpy as np
+
+from airsenal.framework.multiprocessing_utils import attach_arrays, share_arrays
+from airsenal.framework.schema import (
+    Player,
+    PlayerAttributes,
+    find_gameweek_attributes,
+    index_attributes_by_season,
+    session,
+)
+
+POSITIONS = ["GK", "DEF", "MID", "FWD"]
+
+# catalogs already built in this process, keyed by (db url, season, gameweek).
+# Worker processes created by fork inherit these.
+_catalogs = {}
+# attributes of each player in a season, keyed by (db url, season), so catalogs for
+# several gameweeks of a season only need one query
+_season_attributes = {}
+
+
+class PlayerCatalog(object):
+    """
+    The id, name, team, position and price of every player with attributes in a
+    season, as of a gameweek, stored in arrays indexed by position in the catalog.
+    """
+
+    def __init__(self, season, gameweek, player_ids, names, teams, positions, prices):
+        self.season = season
+        self.gameweek = gameweek
+        self.player_ids = np.asarray(player_ids, dtype=np.int32)
+        # fixed-width strings rather than objects, so they can be shared
+        self.names = np.asarray(names, dtype=str)
+        self.teams = np.asarray(teams, dtype=str)
+        self.positions = np.asarray(positions, dtype=str)
+        self.prices = np.asarray(prices, dtype=np.int32)
+        self.index = {pid: i for i, pid in enumerate(self.player_ids.tolist())}
+        # integer codes for each player's position (index in POSITIONS) and team
+        # (index in team_names), e.g. for counting players in a squad
+        self.position_codes = np.array(
+            [POSITIONS.index(p) for p in self.positions.tolist()], dtype=np.int32
+        )
+        self.team_names, team_codes = np.unique(self.teams, return_inverse=True)
+        self.team_codes = team_codes.astype(np.int32)
+
+    @classmethod
+    def from_db(cls, season, gameweek, dbsession=None):
+        """
+        Build the catalog for season and gameweek, using the same team, position
+        and price lookups as the Player class. The attributes for the season are
+        queried once and reused for catalogs of other gameweeks in the season.
+        """
+        player_ids, names, teams, positions, prices = [], [], [], [], []
+        for (player_id, name), season_index in _get_season_attributes(
+            season, dbsession
+        ).items():
+            team_attr = find_gameweek_attributes(season_index, gameweek)
+            price_attr = find_gameweek_attributes(
+                season_index, gameweek, before_and_after=True
+            )
+            if team_attr is None or price_attr is None:
+                # no usable gameweeks - leave these players to the Player class
+                continue
+            player_ids.append(player_id)
+            names.append(name)
+            teams.append(team_attr.team)
+            positions.append(find_gameweek_attributes(season_index, None).position)
+            prices.append(Player._calculate_price(price_attr, gameweek))
+        return cls(season, gameweek, player_ids, names, teams, positions, prices)
+
+    @classmethod
+    def from_players(cls, players, season, gameweek):
+        """
+        Build a catalog from player objects (CandidatePlayer, or anything with the
+        same attributes), using their purchase prices as their prices. If a
+        player_id appears more than once only the first player with that id is used.
+        """
+        unique_players = {}
+        for p in players:
+            unique_players.setdefault(p.player_id, p)
+        players = list(unique_players.values())
+        return cls(
+            season,
+            gameweek,
+            [p.player_id for p in players],
+            [p.name for p in players],
+            [p.team for p in players],
+            [p.position for p in players],
+            [p.purchase_price for p in players],
+        )
+
+    def share(self):
+        """
+        Copy the catalog into shared memory. Returns the SharedMemory block, which
+        the caller must close and unlink when finished with it, and a handle that
+        can be passed to PlayerCatalog.attach in other processes.
+        """
+        shm, description = share_arrays(
+            {
+                "player_ids": self.player_ids,
+                "names": self.names,
+                "teams": self.teams,
+                "positions": self.positions,
+                "prices": self.prices,
+            }
+        )
+        return shm, (self.season, self.gameweek, description)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Create a catalog using the arrays shared by PlayerCatalog.share, without
+        copying them.
+        """
+        season, gameweek, description = handle
+        shm, arrays = attach_arrays(description)
+        catalog = cls(season, gameweek, **arrays)
+        # keep the shared memory open for as long as the catalog is used
+        catalog._shm = shm
+        return catalog
+
+    def __len__(self):
+        return len(self.player_ids)
+
+    def __contains__(self, player_id):
+        return player_id in self.index
+
+    def get(self, player_id):
+        """
+        Return (name, team, position, price) for player_id, or None if the player
+        is not in the catalog.
+        """
+        i = self.index.get(player_id)
+        if i is None:
+            return None
+        return (
+            str(self.names[i]),
+            str(self.teams[i]),
+            str(self.positions[i]),
+            int(self.prices[i]),
+        )
+
+
+def _get_season_attributes(season, dbsession=None):
+    """
+    Query the attributes of every player in season, returning a dict
+    {(player_id, name): attributes indexed by gameweek}.
+    """
+    if not dbsession:
+        dbsession = session
+    key = (str(dbsession.bind.url), season)
+    if key in _season_attributes:
+        return _season_attributes[key]
+    rows = (
+        dbsession.query(
+            Player.player_id,
+            Player.name,
+            PlayerAttributes.season,
+            PlayerAttributes.gameweek,
+            PlayerAttributes.team,
+            PlayerAttributes.position,
+            PlayerAttributes.price,
+        )
+        .join(PlayerAttributes, PlayerAttributes.player_id == Player.player_id)
+        .filter(PlayerAttributes.season == season)
+        .order_by(Player.player_id, PlayerAttributes.id)
+        .all()
+    )
+    player_rows = {}
+    for row in rows:
+        player_rows.setdefault((row.player_id, row.name), []).append(row)
+    _season_attributes[key] = {
+        player: index_attributes_by_season(attributes)[season]
+        for player, attributes in player_rows.items()
+    }
+    return _season_attributes[key]
+
+
+def _get_catalog_key(season, gameweek, dbsession):
+    if not dbsession:
+        dbsession = session
+    return (str(dbsession.bind.url), season, gameweek)
+
+
+def get_player_catalog(season, gameweek, dbsession=None):
+    """
+    Get the PlayerCatalog for season and gameweek, building it from the database
+    the first time it's needed in this process.
+    """
+    key = _get_catalog_key(season, gameweek, dbsession)
+    if key not in _catalogs:
+        _catalogs[key] = PlayerCatalog.from_db(season, gameweek, dbsession)
+    return _catalogs[key]
+
+
+def set_player_catalog(catalog, dbsession=None):
+    """
+    Add an existing catalog (e.g. one built in a parent process) to the catalogs
+    used in this process.
+    """
+    _catalogs[_get_catalog_key(catalog.season, catalog.gameweek, dbsession)] = catalog
+
+
+def clear_player_catalogs():
+    """
+    Remove all catalogs built in this process. Called after the player and player
+    attribute tables are updated (see update_db and make_init_db), and after each
+    API request.
+    """
+    _catalogs.clear()
+    _season_attributes.clear()
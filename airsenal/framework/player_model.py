@@ -1,8 +1,11 @@
+import numpy as np
 import jax.numpy as jnp
 import jax.random as random
 import numpyro
 import numpyro.distributions as dist
-from numpyro.infer import MCMC, NUTS
+from numpyro import optim
+from numpyro.infer import MCMC, NUTS, SVI, Trace_ELBO, init_to_value
+from numpyro.infer.autoguide import AutoNormal
 
 from typing import Any, Dict, Optional
 
@@ -15,6 +18,8 @@ class PlayerModel(object):
     def __init__(self):
         self.player_ids = None
         self.samples = None
+        self.step_size = None
+        self.inverse_mass_matrix = None
 
     @staticmethod
     def _model(
@@ -45,18 +50,48 @@ class PlayerModel(object):
         random_state: int = 42,
         num_warmup: int = 500,
         num_samples: int = 2000,
+        num_chains: int = 1,
+        chain_method: str = "parallel",
         mcmc_kwargs: Optional[Dict[str, Any]] = None,
         run_kwargs: Optional[Dict[str, Any]] = None,
+        warm_start: Optional[Dict[str, Any]] = None,
+        total_samples: Optional[int] = None,
     ):
+        """
+        Fit the model with NUTS. num_samples is the number of posterior samples
+        from each of the num_chains chains, or if total_samples is given that many
+        samples are split between the chains instead. chain_method can be "parallel"
+        (one chain per CPU device, see numpyro.set_host_device_count, falling back
+        to "sequential" if there are not enough devices), "sequential" or
+        "vectorized".
+        warm_start is the state of a previous fit (from get_warm_start). If given,
+        the sampler starts from the previous posterior means, step size and mass
+        matrix (which is then not adapted again), so a much shorter num_warmup can
+        be used.
+        """
         self.player_ids = data["player_ids"]
-        kernel = NUTS(self._model)
+        if warm_start is None:
+            kernel = NUTS(self._model)
+        else:
+            init_probs, inverse_mass_matrix = self._get_warm_start_values(
+                data, warm_start
+            )
+            kernel = NUTS(
+                self._model,
+                step_size=float(warm_start["step_size"]),
+                inverse_mass_matrix=inverse_mass_matrix,
+                adapt_mass_matrix=False,
+                init_strategy=init_to_value(values={"probs": init_probs}),
+            )
+        if total_samples is not None:
+            num_samples = -(-total_samples // num_chains)  # samples per chain
         mcmc = MCMC(
             kernel,
             num_warmup=num_warmup,
             num_samples=num_samples,
-            num_chains=1,
-            progress_bar=True,
-            **(mcmc_kwargs or {}),
+            num_chains=num_chains,
+            chain_method=chain_method,
+            **{"progress_bar": True, **(mcmc_kwargs or {})},
         )
         rng_key, rng_key_predict = random.split(random.PRNGKey(44))
         mcmc.run(
@@ -69,6 +104,89 @@ class PlayerModel(object):
             **(run_kwargs or {}),
         )
         self.samples = mcmc.get_samples()
+        adapt_state = mcmc.last_state.adapt_state
+        self.step_size = float(jnp.mean(adapt_state.step_size))
+        inverse_mass_matrix = adapt_state.inverse_mass_matrix
+        if isinstance(inverse_mass_matrix, dict):
+            # newer numpyro versions key the mass matrix by site names
+            (inverse_mass_matrix,) = inverse_mass_matrix.values()
+        # diagonal mass matrix for the 2 unconstrained parameters of each player
+        # (averaged over chains if there were several)
+        self.inverse_mass_matrix = (
+            np.asarray(inverse_mass_matrix)
+            .reshape((-1, data["nplayer"], 2))
+            .mean(axis=0)
+        )
+        return self
+
+    @staticmethod
+    def _get_warm_start_values(data, warm_start):
+        """
+        Initial values of probs and the diagonal of the inverse mass matrix for
+        each player in data: their values from warm_start, or the prior mean and
+        the average inverse mass matrix for players not in warm_start.
+        """
+        alpha = np.asarray(data["alpha"], dtype=float)
+        probs = np.tile(alpha / alpha.sum(), (data["nplayer"], 1))
+        inverse_mass_matrix = np.tile(
+            warm_start["inverse_mass_matrix"].mean(axis=0), (data["nplayer"], 1)
+        )
+        index = {pid: i for i, pid in enumerate(warm_start["player_ids"])}
+        for i, pid in enumerate(data["player_ids"]):
+            if pid in index:
+                probs[i] = warm_start["probs"][index[pid]]
+                inverse_mass_matrix[i] = warm_start["inverse_mass_matrix"][index[pid]]
+        return jnp.array(probs), jnp.array(inverse_mass_matrix.ravel())
+
+    def get_warm_start(self):
+        """
+        Return the state needed to warm start a later fit (player_ids, posterior
+        mean probs, and NUTS step size and inverse mass matrix).
+        """
+        if self.step_size is None:
+            raise RuntimeError("Warm start state is only available after NUTS fit")
+        return {
+            "player_ids": np.asarray(self.player_ids),
+            "probs": np.asarray(self.samples["probs"].mean(axis=0)),
+            "step_size": self.step_size,
+            "inverse_mass_matrix": self.inverse_mass_matrix,
+        }
+
+    def fit_svi(
+        self,
+        data,
+        random_state: int = 42,
+        num_steps: int = 5000,
+        learning_rate: float = 0.01,
+        num_samples: int = 2000,
+        progress_bar: bool = True,
+    ):
+        """
+        Fit the model with stochastic variational inference, using an AutoNormal
+        guide (independent normals on the unconstrained Dirichlet probabilities).
+        This is much faster than fit, at the cost of an approximate posterior.
+        num_samples samples are drawn from the fitted guide so get_probs works the
+        same way as after fit.
+        """
+        self.player_ids = data["player_ids"]
+        self.step_size = None
+        self.inverse_mass_matrix = None
+        guide = AutoNormal(self._model)
+        svi = SVI(self._model, guide, optim.Adam(learning_rate), Trace_ELBO())
+        rng_key, rng_key_sample = random.split(random.PRNGKey(random_state))
+        svi_result = svi.run(
+            rng_key,
+            num_steps,
+            data["nplayer"],
+            data["nmatch"],
+            data["minutes"],
+            data["y"],
+            data["alpha"],
+            progress_bar=progress_bar,
+        )
+        self.samples = guide.sample_posterior(
+            rng_key_sample, svi_result.params, sample_shape=(num_samples,)
+        )
         return self
 
     def get_probs(self):
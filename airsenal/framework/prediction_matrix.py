@@ -0,0 +1,162 @@
+"""
+Dense (players x gameweeks) matrix of the points predictions for a prediction tag,
+so that the optimisers, API and utility functions don't need to query the
+player_prediction table for each player.
+"""
+
+import numpy as np
+from sqlalchemy import func
+
+from airsenal.framework.multiprocessing_utils import attach_arrays, share_arrays
+from airsenal.framework.schema import Fixture, PlayerPrediction, session
+from airsenal.framework.season import CURRENT_SEASON
+
+# matrices already loaded in this process, keyed by (db url, tag, season)
+_matrices = {}
+
+
+class PredictionMatrix(object):
+    """
+    Predicted points for each player (rows) in each gameweek (columns, gameweek 1
+    in column 0) of a season for one prediction tag. Points for fixtures in the
+    same gameweek (double gameweeks) are summed, and players or gameweeks without
+    predictions have zero points.
+    """
+
+    def __init__(self, tag, season, player_ids, points):
+        self.tag = tag
+        self.season = season
+        self.player_ids = np.asarray(player_ids, dtype=np.int32)
+        self.points = np.asarray(points, dtype=np.float32)
+        self.points.setflags(write=False)
+        self.index = {pid: i for i, pid in enumerate(self.player_ids.tolist())}
+
+    @property
+    def max_gameweek(self):
+        return self.points.shape[1]
+
+    @classmethod
+    def from_db(cls, tag, season=CURRENT_SEASON, dbsession=None):
+        """
+        Load the predictions for tag and season with a single query.
+        """
+        if not dbsession:
+            dbsession = session
+        max_gw = (
+            dbsession.query(func.max(Fixture.gameweek))
+            .filter(Fixture.season == season)
+            .scalar()
+        )
+        if max_gw is None:
+            # same default as utils.get_max_gameweek
+            max_gw = 100
+        rows = (
+            dbsession.query(
+                PlayerPrediction.player_id,
+                Fixture.gameweek,
+                func.sum(PlayerPrediction.predicted_points),
+            )
+            .join(Fixture, PlayerPrediction.fixture_id == Fixture.fixture_id)
+            .filter(PlayerPrediction.tag == tag)
+            .filter(Fixture.season == season)
+            .filter(Fixture.gameweek != None)  # noqa: E711
+            .group_by(PlayerPrediction.player_id, Fixture.gameweek)
+            .all()
+        )
+        player_ids = sorted({player_id for player_id, _, _ in rows})
+        index = {pid: i for i, pid in enumerate(player_ids)}
+        points = np.zeros((len(player_ids), max(max_gw, 0)), dtype=np.float32)
+        for player_id, gameweek, gw_points in rows:
+            if 1 <= gameweek <= max_gw:
+                points[index[player_id], gameweek - 1] = gw_points
+        return cls(tag, season, player_ids, points)
+
+    def share(self):
+        """
+        Copy the matrix into shared memory. Returns the SharedMemory block, which
+        the caller must close and unlink when finished with it, and a handle that
+        can be passed to PredictionMatrix.attach in other processes.
+        """
+        shm, description = share_arrays(
+            {"player_ids": self.player_ids, "points": self.points}
+        )
+        return shm, (self.tag, self.season, description)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Create a matrix using the arrays shared by PredictionMatrix.share, without
+        copying them.
+        """
+        tag, season, description = handle
+        shm, arrays = attach_arrays(description)
+        matrix = cls(tag, season, arrays["player_ids"], arrays["points"])
+        # keep the shared memory open for as long as the matrix is used
+        matrix._shm = shm
+        return matrix
+
+    def __contains__(self, player_id):
+        return player_id in self.index
+
+    def get_player_points(self, player_id):
+        """
+        Predicted points for player_id in every gameweek, as a dict
+        {gameweek: points}.
+        """
+        i = self.index.get(player_id)
+        if i is None:
+            return {gw: 0.0 for gw in range(1, self.max_gameweek + 1)}
+        return dict(zip(range(1, self.max_gameweek + 1), self.points[i].tolist()))
+
+    def get_points(self, player_ids, gameweeks):
+        """
+        Total predicted points for each player in player_ids over gameweeks (a
+        single gameweek or a list of gameweeks), as a numpy array.
+        """
+        if isinstance(gameweeks, int):
+            gameweeks = [gameweeks]
+        columns = [gw - 1 for gw in gameweeks if 1 <= gw <= self.max_gameweek]
+        rows = np.array([self.index.get(pid, -1) for pid in player_ids], dtype=int)
+        if len(self.player_ids) == 0:
+            # no predictions for this tag
+            return np.zeros(len(rows))
+        points = self.points[np.maximum(rows, 0)][:, columns].sum(
+            axis=1, dtype=np.float64
+        )
+        points[rows < 0] = 0.0
+        return points
+
+
+def get_prediction_matrix(tag, season=CURRENT_SEASON, dbsession=None):
+    """
+    Get the PredictionMatrix for tag and season, loading it from the database the
+    first time it's needed in this process.
+    """
+    if not dbsession:
+        dbsession = session
+    key = (str(dbsession.bind.url), tag, season)
+    if key not in _matrices:
+        matrix = PredictionMatrix.from_db(tag, season, dbsession)
+        if len(matrix.player_ids) == 0:
+            # don't keep empty results, the predictions may not be written yet
+            return matrix
+        _matrices[key] = matrix
+    return _matrices[key]
+
+
+def set_prediction_matrix(matrix, dbsession=None):
+    """
+    Add an existing matrix (e.g. one loaded in a parent process) to the matrices
+    used in this process.
+    """
+    if not dbsession:
+        dbsession = session
+    _matrices[(str(dbsession.bind.url), matrix.tag, matrix.season)] = matrix
+
+
+def clear_prediction_matrices():
+    """
+    Remove all prediction matrices loaded in this process. Called after predictions
+    are written (see write_predictions), and after each API request.
+    """
+    _matrices.clear()
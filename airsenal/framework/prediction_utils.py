@@ -2,37 +2,40 @@
 Use the BPL models to predict scores for upcoming fixtures.
 """
 
+import hashlib
 import os
 from collections import defaultdict
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from functools import lru_cache
+from math import factorial
 import pandas as pd
 import numpy as np
 
-from scipy.stats import multinomial
+from sqlalchemy import case
 
-from airsenal.framework.schema import PlayerPrediction, PlayerScore, Fixture
+from airsenal.framework.schema import PlayerPrediction, PlayerScore, Fixture, Result
 
+from airsenal import TMPDIR
 from airsenal.framework.player_model import PlayerModel
 
 from airsenal.framework.utils import (
     NEXT_GAMEWEEK,
-    get_fixtures_for_player,
-    get_recent_minutes_for_player,
-    get_max_matches_per_player,
+    get_latest_fixture_tag,
+    get_recent_minutes_for_players,
     get_player,
     get_player_from_api_id,
     list_players,
     fetcher,
     session,
     CURRENT_SEASON,
-    is_future_gameweek,
+    is_future_gameweek_clause,
 )
 
 from airsenal.framework.FPL_scoring_rules import (
     points_for_goal,
     points_for_assist,
     points_for_cs,
-    get_appearance_points,
     saves_for_point,
     points_for_yellow_card,
     points_for_red_card,
@@ -41,96 +44,195 @@ from airsenal.framework.FPL_scoring_rules import (
 np.random.seed(42)
 # consider probabilities of scoring/conceding up to this many goals
 MAX_GOALS = 10
+# where to save player model fits, for warm starting the next fit
+PLAYER_MODEL_STATE_DIR = os.path.join(TMPDIR, "airsenal_player_model")
 
 
-def get_player_history_df(
+def get_player_history_arrays(
     position="all", season=CURRENT_SEASON, gameweek=NEXT_GAMEWEEK, dbsession=session
 ):
     """
-    Query the player_score table to get goals/assists/minutes, and then
-    get the team_goals from the match table.
+    Query the player_score, fixture and result tables (in one query) to get
+    goals/assists/minutes and team_goals for each match played by each player.
     The 'season' argument defined the set of players that will be considered, but
     for those players, all results will be used.
+
+    Returns a dict of player_ids and player_names (sorted by player_id), and
+    (nplayer, nmatch) arrays of match_id, date, goals, assists, minutes and
+    team_goals, padded with zeros for players with fewer than nmatch matches.
     """
+    players = sorted(
+        list_players(
+            position=position, season=season, gameweek=gameweek, dbsession=dbsession
+        ),
+        key=lambda p: p.player_id,
+    )
+    player_ids = np.array([p.player_id for p in players], dtype=int)
+    player_names = np.array([p.name for p in players], dtype=object)
 
-    col_names = [
-        "player_id",
-        "player_name",
-        "match_id",
-        "date",
-        "goals",
-        "assists",
-        "minutes",
-        "team_goals",
-    ]
-    player_data = []
-    players = list_players(
-        position=position, season=season, gameweek=gameweek, dbsession=dbsession
+    team_goals = case(
+        (Fixture.home_team == PlayerScore.opponent, Result.away_score),
+        (Fixture.away_team == PlayerScore.opponent, Result.home_score),
+        else_=-1,
     )
-    max_matches_per_player = get_max_matches_per_player(
-        position, season=season, gameweek=gameweek, dbsession=dbsession
+    rows = (
+        dbsession.query(
+            PlayerScore.player_id,
+            PlayerScore.result_id,
+            Fixture.date,
+            PlayerScore.goals,
+            PlayerScore.assists,
+            PlayerScore.minutes,
+            team_goals,
+        )
+        .join(Fixture, PlayerScore.fixture_id == Fixture.fixture_id)
+        .outerjoin(Result, PlayerScore.result_id == Result.result_id)
+        .filter(PlayerScore.player_id.in_(player_ids.tolist()))
+        .filter(~is_future_gameweek_clause(season, gameweek))
+        .order_by(PlayerScore.id)
+        .all()
     )
-    for counter, player in enumerate(players):
-        print(
-            "Filling history dataframe for {}: {}/{} done".format(
-                player, counter, len(players)
-            )
+    columns = ["match_id", "date", "goals", "assists", "minutes", "team_goals"]
+    if len(rows) == 0:
+        history = {col: np.zeros((len(players), 0), dtype=int) for col in columns}
+        return dict(player_ids=player_ids, player_names=player_names, **history)
+
+    rows = np.array(rows, dtype=object)
+    player_idx = np.searchsorted(player_ids, rows[:, 0].astype(int))
+    # pad to the most matches any player has, including matches without a result
+    nmatch = np.bincount(player_idx, minlength=len(players)).max()
+    has_result = np.array([bool(r) for r in rows[:, 1]])
+    if not has_result.all():
+        print("Couldn't find results for {} matches".format((~has_result).sum()))
+    rows = rows[has_result]
+    player_idx = player_idx[has_result]
+    # position of each match in its player's row of the padded arrays
+    order = np.argsort(player_idx, kind="stable")
+    first_match = np.searchsorted(player_idx[order], player_idx[order])
+    match_idx = np.empty(len(order), dtype=int)
+    match_idx[order] = np.arange(len(order)) - first_match
+
+    history = {}
+    for i, col in enumerate(columns):
+        values = np.zeros(
+            (len(players), nmatch), dtype=object if col == "date" else int
         )
-        results = player.scores
-        row_count = 0
-        for row in results:
-            if is_future_gameweek(
-                row.fixture.season,
-                row.fixture.gameweek,
-                current_season=season,
-                next_gameweek=gameweek,
-            ):
-                continue
-
-            match_id = row.result_id
-            if not match_id:
-                print(" Couldn't find result for {}".format(row.fixture))
-                continue
-            minutes = row.minutes
-            goals = row.goals
-            assists = row.assists
-            # find the match, in order to get team goals
-            match_result = row.result
-            match_date = row.fixture.date
-            if row.fixture.home_team == row.opponent:
-                team_goals = match_result.away_score
-            elif row.fixture.away_team == row.opponent:
-                team_goals = match_result.home_score
-            else:
-                print("Unknown opponent!")
-                team_goals = -1
-            player_data.append(
-                [
-                    player.player_id,
-                    player.name,
-                    match_id,
-                    match_date,
-                    goals,
-                    assists,
-                    minutes,
-                    team_goals,
-                ]
-            )
-            row_count += 1
+        values[player_idx, match_idx] = rows[:, i + 1]
+        history[col] = values
+    return dict(player_ids=player_ids, player_names=player_names, **history)
 
-        # fill blank rows so they are all the same size
-        if row_count < max_matches_per_player:
-            player_data += [[player.player_id, player.name, 0, 0, 0, 0, 0, 0]] * (
-                max_matches_per_player - row_count
-            )
 
-    df = pd.DataFrame(player_data, columns=col_names)
+def get_player_history_df(
+    position="all", season=CURRENT_SEASON, gameweek=NEXT_GAMEWEEK, dbsession=session
+):
+    """
+    Query the player_score table to get goals/assists/minutes, and then
+    get the team_goals from the match table.
+    The 'season' argument defined the set of players that will be considered, but
+    for those players, all results will be used.
+    """
+    history = get_player_history_arrays(
+        position=position, season=season, gameweek=gameweek, dbsession=dbsession
+    )
+    nmatch = history["minutes"].shape[1]
+    df = pd.DataFrame(
+        {
+            "player_id": np.repeat(history["player_ids"], nmatch),
+            "player_name": np.repeat(history["player_names"], nmatch),
+            **{
+                col: history[col].ravel()
+                for col in ["match_id", "date", "goals", "assists", "minutes"]
+            },
+            "team_goals": history["team_goals"].ravel(),
+        }
+    )
     df["date"] = pd.to_datetime(df["date"], errors="coerce")
     df.reset_index(drop=True, inplace=True)
 
     return df
 
 
+@lru_cache(maxsize=None)
+def get_partition_tensor(max_goals=MAX_GOALS):
+    """
+    Partition each number of team goals n = 0..max_goals into all the possible
+    combinations of [n_goals, n_assists, n_neither] for a player, padded so every n
+    has the same number of partitions.
+    Returns a tuple of:
+      - partitions: int array, shape (max_goals + 1, n_partitions, 3)
+      - coefficients: multinomial coefficients n! / (i! j! k!) for each partition,
+        shape (max_goals + 1, n_partitions), zero for padding entries.
+    """
+    n_partitions = (max_goals + 1) * (max_goals + 2) // 2
+    partitions = np.zeros((max_goals + 1, n_partitions, 3), dtype=int)
+    coefficients = np.zeros((max_goals + 1, n_partitions))
+    for n in range(max_goals + 1):
+        k = 0
+        for i in range(n + 1):
+            for j in range(n - i + 1):
+                partitions[n, k] = [i, j, n - i - j]
+                coefficients[n, k] = factorial(n) / (
+                    factorial(i) * factorial(j) * factorial(n - i - j)
+                )
+                k += 1
+    partitions.setflags(write=False)
+    coefficients.setflags(write=False)
+    return partitions, coefficients
+
+
+def get_goal_prob_array(goal_probs, max_goals=MAX_GOALS):
+    """
+    Convert a dict {n_goals: probability} into an array indexed by number of goals,
+    with zero probability for any number of goals not in the dict.
+    """
+    prob_array = np.zeros(max_goals + 1)
+    for ngoals, prob in goal_probs.items():
+        prob_array[ngoals] = prob
+    return prob_array
+
+
+def get_attacking_points_array(
+    position, minutes, team_score_prob, prob_score, prob_assist
+):
+    """
+    Vectorised version of get_attacking_points. position, minutes, prob_score and
+    prob_assist can be scalars or arrays, and are broadcast against each other (e.g.
+    players x fixtures x recent minutes). team_score_prob is an array of the
+    probability of the team scoring 0, 1, 2 ... goals, in the last dimension, with the
+    other dimensions broadcastable against the other arguments.
+    """
+    team_score_prob = np.asarray(team_score_prob, dtype=float)
+    minutes = np.asarray(minutes, dtype=float)
+    position = np.asarray(position)
+    partitions, coefficients = get_partition_tensor(team_score_prob.shape[-1] - 1)
+
+    # compute multinomial probabilities given time spent on pitch
+    pr_score = (minutes / 90.0) * np.asarray(prob_score, dtype=float)
+    pr_assist = (minutes / 90.0) * np.asarray(prob_assist, dtype=float)
+    pr_neither = 1.0 - pr_score - pr_assist
+    # probability of each partition of n team goals, shape (..., n_goals, n_parts)
+    probabilities = (
+        coefficients
+        * pr_score[..., None, None] ** partitions[..., 0]
+        * pr_assist[..., None, None] ** partitions[..., 1]
+        * pr_neither[..., None, None] ** partitions[..., 2]
+    )
+    # points scored for each partition
+    goal_points = np.vectorize(points_for_goal.get, otypes=[float])(position)
+    scores = (
+        goal_points[..., None, None] * partitions[..., 0]
+        + points_for_assist * partitions[..., 1]
+    )
+    # compute the weighted sum of terms like:
+    #   points(ng, na, nn) * p(ng, na, nn | Ng, T) * p(Ng)
+    exp_score_inner = (probabilities * scores).sum(axis=-1)
+    exp_points = (exp_score_inner * team_score_prob).sum(axis=-1)
+
+    # don't bother with GKs as they barely ever get points like this
+    # if no minutes are played, can't score any points
+    return np.where((position == "GK") | (minutes == 0.0), 0.0, exp_points)
+
+
 def get_attacking_points(position, minutes, team_score_prob, player_prob):
     """
     use team-level and player-level models.
@@ -140,40 +242,16 @@ def get_attacking_points(position, minutes, team_score_prob, player_prob):
         # if no minutes are played, can't score any points
         return 0.0
 
-    # compute multinomial probabilities given time spent on pitch
-    pr_score = (minutes / 90.0) * player_prob["prob_score"]
-    pr_assist = (minutes / 90.0) * player_prob["prob_assist"]
-    pr_neither = 1.0 - pr_score - pr_assist
-    multinom_probs = (pr_score, pr_assist, pr_neither)
-
-    def _get_partitions(n):
-        # partition n goals into possible combinations of
-        # [n_goals, n_assists, n_neither]
-        partitions = []
-        for i in range(n + 1):
-            for j in range(n - i + 1):
-                partitions.append([i, j, n - i - j])
-        return partitions
-
-    def _get_partition_score(partition):
-        # calculate the points scored for a given partition
-        return (
-            points_for_goal[position] * partition[0] + points_for_assist * partition[1]
+    max_goals = max(MAX_GOALS, max(team_score_prob.keys()))
+    return float(
+        get_attacking_points_array(
+            position,
+            minutes,
+            get_goal_prob_array(team_score_prob, max_goals),
+            player_prob["prob_score"],
+            player_prob["prob_assist"],
         )
-
-    # compute the weighted sum of terms like:
-    #   points(ng, na, nn) * p(ng, na, nn | Ng, T) * p(Ng)
-    exp_points = 0.0
-    for ngoals, score_n_prob in team_score_prob.items():
-        if ngoals > 0:
-            partitions = _get_partitions(ngoals)
-            probabilities = multinomial.pmf(
-                partitions, n=[ngoals] * len(partitions), p=multinom_probs
-            )
-            scores = map(_get_partition_score, partitions)
-            exp_score_inner = sum(pi * si for pi, si in zip(probabilities, scores))
-            exp_points += exp_score_inner * score_n_prob
-    return exp_points
+    )
 
 
 def get_defending_points(position, minutes, team_concede_prob):
@@ -249,6 +327,45 @@ def get_card_points(player_id, minutes, df_cards):
         return 0
 
 
+def get_defending_points_array(position, minutes, team_concede_prob):
+    """
+    Vectorised version of get_defending_points. position and minutes are arrays
+    that broadcast against team_concede_prob without its last (number of goals
+    conceded) axis.
+    """
+    minutes = np.asarray(minutes, dtype=float)
+    position = np.asarray(position)
+    team_concede_prob = np.asarray(team_concede_prob, dtype=float)
+
+    cs_points = np.vectorize(points_for_cs.get, otypes=[float])(position)
+    defending_points = np.where(
+        minutes >= 60, cs_points * team_concede_prob[..., 0], 0.0
+    )
+    # lose 1 point per 2 goals conceded, weighted by chance player was on pitch
+    ngoals = np.arange(team_concede_prob.shape[-1])
+    exp_half_goals = ((ngoals // 2) * team_concede_prob).sum(axis=-1)
+    defending_points = defending_points - np.where(
+        (position == "DEF") | (position == "GK"), (minutes / 90) * exp_half_goals, 0.0
+    )
+    return np.where((position == "FWD") | (minutes == 0), 0.0, defending_points)
+
+
+def get_appearance_points_array(minutes):
+    """
+    Vectorised version of get_appearance_points.
+    """
+    minutes = np.asarray(minutes)
+    return (minutes > 0).astype(float) + (minutes >= 60)
+
+
+def get_player_values(df, player_ids):
+    """
+    Look up per-player values (e.g. from fit_bonus_points) for an array of
+    player_ids, with zero for players not in df.
+    """
+    return df.reindex(player_ids, fill_value=0.0).to_numpy(dtype=float)
+
+
 def calc_predicted_points_for_player(
     player,
     fixture_goal_probs,
@@ -267,118 +384,232 @@ def calc_predicted_points_for_player(
     Use the team-level model to get the probs of scoring or conceding
     N goals, and player-level model to get the chance of player scoring
     or assisting given that their team scores.
+
+    Returns a list of PlayerPrediction objects, one per fixture.
     """
     if isinstance(player, int):
         player = get_player(player, dbsession=dbsession)
 
+    rows = calc_predicted_points_for_players(
+        [player],
+        fixture_goal_probs,
+        df_player,
+        df_bonus,
+        df_saves,
+        df_cards,
+        season,
+        gw_range=gw_range,
+        fixtures_behind=fixtures_behind,
+        min_fixtures_behind=min_fixtures_behind,
+        dbsession=dbsession,
+    )
+    fixtures = {
+        f.fixture_id: f
+        for f in dbsession.query(Fixture).filter(
+            Fixture.fixture_id.in_([fixture_id for _, fixture_id, _ in rows])
+        )
+    }
     message = "Points prediction for player {}".format(player)
+    predictions = []
+    for _, fixture_id, points in rows:
+        fixture = fixtures[fixture_id]
+        message += "\ngameweek: {} {}\nExpected points: {:.2f}".format(
+            fixture.gameweek, fixture, points
+        )
+        predictions.append(make_prediction(player, fixture, points, tag))
+    print(message)
+    return predictions
+
 
+def calc_predicted_points_for_players(
+    players,
+    fixture_goal_probs,
+    df_player,
+    df_bonus,
+    df_saves,
+    df_cards,
+    season,
+    gw_range=None,
+    fixtures_behind=None,
+    min_fixtures_behind=3,
+    dbsession=session,
+):
+    """
+    Calculate points predictions for a list of players (Player objects or ids) in
+    all their fixtures in gw_range at once. fixture_goal_probs is either the dict
+    from get_goal_probabilities_for_fixtures or the (probs, fixture_index) tuple
+    from get_goal_probability_tensor. The inputs for every player (team,
+    position, recent minutes, injuries, fixture goal probabilities and
+    bonus/save/card points) are first gathered into arrays, then the predictions
+    for all player x fixture pairs are calculated together.
+
+    Returns a list of (player_id, fixture_id, predicted_points) tuples.
+    """
+    if len(players) == 0:
+        return []
+    players = [
+        get_player(p, dbsession=dbsession) if isinstance(p, int) else p for p in players
+    ]
     if not gw_range:
         # by default, go for next three matches
         gw_range = list(
             range(NEXT_GAMEWEEK, min(NEXT_GAMEWEEK + 3, 38))
         )  # don't go beyond gw 38!
-
     if fixtures_behind is None:
         # default to getting recent minutes from the same number of matches we're
         # predicting for
         fixtures_behind = len(gw_range)
-
     fixtures_behind = max(fixtures_behind, min_fixtures_behind)
 
-    team = player.team(
-        season, gw_range[0]
-    )  # assume player stays with same team from first gameweek in range
-    position = player.position(season)
-    fixtures = get_fixtures_for_player(
-        player, season, gw_range=gw_range, dbsession=dbsession
-    )
-    player_prob = (
-        # fitted probability of scoring/assisting for this player
-        # (we don't calculate this for goalkeepers)
-        df_player[position].loc[player.player_id]
-        if position != "GK"
-        else None
-    )
+    # fixtures in gw_range for each team, with one query for all teams
+    fixture_tag = get_latest_fixture_tag(season, dbsession)
+    team_fixtures = defaultdict(list)
+    for fixture in (
+        dbsession.query(Fixture)
+        .filter_by(season=season)
+        .filter_by(tag=fixture_tag)
+        .filter(Fixture.gameweek.in_(gw_range))
+        .order_by(Fixture.gameweek)
+    ):
+        team_fixtures[fixture.home_team].append(fixture)
+        team_fixtures[fixture.away_team].append(fixture)
 
+    # per-player inputs
+    player_ids = np.array([p.player_id for p in players], dtype=int)
+    positions = np.array([p.position(season) for p in players], dtype=object)
     # use same recent_minutes from previous gameweeks for all predictions
-    recent_minutes = get_recent_minutes_for_player(
-        player,
+    player_minutes = get_recent_minutes_for_players(
+        players,
         num_match_to_use=fixtures_behind,
         season=season,
         last_gw=min(gw_range) - 1,
         dbsession=dbsession,
     )
-    if len(recent_minutes) == 0:
-        # e.g. for gameweek 1
-        # this should now be dealt with in get_recent_minutes_for_player, so
-        # throw error if not.
-        # recent_minutes = estimate_minutes_from_prev_season(
-        #    player, season=season, dbsession=session
-        # )
-        raise ValueError("Recent minutes is empty.")
-
-    expected_points = defaultdict(float)  # default value is 0.
-    predictions = []  # list that will hold PlayerPrediction objects
-
-    for fixture in fixtures:
-        gameweek = fixture.gameweek
-        is_home = fixture.home_team == team
-        opponent = fixture.away_team if is_home else fixture.home_team
-        home_or_away = "at home" if is_home else "away"
-        message += "\ngameweek: {} vs {}  {}".format(gameweek, opponent, home_or_away)
-        team_score_prob = fixture_goal_probs[fixture.fixture_id][team]
-        team_concede_prob = fixture_goal_probs[fixture.fixture_id][opponent]
-
-        points = 0.0
-        expected_points[gameweek] = points
-
-        if sum(recent_minutes) == 0:
-            # 'recent_minutes' contains the number of minutes that player played for
-            # in the past few matches. If these are all zero, we will for sure predict
-            # zero points for this player, so we don't need to call all the functions to
-            # calculate appearance points, defending points, attacking points.
-            points = 0.0
-
-        elif player.is_injured_or_suspended(season, gw_range[0], gameweek):
-            # Points for fixture will be zero if suspended or injured
-            points = 0.0
-
-        else:
-            # now loop over recent minutes and average
-            points = 0
-            for mins in recent_minutes:
-                points += (
-                    get_appearance_points(mins)
-                    + get_attacking_points(
-                        position,
-                        mins,
-                        team_score_prob,
-                        player_prob,
-                    )
-                    + get_defending_points(position, mins, team_concede_prob)
-                )
-                if df_bonus is not None:
-                    points += get_bonus_points(player.player_id, mins, df_bonus)
-                if df_cards is not None:
-                    points += get_card_points(player.player_id, mins, df_cards)
-                if df_saves is not None:
-                    points += get_save_points(
-                        position, player.player_id, mins, df_saves
-                    )
-
-            points /= len(recent_minutes)
-
-        # create the PlayerPrediction for this player+fixture
-        if np.isnan(points):
-            raise ValueError(f"nan points for {player} {fixture} {points} {tag}")
-        predictions.append(make_prediction(player, fixture, points, tag))
-        expected_points[gameweek] += points
-        # and return the per-gameweek predictions as a dict
-        message += "\nExpected points: {:.2f}".format(points)
+    recent_minutes = []
+    for player in players:
+        mins = player_minutes[player.player_id]
+        if len(mins) == 0:
+            raise ValueError(f"Recent minutes is empty for {player}.")
+        recent_minutes.append(mins)
+    # pad recent minutes to (n_players, max matches), with a mask for padding
+    n_recent = np.array([len(mins) for mins in recent_minutes])
+    recent_mask = np.arange(n_recent.max())[None, :] < n_recent[:, None]
+    minutes = np.zeros(recent_mask.shape)
+    minutes[recent_mask] = np.concatenate(recent_minutes)
+
+    # fitted probability of scoring/assisting for each player
+    # (we don't calculate this for goalkeepers)
+    prob_score = np.zeros(len(players))
+    prob_assist = np.zeros(len(players))
+    for pos in ["DEF", "MID", "FWD"]:
+        is_pos = positions == pos
+        if is_pos.any():
+            df_pos = df_player[pos].loc[player_ids[is_pos]]
+            prob_score[is_pos] = df_pos["prob_score"]
+            prob_assist[is_pos] = df_pos["prob_assist"]
+
+    # expected bonus, save and card points for each player and recent match
+    other_points = np.zeros(minutes.shape)
+    if df_bonus is not None:
+        other_points += np.where(
+            minutes >= 60,
+            get_player_values(df_bonus[0], player_ids)[:, None],
+            np.where(
+                minutes >= 30, get_player_values(df_bonus[1], player_ids)[:, None], 0
+            ),
+        )
+    if df_cards is not None:
+        other_points += np.where(
+            minutes >= 30, get_player_values(df_cards, player_ids)[:, None], 0
+        )
+    if df_saves is not None:
+        other_points += np.where(
+            (minutes >= 60) & (positions == "GK")[:, None],
+            get_player_values(df_saves, player_ids)[:, None],
+            0,
+        )
 
-    print(message)
-    return predictions
+    # per player x fixture inputs
+    pair_player = []
+    pair_fixture = []
+    pair_home = []
+    unavailable = []
+    for idx, player in enumerate(players):
+        # assume player stays with same team from first gameweek in range
+        team = player.team(season, gw_range[0])
+        for fixture in team_fixtures[team]:
+            pair_player.append(idx)
+            pair_fixture.append(fixture)
+            pair_home.append(fixture.home_team == team)
+            # Points for fixture will be zero if suspended or injured
+            unavailable.append(
+                player.is_injured_or_suspended(season, gw_range[0], fixture.gameweek)
+            )
+    if len(pair_player) == 0:
+        return []
+    pair_player = np.array(pair_player)
+    pair_home = np.array(pair_home)
+    if isinstance(fixture_goal_probs, tuple):
+        # (n_fixtures, home/away, goals) array - select the rows for each pair
+        goal_probs, fixture_index = fixture_goal_probs
+        rows = np.array([fixture_index[f.fixture_id] for f in pair_fixture])
+        score_probs = goal_probs[rows, np.where(pair_home, 0, 1)]
+        concede_probs = goal_probs[rows, np.where(pair_home, 1, 0)]
+        if score_probs.shape[1] < MAX_GOALS + 1:
+            pad = ((0, 0), (0, MAX_GOALS + 1 - score_probs.shape[1]))
+            score_probs = np.pad(score_probs, pad)
+            concede_probs = np.pad(concede_probs, pad)
+    else:
+        score_probs = []
+        concede_probs = []
+        for fixture, is_home in zip(pair_fixture, pair_home):
+            home_probs = fixture_goal_probs[fixture.fixture_id][fixture.home_team]
+            away_probs = fixture_goal_probs[fixture.fixture_id][fixture.away_team]
+            score_probs.append(home_probs if is_home else away_probs)
+            concede_probs.append(away_probs if is_home else home_probs)
+        max_goals = max(
+            MAX_GOALS, max(max(p.keys()) for p in score_probs + concede_probs)
+        )
+        score_probs = np.array([get_goal_prob_array(p, max_goals) for p in score_probs])
+        concede_probs = np.array(
+            [get_goal_prob_array(p, max_goals) for p in concede_probs]
+        )
+    pair_fixture = [f.fixture_id for f in pair_fixture]
+
+    # points for every (player x fixture, recent match) combination
+    pair_positions = positions[pair_player][:, None]
+    pair_minutes = minutes[pair_player]
+    points = (
+        get_appearance_points_array(pair_minutes)
+        + get_attacking_points_array(
+            pair_positions,
+            pair_minutes,
+            score_probs[:, None, :],
+            prob_score[pair_player][:, None],
+            prob_assist[pair_player][:, None],
+        )
+        + get_defending_points_array(
+            pair_positions, pair_minutes, concede_probs[:, None, :]
+        )
+        + other_points[pair_player]
+    )
+    # average over recent matches
+    points = (points * recent_mask[pair_player]).sum(axis=1) / n_recent[pair_player]
+    # If recent minutes are all zero, or the player is injured or suspended, we
+    # predict zero points
+    points[(minutes.sum(axis=1)[pair_player] == 0) | np.array(unavailable)] = 0.0
+
+    if np.isnan(points).any():
+        nan_pair = np.flatnonzero(np.isnan(points))[0]
+        raise ValueError(
+            f"nan points for {players[pair_player[nan_pair]]} "
+            f"fixture {pair_fixture[nan_pair]}"
+        )
+    print(
+        f"Calculated {len(points)} points predictions for {len(players)} players "
+        f"in gameweeks {gw_range}"
+    )
+    return list(zip(player_ids[pair_player].tolist(), pair_fixture, points.tolist()))
 
 
 def calc_predicted_points_for_pos(
@@ -491,57 +722,137 @@ def process_player_data(
     prefix, season=CURRENT_SEASON, gameweek=NEXT_GAMEWEEK, dbsession=session
 ):
     """
-    transform the player dataframe, basically giving a list (for each player)
+    transform the player history, basically giving a list (for each player)
     of lists of minutes (for each match, and a list (for each player) of
     lists of ["goals","assists","neither"] (for each match)
     """
-    df = get_player_history_df(
+    history = get_player_history_arrays(
         prefix, season=season, gameweek=gameweek, dbsession=dbsession
     )
-    df["neither"] = df["team_goals"] - df["goals"] - df["assists"]
-    df.loc[(df["neither"] < 0), ["neither", "team_goals", "goals", "assists"]] = [
-        0.0,
-        0.0,
-        0.0,
-        0.0,
-    ]
-    alpha = get_empirical_bayes_estimates(df)
-    y = df.sort_values("player_id")[["goals", "assists", "neither"]].values.reshape(
-        (
-            df["player_id"].nunique(),
-            df.groupby("player_id").count().iloc[0]["player_name"],
-            3,
-        )
-    )
-
-    minutes = df.sort_values("player_id")["minutes"].values.reshape(
-        (
-            df["player_id"].nunique(),
-            df.groupby("player_id").count().iloc[0]["player_name"],
-        )
+    goals = history["goals"]
+    assists = history["assists"]
+    team_goals = history["team_goals"]
+    neither = team_goals - goals - assists
+    invalid = neither < 0
+    for values in [neither, team_goals, goals, assists]:
+        values[invalid] = 0
+
+    nplayer, nmatch = history["minutes"].shape
+    df_emp = pd.DataFrame(
+        {
+            "player_name": np.repeat(history["player_names"], nmatch),
+            "match_id": history["match_id"].ravel(),
+            "goals": goals.ravel(),
+            "assists": assists.ravel(),
+            "neither": neither.ravel(),
+            "minutes": history["minutes"].ravel(),
+            "team_goals": team_goals.ravel(),
+        }
     )
+    alpha = get_empirical_bayes_estimates(df_emp)
+    y = np.stack([goals, assists, neither], axis=-1)
 
-    nplayer = df["player_id"].nunique()
-    nmatch = df.groupby("player_id").count().iloc[0]["player_name"]
-    player_ids = np.sort(df["player_id"].unique())
     return dict(
-        player_ids=player_ids,
+        player_ids=history["player_ids"],
         nplayer=nplayer,
         nmatch=nmatch,
-        minutes=minutes.astype("int64"),
+        minutes=history["minutes"].astype("int64"),
         y=y.astype("int64"),
         alpha=alpha,
+        season=season,
+        gameweek=gameweek,
     )
 
 
-def fit_player_data(position, season, gameweek, dbsession=session):
+def fit_player_data(position, season, gameweek, dbsession=session, **fit_kwargs):
     """
     fit the data for a particular position (FWD, MID, DEF)
     """
-    model = PlayerModel()
     data = process_player_data(position, season, gameweek, dbsession)
-    print("Fitting player model for", position, "...")
-    fitted_model = model.fit(data)
+    return fit_player_model(position, data, **fit_kwargs)
+
+
+def get_player_model_state_file(
+    position, season, db_url, state_dir=PLAYER_MODEL_STATE_DIR
+):
+    """
+    path of the file used to save the state of the last player model fit for
+    position and season with the database at db_url, for warm starting the next
+    fit
+    """
+    db_hash = hashlib.sha256(str(db_url).encode()).hexdigest()[:16]
+    return os.path.join(
+        state_dir, "player_model_{}_{}_{}.npz".format(db_hash, season, position)
+    )
+
+
+def save_player_model_state(model, state_file, season, gameweek):
+    """
+    save the state of a fitted PlayerModel (see PlayerModel.get_warm_start),
+    along with the season and gameweek it was fitted for
+    """
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    np.savez(state_file, season=season, gameweek=gameweek, **model.get_warm_start())
+
+
+def load_player_model_state(state_file, season, gameweek, max_gameweek_gap=1):
+    """
+    load the player model state saved by save_player_model_state, if it exists
+    and was fitted for the same season up to max_gameweek_gap gameweeks before
+    gameweek (i.e. only a little new data has arrived since). Otherwise return
+    None.
+    """
+    if not os.path.exists(state_file):
+        return None
+    with np.load(state_file) as state:
+        state = dict(state)
+    if str(state["season"]) != season or not (
+        0 <= gameweek - int(state["gameweek"]) <= max_gameweek_gap
+    ):
+        return None
+    return state
+
+
+def fit_player_model(
+    position,
+    data,
+    fit_method="nuts",
+    warm_start_file=None,
+    warm_start_warmup=100,
+    **fit_kwargs,
+):
+    """
+    fit the player model to processed data (from process_player_data) for a
+    particular position, with either NUTS (fit_method="nuts") or SVI
+    (fit_method="svi"), passing fit_kwargs to PlayerModel.fit or
+    PlayerModel.fit_svi.
+    If warm_start_file is given (see get_player_model_state_file), NUTS fits save
+    their final state there, and start from the saved state of the previous fit
+    (with only warm_start_warmup warmup steps) if it was for the previous or same
+    gameweek.
+    """
+    model = PlayerModel()
+    print("Fitting player model for", position, "with", fit_method, "...")
+    if fit_method == "nuts":
+        if warm_start_file is not None:
+            warm_start = load_player_model_state(
+                warm_start_file, data["season"], data["gameweek"]
+            )
+            if warm_start is not None:
+                print("Warm starting from previous fit for", position)
+                fit_kwargs["warm_start"] = warm_start
+                fit_kwargs["num_warmup"] = min(
+                    fit_kwargs.get("num_warmup", warm_start_warmup), warm_start_warmup
+                )
+        fitted_model = model.fit(data, **fit_kwargs)
+        if warm_start_file is not None:
+            save_player_model_state(
+                fitted_model, warm_start_file, data["season"], data["gameweek"]
+            )
+    elif fit_method == "svi":
+        fitted_model = model.fit_svi(data, **fit_kwargs)
+    else:
+        raise ValueError(f"Unknown player model fit_method {fit_method}")
     df = pd.DataFrame(fitted_model.get_probs())
 
     df["pos"] = position
@@ -553,31 +864,99 @@ def fit_player_data(position, season, gameweek, dbsession=session):
     return df
 
 
-def get_all_fitted_player_data(season, gameweek, dbsession=session):
+def get_all_fitted_player_data(
+    season,
+    gameweek,
+    dbsession=session,
+    fit_method="nuts",
+    num_chains=1,
+    chain_method="parallel",
+    fit_concurrently=False,
+    warm_start=False,
+):
+    """
+    fit the player model for each outfield position, with either NUTS
+    (fit_method="nuts", using num_chains and chain_method) or SVI
+    (fit_method="svi"). If fit_concurrently is True the three fits run at the
+    same time in separate processes. If warm_start is True, NUTS fits start from
+    the previous fit's state if it was for the previous or same gameweek.
+    """
+    positions = ["DEF", "MID", "FWD"]
+    if fit_method == "nuts":
+        fit_kwargs = {"num_chains": num_chains, "chain_method": chain_method}
+        quiet_kwargs = {"mcmc_kwargs": {"progress_bar": False}}
+    else:
+        fit_kwargs = {}
+        quiet_kwargs = {"progress_bar": False}
+    # load all the data first, so worker processes don't need the database
+    data = {
+        pos: process_player_data(pos, season, gameweek, dbsession) for pos in positions
+    }
+    # each position's warm start state, kept separately for each database
+    warm_start_files = {
+        pos: get_player_model_state_file(pos, season, dbsession.bind.url)
+        if warm_start and fit_method == "nuts"
+        else None
+        for pos in positions
+    }
     df_positions = {"GK": None}
-    for pos in ["DEF", "MID", "FWD"]:
-        df_positions[pos] = fit_player_data(pos, season, gameweek, dbsession)
+    if fit_concurrently:
+        # numpyro's effect handlers are global, so use processes rather than
+        # threads, and spawn them as jax doesn't support forking
+        with ProcessPoolExecutor(
+            max_workers=len(positions), mp_context=get_context("spawn")
+        ) as executor:
+            futures = {
+                pos: executor.submit(
+                    fit_player_model,
+                    pos,
+                    data[pos],
+                    fit_method=fit_method,
+                    warm_start_file=warm_start_files[pos],
+                    **fit_kwargs,
+                    **quiet_kwargs,
+                )
+                for pos in positions
+            }
+            for pos in positions:
+                df_positions[pos] = futures[pos].result()
+    else:
+        for pos in positions:
+            df_positions[pos] = fit_player_model(
+                pos,
+                data[pos],
+                fit_method=fit_method,
+                warm_start_file=warm_start_files[pos],
+                **fit_kwargs,
+            )
     return df_positions
 
 
-def get_player_scores(
-    season, gameweek, min_minutes=0, max_minutes=90, dbsession=session
-):
-    """Utility function to get player scores rows up to (or the same as) season and
-    gameweek as a dataframe"""
-
+def load_player_scores(season, gameweek, dbsession=session):
+    """Load all player score rows up to (but not including) season and gameweek
+    into a dataframe, with a single query. Pass the result to the bonus, save and
+    card point fits as df_scores so they only read the table once between them.
+    """
     query = (
         dbsession.query(PlayerScore, Fixture.season, Fixture.gameweek)
-        .filter(PlayerScore.minutes >= min_minutes)
-        .filter(PlayerScore.minutes <= max_minutes)
         .join(Fixture)
+        .filter(~is_future_gameweek_clause(season, gameweek))
     )
-    df = pd.read_sql(query.statement, dbsession.bind)
+    return pd.read_sql(query.statement, dbsession.bind)
 
-    is_fut = partial(is_future_gameweek, current_season=season, next_gameweek=gameweek)
-    exclude = df.apply(lambda r: is_fut(r["season"], r["gameweek"]), axis=1)
-    df = df[~exclude]
-    return df
+
+def get_player_scores(
+    season, gameweek, min_minutes=0, max_minutes=90, dbsession=session, df_scores=None
+):
+    """Utility function to get player scores rows up to (or the same as) season and
+    gameweek as a dataframe. The rows are filtered from df_scores (from
+    load_player_scores for the same season and gameweek) if it's given, otherwise
+    they're loaded from the database."""
+    if df_scores is None:
+        df = load_player_scores(season, gameweek, dbsession)
+    else:
+        df = df_scores
+    return df[(df["minutes"] >= min_minutes) & (df["minutes"] <= max_minutes)].copy()
 
 
 def mean_group_min_count(df, group_col, mean_col, min_count=10):
@@ -592,7 +971,11 @@ def mean_group_min_count(df, group_col, mean_col, min_count=10):
 
 
 def fit_bonus_points(
-    gameweek=NEXT_GAMEWEEK, season=CURRENT_SEASON, min_matches=10, dbsession=session
+    gameweek=NEXT_GAMEWEEK,
+    season=CURRENT_SEASON,
+    min_matches=10,
+    dbsession=session,
+    df_scores=None,
 ):
     """Calculate the average bonus points scored by each player for matches they play
     between 60 and 90 minutes, and matches they play between 30 and 59 minutes.
@@ -613,6 +996,7 @@ def fit_bonus_points(
             min_minutes=min_minutes,
             max_minutes=max_minutes,
             dbsession=dbsession,
+            df_scores=df_scores,
         )
         return mean_group_min_count(df, "player_id", "bonus", min_count=min_matches)
 
@@ -628,6 +1012,7 @@ def fit_save_points(
     min_matches=10,
     min_minutes=90,
     dbsession=session,
+    df_scores=None,
 ):
     """Calculate the average save points scored by each goalkeeper for matches they
     played at least min_minutes in.
@@ -637,7 +1022,11 @@ def fit_save_points(
     Returns pandas series index by player ID, values average save points.
     """
     df = get_player_scores(
-        season, gameweek, min_minutes=min_minutes, dbsession=dbsession
+        season,
+        gameweek,
+        min_minutes=min_minutes,
+        dbsession=dbsession,
+        df_scores=df_scores,
     )
 
     goalkeepers = list_players(
@@ -658,6 +1047,7 @@ def fit_card_points(
     min_matches=10,
     min_minutes=1,
     dbsession=session,
+    df_scores=None,
 ):
     """Calculate the average points per match lost to yellow or red cards
     for each player.
@@ -667,7 +1057,11 @@ def fit_card_points(
     Returns pandas series index by player ID, values average card points.
     """
     df = get_player_scores(
-        season, gameweek, min_minutes=min_minutes, dbsession=dbsession
+        season,
+        gameweek,
+        min_minutes=min_minutes,
+        dbsession=dbsession,
+        df_scores=df_scores,
     )
 
     # TODO: different values for different minutes (remember minutes < 90 for red cards
@@ -3,7 +3,8 @@ Interface to the SQL database.
 Use SQLAlchemy to convert between DB tables and python objects.
 """
 import os
-from sqlalchemy import Column, ForeignKey, Integer, String, Float
+from bisect import bisect_left
+from sqlalchemy import Column, ForeignKey, Integer, String, Float, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import sessionmaker
@@ -54,7 +55,8 @@ class Player(Base):
         print("No price found for", self.name, "in", season, "season.")
         return None
 
-    def _calculate_price(self, attr, gameweek):
+    @staticmethod
+    def _calculate_price(attr, gameweek):
         """
         Either return price available for specified gameweek or interpolate based
         on nearest available price.
@@ -107,45 +109,29 @@ class Player(Base):
         If before_and_after is True and an exact gameweek & season match is not found,
         return both the nearest gameweek before and after the specified gameweek.
         """
-        gw_before = 0
-        gw_after = 100
-        attr_before = None
-        attr_after = None
-
-        for attr in self.attributes:
-            if attr.season != season:
-                continue
-
-            if gameweek is None:
-                # trying to match season only
-                return attr
-            elif attr.gameweek == gameweek:
-                return attr
-            elif (attr.gameweek < gameweek) and (attr.gameweek > gw_before):
-                # update last available attr before specified gameweek
-                gw_before = attr.gameweek
-                attr_before = attr
-            elif (attr.gameweek > gameweek) and (attr.gameweek < gw_after):
-                # update next available attr after specified gameweek
-                gw_after = attr.gameweek
-                attr_after = attr
-
-        # ran through all attributes without finding exact gameweek and season match
-        if attr_before is None and attr_after is None:
-            # no attributes for this player in this season
-            return None
-        elif not attr_after:
-            return attr_before
-        elif not attr_before:
-            return attr_after
-        elif before_and_after:
-            return (attr_before, attr_after)
-        else:
-            # return attributes at gameweeek nearest to input gameweek
-            if (gw_after - gameweek) >= (gameweek - gw_before):
-                return attr_before
-            else:
-                return attr_after
+        return find_gameweek_attributes(
+            self._get_attributes_index().get(season), gameweek, before_and_after
+        )
+
+    def _get_attributes_index(self):
+        """Index of this player's attributes used by get_gameweek_attributes, a dict
+        {season: (sorted gameweeks, attributes sorted by gameweek, first attributes
+        for the season)}. Built on first use from the loaded attributes and rebuilt
+        if they are reloaded or changed (see reset_attributes_index).
+        """
+        attributes = self.attributes
+        index = self.__dict__.get("_attributes_index")
+        if index is not None and index[0] is attributes:
+            return index[1]
+
+        seasons = index_attributes_by_season(attributes)
+        self._attributes_index = (attributes, seasons)
+        return seasons
+
+    def reset_attributes_index(self):
+        """Clear the index of this player's attributes, so it's rebuilt next time
+        it's needed."""
+        self.__dict__.pop("_attributes_index", None)
 
     def __str__(self):
         return self.name
@@ -177,6 +163,89 @@ class PlayerAttributes(Base):
         )
 
 
+def index_attributes_by_season(attributes):
+    """Index a player's attributes (PlayerAttributes objects, or any objects with
+    season and gameweek attributes) for find_gameweek_attributes. Returns a dict
+    {season: (sorted gameweeks, attributes sorted by gameweek, first attributes
+    for the season)}.
+    """
+    by_season = {}
+    for attr in attributes:
+        by_season.setdefault(attr.season, []).append(attr)
+    seasons = {}
+    for season, season_attrs in by_season.items():
+        # sort is stable, so the first attributes for each gameweek are kept
+        # first, as when looping over all attributes
+        sorted_attrs = sorted(
+            (a for a in season_attrs if a.gameweek is not None),
+            key=lambda a: a.gameweek,
+        )
+        seasons[season] = (
+            [a.gameweek for a in sorted_attrs],
+            sorted_attrs,
+            season_attrs[0],
+        )
+    return seasons
+
+
+def find_gameweek_attributes(season_index, gameweek, before_and_after=False):
+    """Find the attributes for gameweek in season_index (the entry for one season
+    from index_attributes_by_season, or None), following the rules in
+    Player.get_gameweek_attributes.
+    """
+    if season_index is None:
+        # no attributes for this player in this season
+        return None
+    gameweeks, attributes, first_attr = season_index
+    if gameweek is None:
+        # trying to match season only
+        return first_attr
+
+    i = bisect_left(gameweeks, gameweek)
+    if i < len(gameweeks) and gameweeks[i] == gameweek:
+        return attributes[i]
+    # last available attr before specified gameweek (ignoring gameweeks < 1)
+    attr_before = None
+    if i > 0 and gameweeks[i - 1] > 0:
+        gw_before = gameweeks[i - 1]
+        attr_before = attributes[bisect_left(gameweeks, gw_before)]
+    # next available attr after specified gameweek (ignoring gameweeks >= 100)
+    attr_after = None
+    if i < len(gameweeks) and gameweeks[i] < 100:
+        gw_after = gameweeks[i]
+        attr_after = attributes[i]
+
+    if attr_before is None and attr_after is None:
+        return None
+    elif not attr_after:
+        return attr_before
+    elif not attr_before:
+        return attr_after
+    elif before_and_after:
+        return (attr_before, attr_after)
+    else:
+        # return attributes at gameweeek nearest to input gameweek
+        if (gw_after - gameweek) >= (gameweek - gw_before):
+            return attr_before
+        else:
+            return attr_after
+
+
+@event.listens_for(Player.attributes, "append")
+@event.listens_for(Player.attributes, "remove")
+def _player_attributes_changed(player, attr, initiator):
+    player.reset_attributes_index()
+
+
+@event.listens_for(PlayerAttributes.season, "set")
+@event.listens_for(PlayerAttributes.gameweek, "set")
+def _player_attributes_gameweek_changed(attr, value, oldvalue, initiator):
+    # don't trigger loading the player if it isn't already loaded
+    player = attr.__dict__.get("player")
+    if player is not None:
+        player.reset_attributes_index()
+
+
 class Result(Base):
     __tablename__ = "result"
     result_id = Column(Integer, primary_key=True, autoincrement=True)
@@ -3,10 +3,12 @@ The class for an FPL squad.
 Contains a set of players.
 Is able to check that it obeys all constraints.
 """
+from collections import OrderedDict
+from math import fsum
 from operator import itemgetter
-import numpy as np
 
 from airsenal.framework.player import CandidatePlayer, Player
+from airsenal.framework.player_catalog import get_player_catalog
 from airsenal.framework.utils import get_player, NEXT_GAMEWEEK, CURRENT_SEASON, fetcher
 
 # how many players do we need to add
@@ -25,6 +27,63 @@ FORMATIONS = [
     (5, 3, 2),
 ]
 
+# how many lineups to keep in the cache used by Squad.get_expected_points
+LINEUP_CACHE_SIZE = 20000
+
+# lineups found by Squad.get_expected_points, keyed by (frozenset of player ids,
+# gameweek, tag, bench_boost, triple_captain), least recently used first. Values
+# are (total score, {player_id: (is_starting, sub_position, is_captain,
+# is_vice_captain, points)}).
+_lineup_cache = OrderedDict()
+
+
+def select_formation(points):
+    """
+    Choose the formation for the best starting 11, given points, a dict
+    {position: points for each player in that position in descending order}.
+    The minimum number of players for each outfield position start, and the
+    remaining places go to the highest scoring players left in positions that
+    aren't full. If several formations give the same points the last of them in
+    FORMATIONS is used.
+    Returns the formation (a tuple of the number of starting DEF, MID and FWD), and
+    the points for the outfield players in it.
+    """
+    defs, mids, fwds = points["DEF"], points["MID"], points["FWD"]
+    n_def, n_mid, n_fwd = 3, 3, 1
+    score = defs[0] + defs[1] + defs[2] + mids[0] + mids[1] + mids[2] + fwds[0]
+    tied = False
+    for _ in range(3):
+        # points for the next player in each position, if there's room for them
+        next_def = defs[n_def] if n_def < min(5, len(defs)) else None
+        next_mid = mids[n_mid] if n_mid < min(5, len(mids)) else None
+        next_fwd = fwds[n_fwd] if n_fwd < min(3, len(fwds)) else None
+        best = max(x for x in (next_def, next_mid, next_fwd) if x is not None)
+        if (next_def == best) + (next_mid == best) + (next_fwd == best) > 1:
+            tied = True
+        if next_def == best:
+            n_def += 1
+        elif next_mid == best:
+            n_mid += 1
+        else:
+            n_fwd += 1
+        score += best
+    formation = (n_def, n_mid, n_fwd)
+    if tied:
+        # other formations may have the same points - choose between them as
+        # comparing every formation in order would, using exact sums so the choice
+        # doesn't depend on rounding errors
+        f_scores = [fsum(defs[:d] + mids[:m] + fwds[:f]) for d, m, f in FORMATIONS]
+        best = max(f_scores)
+        formation = FORMATIONS[len(f_scores) - 1 - f_scores[::-1].index(best)]
+    return formation, score
+
+
+def clear_lineup_cache():
+    """
+    Remove all lineups cached by Squad.get_expected_points in this process.
+    """
+    _lineup_cache.clear()
+
 
 class Squad(object):
     """
@@ -184,10 +243,15 @@ class Squad(object):
                 pass
 
         if not price_now:
-            player_db = get_player(player_id, dbsession=dbsession)
-
-            if player_db:
-                price_now = player_db.price(season, gameweek)
+            catalog_data = get_player_catalog(season, gameweek, dbsession).get(
+                player_id
+            )
+            if catalog_data is not None:
+                price_now = catalog_data[3]
+            else:
+                player_db = get_player(player_id, dbsession=dbsession)
+                if player_db:
+                    price_now = player_db.price(season, gameweek)
         if not price_now:
             # if all else fails just use the purchase price as the sale
             # price for this player.
@@ -266,20 +330,15 @@ class Squad(object):
         # always start the first-placed and sub the second-placed keeper
         player_dict["GK"][0][0].is_starting = True
         player_dict["GK"][1][0].is_starting = False
-        best_score = 0.0
-        best_formation = None
-        for f in FORMATIONS:
-            self.apply_formation(player_dict, f)
-            score = self.total_points_for_starting_11(gameweek, tag)
-            if score >= best_score:
-                best_score = score
-                best_formation = f
+        best_formation, best_score = select_formation(
+            {pos: [points for _, points in v] for pos, v in player_dict.items()}
+        )
         if self.verbose:
             print("Best formation is {}".format(best_formation))
         self.apply_formation(player_dict, best_formation)
         self.order_substitutes(gameweek, tag)
 
-        return best_score
+        return best_score + player_dict["GK"][0][1]
 
     def order_substitutes(self, gameweek, tag):
         # order substitutes by expected points (descending)
@@ -292,8 +351,9 @@ class Squad(object):
             except ValueError:
                 points.append(0)
 
-        # sort the players by points (descending)
-        ordered_sub_inds = reversed(np.argsort(points))
+        # sort the players by points (descending). Players with the same points
+        # are in the reverse of their order in the squad.
+        ordered_sub_inds = reversed(sorted(range(len(subs)), key=points.__getitem__))
         for sub_position, sub_ind in enumerate(ordered_sub_inds):
             subs[sub_ind].sub_position = sub_position
 
@@ -356,7 +416,24 @@ class Squad(object):
     ):
         """
         expected points for the starting 11.
+        The best lineup is cached, so a squad with the same players (in any order)
+        is only optimised once for each gameweek, tag and chip.
         """
+        if not self.is_complete():
+            raise RuntimeError("Squad is incomplete")
+        self._calc_expected_points(tag)
+
+        key = (
+            frozenset(p.player_id for p in self.players),
+            gameweek,
+            tag,
+            bench_boost,
+            triple_captain,
+        )
+        cached = _lineup_cache.get(key)
+        if cached is not None and self._apply_cached_lineup(cached[1], gameweek, tag):
+            _lineup_cache.move_to_end(key)
+            return cached[0]
 
         self.optimize_lineup(gameweek, tag)
 
@@ -367,8 +444,43 @@ class Squad(object):
         if bench_boost:
             total_score += self.total_points_for_subs(gameweek, tag)
 
+        _lineup_cache[key] = (
+            total_score,
+            {
+                p.player_id: (
+                    p.is_starting,
+                    p.sub_position,
+                    p.is_captain,
+                    p.is_vice_captain,
+                    p.predicted_points[tag].get(gameweek, 0),
+                )
+                for p in self.players
+            },
+        )
+        if len(_lineup_cache) > LINEUP_CACHE_SIZE:
+            _lineup_cache.popitem(last=False)
+
         return total_score
 
+    def _apply_cached_lineup(self, lineup, gameweek, tag):
+        """
+        Set the starting 11, substitutes and captains from a lineup cached by
+        get_expected_points. Returns False without changing anything if the
+        players' predicted points have changed since the lineup was cached.
+        """
+        for p in self.players:
+            if p.predicted_points[tag].get(gameweek, 0) != lineup[p.player_id][4]:
+                return False
+        for p in self.players:
+            (
+                p.is_starting,
+                p.sub_position,
+                p.is_captain,
+                p.is_vice_captain,
+                _,
+            ) = lineup[p.player_id]
+        return True
+
     def pick_captains(self, gameweek, tag):
         """
         pick the highest two expected points for captain and vice-captain
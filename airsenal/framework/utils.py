@@ -9,7 +9,7 @@ from typing import TypeVar
 import dateparser
 import re
 from pickle import loads, dumps
-from sqlalchemy import or_, case, desc
+from sqlalchemy import or_, and_, case, desc, cast, func, Integer
 
 from airsenal.framework.mappings import alternative_player_names
 from airsenal.framework.data_fetcher import FPLDataFetcher
@@ -24,6 +24,11 @@ from airsenal.framework.schema import (
     session,
 )
 from airsenal.framework.season import CURRENT_SEASON
+from airsenal.framework.prediction_matrix import get_prediction_matrix
+
+# ids of the players returned by list_players for get_predicted_points, keyed by
+# (db url, position, team, season)
+_player_lists = {}
 
 fetcher = FPLDataFetcher()  # in global scope so it can keep cached data
 
@@ -487,6 +492,26 @@ def is_future_gameweek(
     )
 
 
+def is_future_gameweek_clause(
+    current_season=CURRENT_SEASON, next_gameweek=NEXT_GAMEWEEK
+):
+    """SQL expression version of is_future_gameweek, for filtering queries that
+    include the Fixture table"""
+    return or_(
+        and_(
+            Fixture.season == current_season,
+            or_(
+                Fixture.gameweek == None,  # noqa: E711
+                Fixture.gameweek >= next_gameweek,
+            ),
+        ),
+        and_(
+            Fixture.season != current_season,
+            cast(Fixture.season, Integer) > int(current_season),
+        ),
+    )
+
+
 def get_max_matches_per_player(
     position="all", season=CURRENT_SEASON, gameweek=NEXT_GAMEWEEK, dbsession=None
 ):
@@ -494,24 +519,22 @@ def get_max_matches_per_player(
     can be used e.g. in bpl_interface.get_player_history_df
     to help avoid a ragged dataframe.
     """
+    if not dbsession:
+        dbsession = session
     players = list_players(
         position=position, season=season, gameweek=gameweek, dbsession=dbsession
     )
-    max_matches = 0
-    for p in players:
-        num_match = sum(
-            not is_future_gameweek(
-                score.fixture.season,
-                score.fixture.gameweek,
-                current_season=season,
-                next_gameweek=gameweek,
-            )
-            for score in p.scores
-        )
-        if num_match > max_matches:
-            max_matches = num_match
-
-    return max_matches
+    if not players:
+        return 0
+    num_matches = (
+        dbsession.query(func.count(PlayerScore.id))
+        .join(Fixture, PlayerScore.fixture_id == Fixture.fixture_id)
+        .filter(PlayerScore.player_id.in_([p.player_id for p in players]))
+        .filter(~is_future_gameweek_clause(season, gameweek))
+        .group_by(PlayerScore.player_id)
+        .all()
+    )
+    return max((n for n, in num_matches), default=0)
 
 
 def get_player_attributes(
@@ -721,37 +744,48 @@ def get_previous_points_for_same_fixture(player, fixture_id, dbsession=session):
     return previous_points
 
 
-@lru_cache(maxsize=4096)
 def get_predicted_points_for_player(player, tag, season=CURRENT_SEASON, dbsession=None):
     """
-    Query the player prediction table for a given player.
+    Get the predicted points for a given player (Player object, name or id) from
+    the prediction matrix for tag and season.
     Return a dict, keyed by gameweek.
     """
+    if isinstance(player, str):
+        # we want the player id
+        player = get_player(player, dbsession=dbsession)
+    player_id = player if isinstance(player, int) else player.player_id
+    return get_prediction_matrix(tag, season, dbsession).get_player_points(player_id)
+
+
+def _list_players_for_predictions(position, team, season, dbsession=None):
+    """
+    list_players for get_predicted_points. The optimisers call get_predicted_points
+    many times with the same arguments, so the player ids are kept until
+    clear_player_lists is called (e.g. after updating the database), and the players
+    are then loaded in one query.
+    """
     if not dbsession:
         dbsession = session
-    if isinstance(player, (str, int)):
-        # we want the actual player object
-        player = get_player(player, dbsession=dbsession)
-    pps = (
-        dbsession.query(PlayerPrediction)
-        .filter(PlayerPrediction.fixture.has(Fixture.season == season))
-        .filter_by(player_id=player.player_id, tag=tag)
-        .all()
-    )
-    ppdict = {}
-    for prediction in pps:
-        # there is one prediction per fixture.
-        # for double gameweeks, we need to add the two together
-        gameweek = prediction.fixture.gameweek
-        if gameweek not in ppdict.keys():
-            ppdict[gameweek] = 0
-        ppdict[gameweek] += prediction.predicted_points
-    # we still need to fill in zero for gameweeks that they're not playing.
-    max_gw = get_max_gameweek(season, dbsession)
-    for gw in range(1, max_gw + 1):
-        if gw not in ppdict.keys():
-            ppdict[gw] = 0.0
-    return ppdict
+    key = (str(dbsession.bind.url), position, team, season)
+    if key not in _player_lists:
+        _player_lists[key] = [
+            p.player_id
+            for p in list_players(position, team, season=season, dbsession=dbsession)
+        ]
+    player_ids = _player_lists[key]
+    players = {
+        p.player_id: p
+        for p in dbsession.query(Player).filter(Player.player_id.in_(player_ids))
+    }
+    return [players[pid] for pid in player_ids]
+
+
+def clear_player_lists():
+    """
+    Remove the player lists kept by get_predicted_points in this process, e.g.
+    after updating the database.
+    """
+    _player_lists.clear()
 
 
 def get_predicted_points(
@@ -763,32 +797,11 @@ def get_predicted_points(
     "gameweek" argument can either be a single integer for one gameweek, or a
     list of gameweeks, in which case we will get the sum over all of them
     """
-    players = list_players(position, team, season=season, dbsession=dbsession)
-
-    if isinstance(gameweek, int):  # predictions for a single gameweek
-        output_list = [
-            (
-                p,
-                get_predicted_points_for_player(
-                    p, tag=tag, season=season, dbsession=dbsession
-                )[gameweek],
-            )
-            for p in players
-        ]
-    else:  # predictions for a list of gameweeks
-        output_list = [
-            (
-                p,
-                sum(
-                    get_predicted_points_for_player(
-                        p, tag=tag, season=season, dbsession=dbsession
-                    )[gw]
-                    for gw in gameweek
-                ),
-            )
-            for p in players
-        ]
-
+    players = _list_players_for_predictions(position, team, season, dbsession)
+    points = get_prediction_matrix(tag, season, dbsession).get_points(
+        [p.player_id for p in players], gameweek
+    )
+    output_list = list(zip(players, points.tolist()))
     output_list.sort(key=itemgetter(1), reverse=True)
     return output_list
 
@@ -958,6 +971,47 @@ def estimate_minutes_from_prev_season(
     return [average_mins]
 
 
+def estimate_minutes_from_prev_season_for_players(
+    players,
+    season=CURRENT_SEASON,
+    gameweek=NEXT_GAMEWEEK,
+    n_games_to_use=10,
+    dbsession=None,
+):
+    """
+    Batch version of estimate_minutes_from_prev_season for a list of Player
+    objects, using a single query. Returns a dict {player_id: [average minutes]}.
+    """
+    if not dbsession:
+        dbsession = session
+    previous_season = get_previous_season(season)
+    # Only consider minutes the player played with his
+    # current team in the previous season.
+    current_teams = {p.player_id: p.team(season, gameweek) for p in players}
+
+    rows = (
+        dbsession.query(
+            PlayerScore.player_id, PlayerScore.player_team, PlayerScore.minutes
+        )
+        .join(Fixture, PlayerScore.fixture)
+        .filter(Fixture.season == previous_season)
+        .filter(PlayerScore.player_id.in_(list(current_teams.keys())))
+        .order_by(desc(Fixture.gameweek))
+        .all()
+    )
+    prev_minutes = {pid: [] for pid in current_teams}
+    for player_id, team, mins in rows:
+        if team == current_teams[player_id] and (
+            len(prev_minutes[player_id]) < n_games_to_use
+        ):
+            prev_minutes[player_id].append(mins)
+    # If a player didn't play for his current team last season, return 0 minutes
+    return {
+        pid: [sum(mins) / len(mins)] if mins else [0]
+        for pid, mins in prev_minutes.items()
+    }
+
+
 def get_recent_playerscore_rows(
     player, num_match_to_use=3, season=CURRENT_SEASON, last_gw=None, dbsession=None
 ):
@@ -1025,20 +1079,62 @@ def get_recent_minutes_for_player(
     If current_gw is not given, we take it to be the most
     recent finished gameweek.
     """
-    playerscores = get_recent_playerscore_rows(
-        player, num_match_to_use, season, last_gw, dbsession
+    return get_recent_minutes_for_players(
+        [player], num_match_to_use, season, last_gw, dbsession
+    )[player.player_id]
+
+
+def get_recent_minutes_for_players(
+    players, num_match_to_use=3, season=CURRENT_SEASON, last_gw=None, dbsession=None
+):
+    """
+    Batch version of get_recent_minutes_for_player for a list of Player objects,
+    returning a dict {player_id: list of minutes}. Uses one query for the recent
+    matches of all players, and one query for the previous season's minutes of
+    players that need a minutes estimate from last season (see
+    estimate_minutes_from_prev_season).
+    """
+    if not dbsession:
+        dbsession = session
+    player_ids = [p.player_id for p in players]
+    minutes = {pid: [] for pid in player_ids}
+
+    # If asking for gameweeks without results in DB, revert to most recent results.
+    last_available_gameweek = get_last_complete_gameweek_in_db(
+        season=season, dbsession=dbsession
     )
-    minutes = [r.minutes for r in playerscores] if playerscores else []
+    if last_available_gameweek:
+        window_end = last_gw
+        if window_end is None or window_end > last_available_gameweek:
+            window_end = last_available_gameweek
+        rows = (
+            dbsession.query(PlayerScore.player_id, PlayerScore.minutes)
+            .join(Fixture, PlayerScore.fixture)
+            .filter(Fixture.season == season)
+            .filter(Fixture.gameweek > window_end - num_match_to_use)
+            .filter(Fixture.gameweek <= window_end)
+            .filter(PlayerScore.player_id.in_(player_ids))
+            .order_by(PlayerScore.id)
+            .all()
+        )
+        for player_id, mins in rows:
+            minutes[player_id].append(mins)
+        # matches from this season are uploaded in order, so we can just take the
+        # last n rows for each player
+        minutes = {pid: mins[-num_match_to_use:] for pid, mins in minutes.items()}
+
     # if going back num_matches_to_use from last_gw takes us before the start
     # of the season, also include a minutes estimate using last season's data
     if not last_gw:
         last_gw = NEXT_GAMEWEEK
     first_gw = last_gw - num_match_to_use
-    if first_gw < 0 or not minutes:
-        minutes += estimate_minutes_from_prev_season(
-            player, season, dbsession=dbsession
+    estimate_players = [p for p in players if first_gw < 0 or not minutes[p.player_id]]
+    if estimate_players:
+        prev_minutes = estimate_minutes_from_prev_season_for_players(
+            estimate_players, season, dbsession=dbsession
         )
-
+        for pid, mins in prev_minutes.items():
+            minutes[pid] += mins
     return minutes
 
 
@@ -51,7 +51,15 @@ from airsenal.scripts.set_lineup import set_lineup
     is_flag=True,
     help="If set, go ahead and make the transfers via the API.",
 )
-def run_pipeline(num_thread, weeks_ahead, fpl_team_id, clean, apply_transfers):
+@click.option(
+    "--fit_method",
+    type=click.Choice(["nuts", "svi"]),
+    default="nuts",
+    help="Fit the player model with NUTS (slower) or SVI (faster, approximate)",
+)
+def run_pipeline(
+    num_thread, weeks_ahead, fpl_team_id, clean, apply_transfers, fit_method
+):
     """
     Run the full pipeline, from setting up the database and filling
     with players, teams, fixtures, and results (if it didn't already exist),
@@ -82,7 +90,7 @@ def run_pipeline(num_thread, weeks_ahead, fpl_team_id, clean, apply_transfers):
             raise RuntimeError("Problem updating db")
         click.echo("Database update complete..")
         click.echo("Running prediction..")
-        predict_ok = run_prediction(num_thread, weeks_ahead, dbsession)
+        predict_ok = run_prediction(num_thread, weeks_ahead, dbsession, fit_method)
         if not predict_ok:
             raise RuntimeError("Problem running prediction")
         click.echo("Prediction complete..")
@@ -125,7 +133,7 @@ def update_database(fpl_team_id, attr, dbsession):
     return update_db(season, attr, fpl_team_id, dbsession)
 
 
-def run_prediction(num_thread, weeks_ahead, dbsession):
+def run_prediction(num_thread, weeks_ahead, dbsession, fit_method="nuts"):
     """
     Run prediction
     """
@@ -138,6 +146,7 @@ def run_prediction(num_thread, weeks_ahead, dbsession):
         include_bonus=True,
         include_cards=True,
         include_saves=True,
+        fit_method=fit_method,
         dbsession=dbsession,
     )
 
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Compare the runtime and fitted probabilities of the NUTS and SVI fits of the
+player model, by default on the test database.
+Usage:
+python benchmark_player_model.py --season 1819 --gameweek 12
+"""
+import argparse
+import os
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from airsenal.framework.prediction_utils import process_player_data, fit_player_model
+
+TEST_DB_FILE = os.path.join(
+    os.path.dirname(__file__), "..", "tests", "testdata", "testdata_1718_1819.db"
+)
+
+
+def benchmark_position(position, data, num_samples=2000, num_steps=5000):
+    """
+    Fit the player model for one position with both NUTS and SVI, and return
+    the time taken by each and the differences between their mean
+    probabilities.
+    """
+    start = time.time()
+    df_nuts = fit_player_model(
+        position,
+        data,
+        fit_method="nuts",
+        num_samples=num_samples,
+        mcmc_kwargs={"progress_bar": False},
+    )
+    nuts_time = time.time() - start
+
+    start = time.time()
+    df_svi = fit_player_model(
+        position,
+        data,
+        fit_method="svi",
+        num_samples=num_samples,
+        num_steps=num_steps,
+        progress_bar=False,
+    )
+    svi_time = time.time() - start
+
+    cols = ["prob_score", "prob_assist", "prob_neither"]
+    diff = (df_svi[cols] - df_nuts[cols]).abs().values
+    return {
+        "position": position,
+        "nplayer": data["nplayer"],
+        "nuts_time": nuts_time,
+        "svi_time": svi_time,
+        "max_abs_diff": diff.max(),
+        "mean_abs_diff": diff.mean(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark SVI against NUTS for the player model"
+    )
+    parser.add_argument(
+        "--db_file", help="sqlite database file to use", default=TEST_DB_FILE
+    )
+    parser.add_argument(
+        "--season", help="season, in format e.g. '1819'", default="1819"
+    )
+    parser.add_argument(
+        "--gameweek", help="fit to data before this gameweek", type=int, default=12
+    )
+    parser.add_argument(
+        "--num_samples", help="number of posterior samples", type=int, default=2000
+    )
+    parser.add_argument(
+        "--num_steps", help="number of SVI optimisation steps", type=int, default=5000
+    )
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///{}".format(os.path.abspath(args.db_file)))
+    dbsession = sessionmaker(bind=engine, autoflush=False)()
+
+    results = []
+    for position in ["DEF", "MID", "FWD"]:
+        data = process_player_data(position, args.season, args.gameweek, dbsession)
+        results.append(
+            benchmark_position(
+                position, data, num_samples=args.num_samples, num_steps=args.num_steps
+            )
+        )
+
+    print(
+        "{:<4} {:>7} {:>10} {:>9} {:>8} {:>13} {:>14}".format(
+            "pos",
+            "players",
+            "NUTS (s)",
+            "SVI (s)",
+            "speedup",
+            "max abs diff",
+            "mean abs diff",
+        )
+    )
+    for r in results:
+        print(
+            "{:<4} {:>7} {:>10.1f} {:>9.1f} {:>8.1f} {:>13.4f} {:>14.4f}".format(
+                r["position"],
+                r["nplayer"],
+                r["nuts_time"],
+                r["svi_time"],
+                r["nuts_time"] / r["svi_time"],
+                r["max_abs_diff"],
+                r["mean_abs_diff"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
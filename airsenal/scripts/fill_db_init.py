@@ -10,6 +10,8 @@ from airsenal.scripts.fill_fifa_ratings_table import make_fifa_ratings_table
 
 from airsenal.framework.transaction_utils import fill_initial_squad
 from airsenal.framework.schema import session_scope
+from airsenal.framework.player_catalog import clear_player_catalogs
+from airsenal.framework.utils import clear_player_lists
 
 import argparse
 
@@ -36,6 +38,9 @@ def make_init_db(fpl_team_id, dbsession):
     make_playerscore_table(dbsession=dbsession)
 
     fill_initial_squad(fpl_team_id=fpl_team_id, dbsession=dbsession)
+    # players and prices cached before the tables were filled are out of date
+    clear_player_catalogs()
+    clear_player_lists()
 
     print("DONE!")
     return not database_is_empty(dbsession)
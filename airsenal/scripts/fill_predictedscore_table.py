@@ -7,14 +7,19 @@ python fill_predictedscore_table.py --weeks_ahead <nweeks>
 Generates a "tag" string which is stored so it can later be used by team-optimizers to
 get consistent sets of predictions from the database.
 """
+import time
 from uuid import uuid4
 
-from multiprocessing import Process, Queue
+from multiprocessing import Pool
 import argparse
 
+import numpyro
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
 from airsenal.framework.bpl_interface import (
     get_fitted_team_model,
-    get_goal_probabilities_for_fixtures,
+    get_goal_probability_tensor,
 )
 from airsenal.framework.utils import (
     NEXT_GAMEWEEK,
@@ -25,19 +30,25 @@ from airsenal.framework.utils import (
 )
 
 from airsenal.framework.prediction_utils import (
-    calc_predicted_points_for_player,
+    calc_predicted_points_for_players,
     get_all_fitted_player_data,
     fit_bonus_points,
     fit_save_points,
     fit_card_points,
+    load_player_scores,
     MAX_GOALS,
 )
 
-from airsenal.framework.schema import session_scope
+from airsenal.framework.schema import session_scope, PlayerPrediction
+from airsenal.framework.prediction_matrix import clear_prediction_matrices
+from airsenal.framework.db_config import DB_CONNECTION_STRING
+
+# model inputs for the prediction worker processes, set once when each worker starts
+worker_inputs = {}
 
 
-def allocate_predictions(
-    queue,
+def init_prediction_worker(
+    db_url,
     gw_range,
     fixture_goal_probs,
     df_player,
@@ -45,33 +56,69 @@ def allocate_predictions(
     df_saves,
     df_cards,
     season,
-    tag,
-    dbsession,
 ):
     """
-    Take positions off the queue and call function to calculate predictions
+    Set up a prediction worker process. Each worker gets its own database engine
+    and session, rather than sharing the parent process's connection, and
+    receives the fitted model inputs once rather than with every task.
     """
-    while True:
-        player = queue.get()
-        if player == "DONE":
-            print("Finished processing")
-            break
+    engine = create_engine(db_url)
+    worker_inputs.update(
+        {
+            "fixture_goal_probs": fixture_goal_probs,
+            "df_player": df_player,
+            "df_bonus": df_bonus,
+            "df_saves": df_saves,
+            "df_cards": df_cards,
+            "season": season,
+            "gw_range": gw_range,
+            "dbsession": sessionmaker(bind=engine, autoflush=False)(),
+        }
+    )
 
-        predictions = calc_predicted_points_for_player(
-            player,
-            fixture_goal_probs,
-            df_player,
-            df_bonus,
-            df_saves,
-            df_cards,
-            season,
-            gw_range=gw_range,
-            tag=tag,
-            dbsession=dbsession,
+
+def allocate_predictions(player_ids):
+    """
+    Calculate predictions for a list of player ids in a worker process, using the
+    inputs set by init_prediction_worker. Returns the predictions as
+    (player_id, fixture_id, predicted_points) tuples to be written to the database
+    by the parent process.
+    """
+    predictions = calc_predicted_points_for_players(player_ids, **worker_inputs)
+    # don't hold a read transaction open between tasks
+    worker_inputs["dbsession"].rollback()
+    return predictions
+
+
+def write_predictions(predictions, tag, dbsession, batch_size=5000):
+    """
+    Bulk insert (player_id, fixture_id, predicted_points) rows into the
+    player_prediction table, in executemany batches of batch_size rows within a
+    single transaction. Returns the number of rows written.
+    """
+    start = time.time()
+    insert = PlayerPrediction.__table__.insert()
+    rows = [
+        {
+            "player_id": player_id,
+            "fixture_id": fixture_id,
+            "predicted_points": points,
+            "tag": tag,
+        }
+        for player_id, fixture_id, points in predictions
+    ]
+    for i in range(0, len(rows), batch_size):
+        dbsession.execute(insert, rows[i : i + batch_size])  # noqa: E203
+    dbsession.commit()
+    # prediction matrices loaded before these rows were written are out of date
+    clear_prediction_matrices()
+    duration = time.time() - start
+    print(
+        "Wrote {} predictions in {:.2f}s ({:.0f} rows/sec)".format(
+            len(rows), duration, len(rows) / duration if duration > 0 else len(rows)
         )
-        for p in predictions:
-            dbsession.add(p)
-        dbsession.commit()
+    )
+    return len(rows)
 
 
 def calc_all_predicted_points(
@@ -82,85 +129,103 @@ def calc_all_predicted_points(
     include_saves=True,
     num_thread=4,
     tag="",
+    fit_method="nuts",
+    num_chains=1,
+    chain_method="parallel",
+    warm_start=False,
     dbsession=None,
 ):
     """
-    Do the full prediction for players.
+    Do the full prediction for players. The player model is fitted with
+    fit_method ("nuts" or "svi"), num_chains and chain_method are used by NUTS
+    (see PlayerModel.fit), and if num_thread > 1 the fits for each position run
+    concurrently. If warm_start is True, NUTS fits start from the state of the
+    previous fit if it was for the previous (or same) gameweek.
     """
     model_team = get_fitted_team_model(
         season, gameweek=min(gw_range), dbsession=dbsession
     )
     print("Calculating fixture score probabilities...")
     fixtures = get_fixtures_for_gameweek(gw_range, season=season, dbsession=dbsession)
-    fixture_goal_probs = get_goal_probabilities_for_fixtures(
+    fixture_goal_probs = get_goal_probability_tensor(
         fixtures, model_team, max_goals=MAX_GOALS
     )
 
-    df_player = get_all_fitted_player_data(season, gw_range[0])
+    df_player = get_all_fitted_player_data(
+        season,
+        gw_range[0],
+        fit_method=fit_method,
+        num_chains=num_chains,
+        chain_method=chain_method,
+        fit_concurrently=num_thread is not None and num_thread > 1,
+        warm_start=warm_start,
+    )
 
+    # the bonus, save and card fits share one load of the player score table
+    if include_bonus or include_saves or include_cards:
+        df_scores = load_player_scores(season, gw_range[0])
     if include_bonus:
-        df_bonus = fit_bonus_points(gameweek=gw_range[0], season=season)
+        df_bonus = fit_bonus_points(
+            gameweek=gw_range[0], season=season, df_scores=df_scores
+        )
     else:
         df_bonus = None
     if include_saves:
-        df_saves = fit_save_points(gameweek=gw_range[0], season=season)
+        df_saves = fit_save_points(
+            gameweek=gw_range[0], season=season, df_scores=df_scores
+        )
     else:
         df_saves = None
     if include_cards:
-        df_cards = fit_card_points(gameweek=gw_range[0], season=season)
+        df_cards = fit_card_points(
+            gameweek=gw_range[0], season=season, df_scores=df_scores
+        )
     else:
         df_cards = None
 
     players = list_players(season=season, gameweek=gw_range[0], dbsession=dbsession)
 
     if num_thread is not None and num_thread > 1:
-        queue = Queue()
-        procs = []
-        for _ in range(num_thread):
-            processor = Process(
-                target=allocate_predictions,
-                args=(
-                    queue,
-                    gw_range,
-                    fixture_goal_probs,
-                    df_player,
-                    df_bonus,
-                    df_saves,
-                    df_cards,
-                    season,
-                    tag,
-                    dbsession,
-                ),
-            )
-            processor.daemon = True
-            processor.start()
-            procs.append(processor)
-
-        for p in players:
-            queue.put(p.player_id)
-        for _ in range(num_thread):
-            queue.put("DONE")
-
-        for _, p in enumerate(procs):
-            p.join()
-    else:
-        # single threaded
-        for player in players:
-            predictions = calc_predicted_points_for_player(
-                player,
+        db_url = dbsession.bind.url if dbsession else DB_CONNECTION_STRING
+        player_ids = [p.player_id for p in players]
+        # a few chunks per worker to balance the load between them
+        n_chunks = 4 * num_thread
+        chunks = [player_ids[i::n_chunks] for i in range(n_chunks)]
+        # fewer players than chunks leaves some of them empty
+        chunks = [chunk for chunk in chunks if chunk]
+        with Pool(
+            num_thread,
+            initializer=init_prediction_worker,
+            initargs=(
+                db_url,
+                gw_range,
                 fixture_goal_probs,
                 df_player,
                 df_bonus,
                 df_saves,
                 df_cards,
                 season,
-                gw_range=gw_range,
-                tag=tag,
-                dbsession=dbsession,
-            )
-            for p in predictions:
-                dbsession.add(p)
-        dbsession.commit()
+            ),
+        ) as pool:
+            # all database writes happen here, in a single process, as each chunk
+            # of predictions arrives
+            for chunk_predictions in pool.imap_unordered(allocate_predictions, chunks):
+                write_predictions(chunk_predictions, tag, dbsession)
+        print("Finished adding predictions to db")
+    else:
+        # single threaded
+        predictions = calc_predicted_points_for_players(
+            players,
+            fixture_goal_probs,
+            df_player,
+            df_bonus,
+            df_saves,
+            df_cards,
+            season,
+            gw_range=gw_range,
+            dbsession=dbsession,
+        )
+        write_predictions(predictions, tag, dbsession)
         print("Finished adding predictions to db")
 
 
@@ -172,6 +237,10 @@ def make_predictedscore_table(
     include_cards=True,
     include_saves=True,
     tag_prefix=None,
+    fit_method="nuts",
+    num_chains=1,
+    chain_method="parallel",
+    warm_start=False,
     dbsession=None,
 ):
     tag = tag_prefix or ""
@@ -186,6 +255,10 @@ def make_predictedscore_table(
         include_saves=include_saves,
         num_thread=num_thread,
         tag=tag,
+        fit_method=fit_method,
+        num_chains=num_chains,
+        chain_method=chain_method,
+        warm_start=warm_start,
         dbsession=dbsession,
     )
     return tag
@@ -221,6 +294,29 @@ def main():
         help="don't include save points for goalkeepers",
         action="store_true",
     )
+    parser.add_argument(
+        "--fit_method",
+        help="fit the player model with NUTS (slower) or SVI (faster, approximate)",
+        choices=["nuts", "svi"],
+        default="nuts",
+    )
+    parser.add_argument(
+        "--num_chains",
+        help="number of MCMC chains to use when fitting the player model",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--chain_method",
+        help="how to run multiple MCMC chains",
+        choices=["parallel", "sequential", "vectorized"],
+        default="parallel",
+    )
+    parser.add_argument(
+        "--warm_start",
+        help="start the player model fit from the previous gameweek's fit",
+        action="store_true",
+    )
 
     args = parser.parse_args()
     if args.weeks_ahead and (args.gameweek_start or args.gameweek_end):
@@ -241,6 +337,9 @@ def main():
     include_bonus = not args.no_bonus
     include_cards = not args.no_cards
     include_saves = not args.no_saves
+    if args.chain_method == "parallel" and args.num_chains > 1:
+        # run each chain on its own CPU device (must be set before jax is used)
+        numpyro.set_host_device_count(args.num_chains)
 
     with session_scope() as session:
         session.expire_on_commit = False
@@ -252,6 +351,10 @@ def main():
             include_bonus=include_bonus,
             include_cards=include_cards,
             include_saves=include_saves,
+            fit_method=args.fit_method,
+            num_chains=args.num_chains,
+            chain_method=args.chain_method,
+            warm_start=args.warm_start,
             dbsession=session,
         )
 
@@ -43,6 +43,16 @@ from airsenal.framework.optimization_utils import (
     get_discount_factor,
 )
 from airsenal.framework.optimization_transfers import make_best_transfers
+from airsenal.framework.player_catalog import (
+    PlayerCatalog,
+    get_player_catalog,
+    set_player_catalog,
+)
+from airsenal.framework.prediction_matrix import (
+    PredictionMatrix,
+    get_prediction_matrix,
+    set_prediction_matrix,
+)
 from airsenal.framework.utils import (
     CURRENT_SEASON,
     get_player_name,
@@ -70,6 +80,46 @@ def is_finished(final_expected_num):
     return json_count == final_expected_num
 
 
+def share_optimization_data(gameweeks, tag, season=CURRENT_SEASON):
+    """
+    Load the prediction matrix and player catalogs needed to optimise transfers in
+    gameweeks, and copy them into shared memory so the worker processes can use
+    them without each loading or copying them.
+    Returns a list of the SharedMemory blocks, to be closed and unlinked when the
+    optimisation is finished, and the handles to pass to attach_optimization_data
+    (None if shared memory isn't available, in which case forked workers use the
+    copies loaded here).
+    """
+    matrix = get_prediction_matrix(tag, season)
+    catalogs = [get_player_catalog(season, gw) for gw in gameweeks]
+    blocks = []
+    try:
+        matrix_handle = None
+        if len(matrix.player_ids) > 0:
+            shm, matrix_handle = matrix.share()
+            blocks.append(shm)
+        catalog_handles = []
+        for catalog in catalogs:
+            shm, handle = catalog.share()
+            blocks.append(shm)
+            catalog_handles.append(handle)
+    except ModuleNotFoundError:
+        return blocks, None
+    return blocks, (matrix_handle, catalog_handles)
+
+
+def attach_optimization_data(handles):
+    """
+    Use the prediction matrix and player catalogs shared by share_optimization_data
+    in this process.
+    """
+    matrix_handle, catalog_handles = handles
+    if matrix_handle is not None:
+        set_prediction_matrix(PredictionMatrix.attach(matrix_handle))
+    for handle in catalog_handles:
+        set_player_catalog(PlayerCatalog.attach(handle))
+
+
 def optimize(
     queue,
     pid,
@@ -85,12 +135,18 @@ def optimize(
     updater=None,
     resetter=None,
     profile=False,
+    squad_algorithm="genetic",
+    shared_data=None,
 ):
     """
     Queue is the multiprocessing queue,
     pid is the Process that will execute this func,
     gameweeks will be a list of gameweeks to consider,
     season and prediction_tag are hopefully self-explanatory.
+    squad_algorithm is the algorithm used to pick new squads for wildcards and free
+    hits, passed to make_new_squad.
+    shared_data are the handles from share_optimization_data, if the predictions
+    and player catalogs have been put in shared memory.
 
     The rest of the parameters needed for prediction are from the queue.
 
@@ -104,6 +160,9 @@ def optimize(
      strat_id
     )
     """
+    if shared_data is not None:
+        attach_optimization_data(shared_data)
+
     while True:
         if queue.qsize() > 0:
             status = queue.get()
@@ -186,6 +245,7 @@ def optimize(
                 season,
                 num_iterations,
                 (updater, increment, pid),
+                algorithm=squad_algorithm,
             )
 
             points -= calc_points_hit(
@@ -363,6 +423,9 @@ def run_optimization(
     num_iterations=100,
     num_thread=4,
     profile=False,
+    algorithm="tree",
+    time_limit=None,
+    squad_algorithm="genetic",
 ):
     """
     This is the actual main function that sets up the multiprocessing
@@ -371,6 +434,10 @@ def run_optimization(
     The chip-related variables e.g. wildcard_week are -1 if that chip
     is not to be played, 0 for 'play it any week', or the gw in which
     it should be played.
+    With algorithm="milp" the whole strategy is found by solving one mixed-integer
+    linear program instead (see optimization_milp), stopping after time_limit
+    seconds if given. Otherwise squad_algorithm is the algorithm used for
+    wildcards and free hits ("normal", "genetic" or "milp", see make_new_squad).
     """
     if fpl_team_id is None:
         fpl_team_id = fetcher.FPL_TEAM_ID
@@ -390,6 +457,23 @@ def run_optimization(
     # in each gw
     chip_gw_dict = construct_chip_dict(gameweeks, chip_gameweeks)
 
+    if algorithm == "milp":
+        best_strategy, baseline_score = run_milp_optimization(
+            gameweeks,
+            tag,
+            season,
+            fpl_team_id,
+            chip_gw_dict,
+            num_free_transfers,
+            max_total_hit,
+            allow_unused_transfers,
+            max_transfers,
+            time_limit,
+        )
+        output_best_strategy(best_strategy, baseline_score, season, fpl_team_id)
+        shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+        return
+
     # create a queue that we will add nodes to, and some processes to take
     # things off it
     squeue = CustomQueue()
@@ -454,52 +538,110 @@ def run_optimization(
     #  total_score
     #  num_free_transfers
     #  budget
-    for i in range(num_thread):
-        processor = Process(
-            target=optimize,
-            args=(
-                squeue,
-                i,
-                num_expected_outputs,
-                gameweeks,
-                season,
-                tag,
-                chip_gw_dict,
-                max_total_hit,
-                allow_unused_transfers,
-                max_transfers,
-                num_iterations,
-                update_progress,
-                reset_progress,
-                profile,
-            ),
-        )
-        processor.daemon = True
-        processor.start()
-        procs.append(processor)
-    # add starting node to the queue
-    squeue.put((0, num_free_transfers, 0, starting_squad, {}, "starting"))
-
-    for i, p in enumerate(procs):
-        progress_bars[i].close()
-        progress_bars[i] = None
-        p.join()
+    # The predictions and player details they need are shared between them.
+    shared_blocks, shared_data = share_optimization_data(gameweeks, tag, season)
+    try:
+        for i in range(num_thread):
+            processor = Process(
+                target=optimize,
+                args=(
+                    squeue,
+                    i,
+                    num_expected_outputs,
+                    gameweeks,
+                    season,
+                    tag,
+                    chip_gw_dict,
+                    max_total_hit,
+                    allow_unused_transfers,
+                    max_transfers,
+                    num_iterations,
+                    update_progress,
+                    reset_progress,
+                    profile,
+                    squad_algorithm,
+                    shared_data,
+                ),
+            )
+            processor.daemon = True
+            processor.start()
+            procs.append(processor)
+        # add starting node to the queue
+        squeue.put((0, num_free_transfers, 0, starting_squad, {}, "starting"))
+
+        for i, p in enumerate(procs):
+            progress_bars[i].close()
+            progress_bars[i] = None
+            p.join()
+    finally:
+        # release the shared predictions and players even if a worker or the
+        # queue fails, as shared memory blocks outlive this process otherwise
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
 
     # find the best from all the strategies tried
     best_strategy = find_best_strat_from_json(tag)
 
     baseline_score = find_baseline_score_from_json(tag, num_weeks)
-    fill_suggestion_table(baseline_score, best_strategy, season, fpl_team_id)
     for i in range(len(procs)):
         print("\n")
+    output_best_strategy(best_strategy, baseline_score, season, fpl_team_id)
+    shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+    return
+
+
+def output_best_strategy(best_strategy, baseline_score, season, fpl_team_id):
+    """
+    Save the best strategy to the transfer suggestion table and print it.
+    """
+    fill_suggestion_table(baseline_score, best_strategy, season, fpl_team_id)
     print("\n====================================\n")
     print("Strategy for Team ID: {}".format(fpl_team_id))
     print("Baseline score: {}".format(baseline_score))
     print("Best score: {}".format(best_strategy["total_score"]))
     print_strat(best_strategy)
     print_team_for_next_gw(best_strategy, fpl_team_id)
-    shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
-    return
+
+
+def run_milp_optimization(
+    gameweeks,
+    tag,
+    season,
+    fpl_team_id,
+    chip_gw_dict,
+    num_free_transfers,
+    max_total_hit=None,
+    allow_unused_transfers=True,
+    max_transfers=2,
+    time_limit=None,
+):
+    """
+    Find the best strategy with optimization_milp.make_transfer_plan_milp.
+    Returns the strategy, in the same format as the tree search's, and the
+    baseline score of making no transfers.
+    """
+    from airsenal.framework.optimization_milp import make_transfer_plan_milp
+
+    starting_squad = get_starting_squad(fpl_team_id=fpl_team_id)
+    best_strategy = make_transfer_plan_milp(
+        starting_squad,
+        gameweeks,
+        tag,
+        season=season,
+        free_transfers=num_free_transfers,
+        chip_gw_dict=chip_gw_dict,
+        max_total_hit=max_total_hit,
+        allow_unused_transfers=allow_unused_transfers,
+        max_transfers=max_transfers,
+        time_limit=time_limit,
+    )
+    baseline_score = sum(
+        starting_squad.get_expected_points(gw, tag)
+        * get_discount_factor(gameweeks[0], gw)
+        for gw in gameweeks
+    )
+    return best_strategy, baseline_score
 
 
 def construct_chip_dict(gameweeks, chip_gameweeks):
@@ -616,6 +758,25 @@ def main():
         help="For developers: Profile strategy execution time",
         action="store_true",
     )
+    parser.add_argument(
+        "--algorithm",
+        help="tree: search every number of transfers each week, milp: solve a "
+        "mixed-integer linear program for the whole strategy (needs scipy>=1.9)",
+        choices=["tree", "milp"],
+        default="tree",
+    )
+    parser.add_argument(
+        "--time_limit",
+        help="maximum time in seconds for the milp algorithm",
+        type=float,
+    )
+    parser.add_argument(
+        "--squad_algorithm",
+        help="algorithm for choosing new squads for wildcards and free hits with "
+        "the tree algorithm: 'normal', 'genetic' or 'milp' (needs scipy>=1.9)",
+        choices=["normal", "genetic", "milp"],
+        default="genetic",
+    )
     parser.add_argument(
         "--fpl_team_id",
         help="specify fpl team id",
@@ -688,4 +849,7 @@ def main():
             num_iterations,
             num_thread,
             profile,
+            args.algorithm,
+            args.time_limit,
+            args.squad_algorithm,
         )
@@ -8,9 +8,13 @@ from airsenal.framework.schema import session_scope
 from airsenal.scripts.fill_predictedscore_table import make_predictedscore_table
 
 
-def rerun_predictions(season, gw_start, gw_end, weeks_ahead=3, num_thread=4):
+def rerun_predictions(
+    season, gw_start, gw_end, weeks_ahead=3, num_thread=4, warm_start=True
+):
     """
     Run the predictions each week for gw_start to gw_end in chosen season.
+    If warm_start is True, each week's player model fit starts from the previous
+    week's.
     """
     with session_scope() as session:
         for gw in range(gw_start, gw_end + 1):
@@ -23,6 +27,7 @@ def rerun_predictions(season, gw_start, gw_end, weeks_ahead=3, num_thread=4):
                 season=season,
                 num_thread=num_thread,
                 tag_prefix=tag_prefix,
+                warm_start=warm_start,
                 dbsession=session,
             )
 
@@ -48,6 +53,11 @@ def main():
         type=int,
         default=4,
     )
+    parser.add_argument(
+        "--no_warm_start",
+        help="fit the player model from scratch every gameweek",
+        action="store_true",
+    )
     args = parser.parse_args()
 
     rerun_predictions(
@@ -56,4 +66,5 @@ def main():
         args.gameweek_end,
         args.weeks_ahead,
         args.num_thread,
+        not args.no_warm_start,
     )
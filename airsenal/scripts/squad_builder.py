@@ -27,7 +27,7 @@ def main():
     )
     parser.add_argument(
         "--algorithm",
-        help="Which optimization algorithm to use - 'normal' or 'genetic'",
+        help="Which optimization algorithm to use - 'normal', 'genetic' or 'milp'",
         type=str,
         default="genetic",
     )
@@ -53,7 +53,7 @@ def main():
     )
     parser.add_argument(
         "--no_subs",
-        help="Don't include points contribution from substitutes (genetic only)",
+        help="Don't include points contribution from substitutes (genetic/milp only)",
         action="store_true",
     )
     parser.add_argument(
@@ -15,6 +15,7 @@ from airsenal.framework.utils import (
     list_players,
     fetcher,
     get_player,
+    clear_player_lists,
 )
 from airsenal.scripts.fill_player_attributes_table import fill_attributes_table_from_api
 from airsenal.scripts.fill_fixture_table import fill_fixtures_from_api
@@ -22,6 +23,7 @@ from airsenal.scripts.fill_result_table import fill_results_from_api
 from airsenal.scripts.fill_playerscore_table import fill_playerscores_from_api
 from airsenal.framework.transaction_utils import update_squad, count_transactions
 from airsenal.framework.schema import Player, session_scope
+from airsenal.framework.player_catalog import clear_player_catalogs
 
 
 def update_transactions(season, fpl_team_id, dbsession):
@@ -175,6 +177,9 @@ def update_db(season, do_attributes, fpl_team_id, session):
     update_results(season, session)
     # update our squad
     update_transactions(season, fpl_team_id, session)
+    # players, prices and teams cached before the update are out of date
+    clear_player_catalogs()
+    clear_player_lists()
     return True
 
 
@@ -163,3 +163,38 @@ def test_is_injured_or_suspended():
     assert player.is_injured_or_suspended(season, 1, 1) is False
     # gameweek after last available: return status as of last available
     assert player.is_injured_or_suspended(season, 6, 1) is True
+
+
+def test_attributes_index_updated():
+    """
+    Check attributes added to a player, or changed, after the player's attributes
+    have already been queried are used by Player.team().
+    """
+    season = "1920"
+    player = Player()
+    player.player_id = 1
+    player.name = "Test Player"
+    player.attributes = []
+
+    def add_attributes(gw, team):
+        pa = PlayerAttributes()
+        pa.season = season
+        pa.team = team
+        pa.gameweek = gw
+        pa.price = 50
+        pa.position = "MID"
+        pa.player_id = player.player_id
+        player.attributes.append(pa)
+        return pa
+
+    add_attributes(2, "ABC")
+    assert player.team(season, 4) == "ABC"
+    # attributes added for a gameweek nearer to 4
+    pa = add_attributes(5, "XYZ")
+    assert player.team(season, 4) == "XYZ"
+    # gameweek of existing attributes changed
+    pa.gameweek = 7
+    assert player.team(season, 4) == "ABC"
+    # attributes removed
+    player.attributes.remove(pa)
+    assert player.team(season, 7) == "ABC"
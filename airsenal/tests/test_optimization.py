@@ -5,7 +5,21 @@ and checking that the optimizer finds the expected outcome.
 from unittest import mock
 from operator import itemgetter
 
-from airsenal.framework.squad import Squad
+import numpy as np
+import pytest
+
+from airsenal.framework.squad import Squad, _lineup_cache, clear_lineup_cache
+from airsenal.framework.player_catalog import (
+    PlayerCatalog,
+    clear_player_catalogs,
+    set_player_catalog,
+)
+from airsenal.framework.prediction_matrix import (
+    PredictionMatrix,
+    clear_prediction_matrices,
+    set_prediction_matrix,
+)
+from airsenal.framework.season import CURRENT_SEASON
 from airsenal.framework.optimization_utils import (
     get_discount_factor,
     next_week_transfers,
@@ -14,6 +28,8 @@ from airsenal.framework.optimization_utils import (
 from airsenal.framework.optimization_transfers import (
     make_optimum_single_transfer,
     make_optimum_double_transfer,
+    get_squad_points,
+    TransferScorer,
 )
 
 
@@ -91,6 +107,33 @@ def predicted_point_mock_generator(point_dict):
     return mock_get_predicted_points
 
 
+@pytest.fixture
+def dummy_player_data():
+    """
+    Return a function that sets up the player catalog and prediction matrix for a
+    list of DummyPlayers (with their "DUMMY" predicted points from gameweek 1), so
+    the optimisers that use them don't need the database. They are cleared again
+    after the test.
+    """
+
+    def set_dummy_player_data(players):
+        max_gw = max(max(p.predicted_points["DUMMY"]) for p in players)
+        points = [
+            [p.predicted_points["DUMMY"].get(gw, 0) for gw in range(1, max_gw + 1)]
+            for p in players
+        ]
+        set_player_catalog(PlayerCatalog.from_players(players, CURRENT_SEASON, 1))
+        set_prediction_matrix(
+            PredictionMatrix(
+                "DUMMY", CURRENT_SEASON, [p.player_id for p in players], points
+            )
+        )
+
+    yield set_dummy_player_data
+    clear_player_catalogs()
+    clear_prediction_matrices()
+
+
 def test_subs():
     """
     mock squads with some players predicted some points, and
@@ -127,6 +170,34 @@ def test_subs():
     assert t.players[14].is_vice_captain is True
 
 
+def test_lineup_cache():
+    """
+    squads with the same players should re-use the cached lineup, unless the
+    players' predicted points have changed.
+    """
+    clear_lineup_cache()
+    points_dict = {i: {1: i} for i in range(15)}
+    t = generate_dummy_squad(points_dict)
+    ep = t.get_expected_points(1, "DUMMY")
+    assert len(_lineup_cache) == 1
+    starting = [p.is_starting for p in t.players]
+    captain = [p.is_captain for p in t.players]
+    # same players in a different order
+    t2 = generate_dummy_squad(points_dict)
+    t2.players.reverse()
+    for p in t2.players:
+        p.is_starting = True
+    assert t2.get_expected_points(1, "DUMMY") == ep
+    assert len(_lineup_cache) == 1
+    assert [p.is_starting for p in reversed(t2.players)] == starting
+    assert [p.is_captain for p in reversed(t2.players)] == captain
+    # new predictions for the same players
+    t3 = generate_dummy_squad({i: {1: 14 - i} for i in range(15)})
+    assert t3.get_expected_points(1, "DUMMY") != ep
+    assert t3.players[0].is_starting is True
+    clear_lineup_cache()
+
+
 def test_single_transfer():
     """
     mock squad with all players predicted 2 points, and potential transfers
@@ -252,6 +323,386 @@ def test_double_transfer():
                 assert p.is_captain is False
 
 
+def test_double_transfer_no_improvement():
+    """
+    if no pair of transfers scores more points, the squad should be returned
+    without any transfers.
+    """
+    t = generate_dummy_squad({i: {1: 0} for i in range(15)})
+    position_points_dict = {
+        "GK": {0: 0, 1: 0, 100: 0},
+        "DEF": {2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 103: 0},
+        "MID": {7: 0, 8: 0, 9: 0, 10: 0, 11: 0, 108: 0},
+        "FWD": {12: 0, 13: 0, 14: 0, 113: 0},
+    }
+    mock_pred_points = predicted_point_mock_generator(position_points_dict)
+
+    with mock.patch(
+        "airsenal.framework.optimization_transfers.get_predicted_points",
+        side_effect=mock_pred_points,
+    ):
+        new_squad, pid_out, pid_in = make_optimum_double_transfer(t, "DUMMY", [1])
+    assert pid_out == []
+    assert pid_in == []
+    assert [p.player_id for p in new_squad.players] == list(range(15))
+    assert new_squad is not t
+
+
+def test_transfer_scorer():
+    """
+    TransferScorer should give the same points as scoring the new squad in full,
+    with and without chips, and best_points should give an upper bound.
+    """
+    points_dict = {i: {1: i % 4, 2: (i * 7) % 5, 3: (i * 3) % 7} for i in range(15)}
+    t = generate_dummy_squad(points_dict)
+    players_out = [t.players[3], t.players[13]]
+    players_in = [
+        DummyPlayer(103, "DEF", {1: 9, 2: 1, 3: 4}),
+        DummyPlayer(113, "FWD", {1: 0, 2: 8, 3: 6}),
+    ]
+    new_squad = Squad()
+    for p in t.players:
+        if p not in players_out:
+            new_squad.add_player(p)
+    for p in players_in:
+        new_squad.add_player(p)
+
+    for bench_boost_gw, triple_captain_gw in [(None, None), (2, None), (None, 3)]:
+        scorer = TransferScorer(
+            t, "DUMMY", [1, 2, 3], 1, bench_boost_gw, triple_captain_gw
+        )
+        assert scorer.score([], []) == get_squad_points(
+            t, "DUMMY", [1, 2, 3], 1, bench_boost_gw, triple_captain_gw
+        )
+        assert scorer.score(players_out, players_in) == get_squad_points(
+            new_squad, "DUMMY", [1, 2, 3], 1, bench_boost_gw, triple_captain_gw
+        )
+        # replacing players with the best points in each gameweek is an upper bound
+        best_points = scorer.best_points(players_in)
+        assert scorer.score_points(
+            players_out, [(p.position, best_points) for p in players_out]
+        ) >= scorer.score(players_out, players_in)
+
+
+def test_transfer_plan_milp(dummy_player_data):
+    """
+    With one free transfer a week and no hits, the MILP should buy the best new
+    forward in the first gameweek and save the transfer for a midfielder who only
+    scores in the second gameweek.
+    """
+    optimization_milp = pytest.importorskip("airsenal.framework.optimization_milp")
+    t = generate_dummy_squad({i: {1: 1, 2: 1} for i in range(15)})
+    dummy_player_data(
+        list(t.players)
+        + [
+            DummyPlayer(100, "FWD", {1: 10, 2: 10}),
+            DummyPlayer(101, "MID", {1: 0, 2: 5}),
+        ]
+    )
+    strategy = optimization_milp.make_transfer_plan_milp(
+        t, [1, 2], "DUMMY", free_transfers=1, max_total_hit=0
+    )
+    assert strategy["players_in"] == {"1": [100], "2": [101]}
+    assert len(strategy["players_out"]["1"]) == 1
+    assert strategy["chips_played"] == {"1": None, "2": None}
+    # 10 starters with 1 point, plus the new forward as captain, then 9 starters
+    # with 1 point, the forward as captain and the new midfielder
+    discount = get_discount_factor(1, 2)
+    assert strategy["total_score"] == pytest.approx(30 + (9 + 20 + 5) * discount)
+
+
+def test_transfer_plan_milp_hits(dummy_player_data):
+    """
+    The MILP should take a hit for a second transfer if it's worth more than the
+    hit, unless max_total_hit or max_transfers rule it out.
+    """
+    optimization_milp = pytest.importorskip("airsenal.framework.optimization_milp")
+    t = generate_dummy_squad({i: {1: 1} for i in range(15)})
+    dummy_player_data(
+        list(t.players) + [DummyPlayer(pid, "FWD", {1: 20}) for pid in [100, 101, 102]]
+    )
+    # (max_total_hit, max_transfers): (players in, score)
+    expected = {
+        # 1 transfer: 10 starters with 1 point and one captained 20 point forward
+        (0, 2): (1, 50),
+        # 2 transfers, one of them a hit
+        (4, 2): (2, 9 + 20 * 3 - 4),
+        (None, 2): (2, 9 + 20 * 3 - 4),
+        (None, 3): (3, 8 + 20 * 4 - 8),
+    }
+    for (max_total_hit, max_transfers), (n_in, score) in expected.items():
+        strategy = optimization_milp.make_transfer_plan_milp(
+            t,
+            [1],
+            "DUMMY",
+            free_transfers=1,
+            max_total_hit=max_total_hit,
+            max_transfers=max_transfers,
+        )
+        assert len(strategy["players_in"]["1"]) == n_in
+        assert set(strategy["players_in"]["1"]) <= {100, 101, 102}
+        assert strategy["total_score"] == pytest.approx(score)
+
+
+def test_transfer_plan_milp_free_transfer_carried_over(dummy_player_data):
+    """
+    An unused free transfer should carry over to the next gameweek, so the MILP
+    can wait and make two transfers without a hit. Here the forwards in the squad
+    only score in the first gameweek and the new ones only in the second.
+    """
+    optimization_milp = pytest.importorskip("airsenal.framework.optimization_milp")
+    points = {i: {1: 1, 2: 1} for i in range(12)}
+    points.update({i: {1: 10, 2: 0} for i in range(12, 15)})
+    t = generate_dummy_squad(points)
+    dummy_player_data(
+        list(t.players) + [DummyPlayer(pid, "FWD", {1: 0, 2: 10}) for pid in [100, 101]]
+    )
+    for max_total_hit in [0, None]:
+        strategy = optimization_milp.make_transfer_plan_milp(
+            t, [1, 2], "DUMMY", free_transfers=1, max_total_hit=max_total_hit
+        )
+        assert strategy["players_in"] == {"1": [], "2": [100, 101]}
+        # 8 starters with 1 point and 3 forwards with 10 points, one of them
+        # captain, then 9 starters with 1 point and the 2 new forwards
+        assert strategy["total_score"] == pytest.approx(
+            48 + 39 * get_discount_factor(1, 2)
+        )
+
+
+def test_transfer_plan_milp_wildcard(dummy_player_data):
+    """
+    If a wildcard can be played the MILP should use it to replace the whole squad
+    with better players, without any hits.
+    """
+    optimization_milp = pytest.importorskip("airsenal.framework.optimization_milp")
+    t = generate_dummy_squad({i: {1: 1} for i in range(15)})
+    new_players = [
+        DummyPlayer(100 + p.player_id, p.position, {1: 5}) for p in t.players
+    ]
+    dummy_player_data(list(t.players) + new_players)
+    strategy = optimization_milp.make_transfer_plan_milp(
+        t,
+        [1],
+        "DUMMY",
+        free_transfers=1,
+        chip_gw_dict={1: {"chip_to_play": None, "chips_allowed": ["wildcard"]}},
+        max_total_hit=0,
+    )
+    assert strategy["chips_played"] == {"1": "wildcard"}
+    # the whole squad is out and the new one in, with at least the starting 11 new
+    # (substitutes don't score, so some of them might be kept)
+    assert sorted(strategy["players_out"]["1"]) == list(range(15))
+    assert len(strategy["players_in"]["1"]) == 15
+    assert len(set(strategy["players_in"]["1"]) - set(range(15))) >= 11
+    assert strategy["total_score"] == pytest.approx(11 * 5 + 5)
+
+
+def test_transfer_plan_milp_free_hit(dummy_player_data):
+    """
+    A free hit squad should only last one gameweek, and cost at most the sell
+    value of the squad plus the bank.
+    """
+    optimization_milp = pytest.importorskip("airsenal.framework.optimization_milp")
+    t = generate_dummy_squad({i: {1: 1, 2: 1} for i in range(15)})
+    for p in t.players:
+        p.purchase_price = 50
+    t.budget = 0
+    new_players = [
+        DummyPlayer(100 + p.player_id, p.position, {1: 5, 2: 0}) for p in t.players
+    ]
+    # too expensive for the free hit squad, as all the other players cost 50
+    star = DummyPlayer(200, "FWD", {1: 30, 2: 0})
+    for p in new_players:
+        p.purchase_price = 50
+    star.purchase_price = 100
+    dummy_player_data(list(t.players) + new_players + [star])
+    strategy = optimization_milp.make_transfer_plan_milp(
+        t,
+        [1, 2],
+        "DUMMY",
+        free_transfers=1,
+        chip_gw_dict={
+            1: {"chip_to_play": "free_hit", "chips_allowed": []},
+            2: {"chip_to_play": None, "chips_allowed": []},
+        },
+    )
+    assert strategy["chips_played"] == {"1": "free_hit", "2": None}
+    assert len(set(strategy["players_in"]["1"]) - set(range(15))) >= 11
+    assert star.player_id not in strategy["players_in"]["1"]
+    # back to the original squad in the next gameweek, so any transfers then (of
+    # substitutes, which don't change the score) are out of the original squad
+    assert set(strategy["players_out"]["2"]) <= set(range(15))
+    assert strategy["points_per_gw"]["2"] == pytest.approx(
+        12 * get_discount_factor(1, 2)
+    )
+    assert strategy["total_score"] == pytest.approx(
+        11 * 5 + 5 + 12 * get_discount_factor(1, 2)
+    )
+
+
+def test_transfer_plan_milp_bench_boost(dummy_player_data):
+    """
+    The MILP should play the bench boost in the gameweek the substitutes score the
+    most points, adding all their points to the score.
+    """
+    optimization_milp = pytest.importorskip("airsenal.framework.optimization_milp")
+    t = generate_dummy_squad({i: {1: 1, 2: 2} for i in range(15)})
+    dummy_player_data(list(t.players))
+    chips_allowed = {"chip_to_play": None, "chips_allowed": ["bench_boost"]}
+    strategy = optimization_milp.make_transfer_plan_milp(
+        t, [1, 2], "DUMMY", chip_gw_dict={1: chips_allowed, 2: chips_allowed}
+    )
+    assert strategy["chips_played"] == {"1": None, "2": "bench_boost"}
+    assert strategy["total_score"] == pytest.approx(
+        12 + (15 * 2 + 2) * get_discount_factor(1, 2)
+    )
+
+
+def test_transfer_plan_milp_triple_captain(dummy_player_data):
+    """
+    The MILP should play the triple captain in the gameweek the captain scores the
+    most points, and prefer it to the bench boost if it's worth more.
+    """
+    optimization_milp = pytest.importorskip("airsenal.framework.optimization_milp")
+    points = {i: {1: 1, 2: 1} for i in range(14)}
+    points[14] = {1: 10, 2: 5}
+    t = generate_dummy_squad(points)
+    dummy_player_data(list(t.players))
+    chips_allowed = {
+        "chip_to_play": None,
+        "chips_allowed": ["triple_captain", "bench_boost"],
+    }
+    strategy = optimization_milp.make_transfer_plan_milp(
+        t, [1, 2], "DUMMY", chip_gw_dict={1: chips_allowed, 2: chips_allowed}
+    )
+    # bench boost in the second gameweek (4 points) is worth less than the triple
+    # captain in either gameweek, but they can't both be played in one gameweek
+    assert strategy["chips_played"] == {"1": "triple_captain", "2": "bench_boost"}
+    assert strategy["total_score"] == pytest.approx(
+        10 * 1 + 10 * 3 + (14 * 1 + 5 * 2) * get_discount_factor(1, 2)
+    )
+
+
+def test_new_squad_milp(dummy_player_data):
+    """
+    The MILP should pick the best squad it can afford, leaving out an expensive
+    forward who would take the squad over budget.
+    """
+    pytest.importorskip("airsenal.framework.optimization_milp")
+    from airsenal.framework.optimization_squad import make_new_squad
+
+    player_points = {
+        "GK": [6, 2, 1],
+        "DEF": [6, 5, 4, 3, 2, 1],
+        "MID": [6, 5, 4, 3, 2, 1],
+        "FWD": [20, 8, 5, 4, 1],
+    }
+    players = []
+    for pos, pos_points in player_points.items():
+        for pts in pos_points:
+            players.append(DummyPlayer(len(players), pos, {1: pts}))
+            players[-1].purchase_price = 400 if pts == 20 else 50
+    dummy_player_data(players)
+    squad = make_new_squad([1], "DUMMY", budget=800, algorithm="milp")
+    assert squad.is_complete()
+    assert squad.budget >= 0
+    # everyone apart from the worst goalkeeper, the worst defender and midfielder,
+    # and the expensive forward
+    assert sorted(p.player_id for p in squad.players) == [0, 1] + list(
+        range(3, 8)
+    ) + list(range(9, 14)) + [16, 17, 18]
+
+
+def test_new_squad_milp_fallback():
+    """
+    make_new_squad should fall back to the normal algorithm if the MILP module
+    can't be imported, but not hide errors raised while solving the MILP.
+    """
+    pytest.importorskip("airsenal.framework.optimization_milp")
+    from airsenal.framework import optimization_squad
+
+    with mock.patch.object(
+        optimization_squad, "make_new_squad_iter", return_value="iter_squad"
+    ):
+        with mock.patch.dict(
+            "sys.modules", {"airsenal.framework.optimization_milp": None}
+        ):
+            assert (
+                optimization_squad.make_new_squad([1], "DUMMY", algorithm="milp")
+                == "iter_squad"
+            )
+        with mock.patch(
+            "airsenal.framework.optimization_milp.make_new_squad_milp",
+            side_effect=ModuleNotFoundError("raised by the solver"),
+        ):
+            with pytest.raises(ModuleNotFoundError, match="raised by the solver"):
+                optimization_squad.make_new_squad([1], "DUMMY", algorithm="milp")
+
+
+def test_squad_opt_batch_fitness(dummy_player_data):
+    """
+    The fitness of squads scored together with SquadOpt.batch_fitness should be
+    the same as scoring each of them with a Squad, and zero for invalid squads.
+    """
+    optimization_pygmo = pytest.importorskip("airsenal.framework.optimization_pygmo")
+    n_per_position = {"GK": 3, "DEF": 7, "MID": 7, "FWD": 4}
+    rng = np.random.default_rng(42)
+    players = []
+    for pos, n in n_per_position.items():
+        for _ in range(n):
+            pts = rng.integers(0, 10, size=2)
+            players.append(
+                DummyPlayer(len(players), pos, {1: float(pts[0]), 2: float(pts[1])})
+            )
+            players[-1].purchase_price = 60
+    # four players in the same team
+    for p in players[3:5] + players[10:12]:
+        p.team = "SAME_TEAM"
+    dummy_player_data(players)
+    db_players = [mock.Mock(player_id=p.player_id) for p in players]
+
+    def mock_list_players(position, season, gameweek):
+        return [db_players[p.player_id] for p in players if p.position == position]
+
+    squads = [
+        list(range(2)) + list(range(5, 10)) + list(range(12, 17)) + list(range(17, 20)),
+        [1, 2] + list(range(5, 10)) + list(range(12, 17)) + [17, 18, 20],
+        [0, 0] + list(range(5, 10)) + list(range(12, 17)) + [17, 18, 20],  # duplicate
+        [0, 1] + list(range(3, 8)) + list(range(10, 15)) + [17, 18, 19],  # 4 per team
+    ]
+    with mock.patch(
+        "airsenal.framework.optimization_pygmo.list_players",
+        side_effect=mock_list_players,
+    ):
+        for chips in [{}, {"bench_boost_gw": 2, "triple_captain_gw": 1}]:
+            opt = optimization_pygmo.SquadOpt(
+                [1, 2], "DUMMY", budget=900, remove_zero=False, **chips
+            )
+            fitness = opt.batch_fitness(np.array(squads, dtype=float).ravel())
+            for squad_idx, f in zip(squads[:2], fitness):
+                squad = Squad(budget=900)
+                for i in squad_idx:
+                    assert squad.add_player(players[i])
+                expected = 0.0
+                for gw, weight in zip([1, 2], opt.gw_weight):
+                    expected += weight * squad.get_expected_points(
+                        gw,
+                        "DUMMY",
+                        bench_boost=gw == chips.get("bench_boost_gw"),
+                        triple_captain=gw == chips.get("triple_captain_gw"),
+                    )
+                    if gw != chips.get("bench_boost_gw"):
+                        expected += weight * squad.total_points_for_subs(
+                            gw, "DUMMY", sub_weights=opt.sub_weights
+                        )
+                assert f == pytest.approx(-expected)
+            assert list(fitness[2:]) == [0, 0]
+            assert opt.fitness(squads[0]) == [fitness[0]]
+            # over budget
+            opt.budget = 800
+            assert opt.fitness(squads[0]) == [0]
+
+
 def test_get_discount_factor():
     """
     Discount factor discounts future gameweek score predictions based on the
@@ -2,7 +2,14 @@
 test the score-calculating functions
 """
 
+import os
+from collections import namedtuple
+from unittest import mock
+
+import numpy as np
 import pandas as pd
+import pytest
+from scipy.stats import multinomial, poisson
 
 import bpl
 
@@ -10,8 +17,15 @@ from airsenal.framework.FPL_scoring_rules import get_appearance_points
 from airsenal.framework.prediction_utils import (
     get_defending_points,
     get_attacking_points,
+    get_attacking_points_array,
+    get_defending_points_array,
+    get_appearance_points_array,
+    get_partition_tensor,
     get_player_history_df,
     fit_player_data,
+    fit_player_model,
+    process_player_data,
+    get_player_model_state_file,
     get_bonus_points,
     get_save_points,
     get_card_points,
@@ -19,7 +33,11 @@ from airsenal.framework.prediction_utils import (
     fit_card_points,
     fit_save_points,
     get_player_scores,
+    load_player_scores,
+    calc_predicted_points_for_players,
     mean_group_min_count,
+    save_player_model_state,
+    load_player_model_state,
 )
 from airsenal.framework.player_model import PlayerModel
 
@@ -28,10 +46,16 @@ from airsenal.framework.bpl_interface import (
     get_ratings_dict,
     get_fitted_team_model,
     fixture_probabilities,
+    get_training_data_hash,
+    load_cached_team_model,
+    save_cached_team_model,
+    get_goal_probability_tensor,
+    get_goal_probabilities_dict,
 )
 
-from airsenal.conftest import test_past_data_session_scope
-from airsenal.framework.schema import Result, Fixture
+from airsenal.conftest import test_past_data_session_scope, test_session_scope
+from airsenal.framework.schema import Result, Fixture, PlayerPrediction
+from airsenal.scripts.fill_predictedscore_table import write_predictions
 
 
 def generate_player_df(prob_score, prob_assist):
@@ -145,6 +169,101 @@ def test_attacking_points_1_0_top_assister():
     assert get_attacking_points("GK", 45, team_score_prob, player_probs) == 0
 
 
+def reference_attacking_points(position, minutes, team_score_prob, player_prob):
+    """
+    Expected attacking points evaluated partition by partition with scipy, to
+    compare the vectorised implementation against.
+    """
+    if position == "GK" or minutes == 0.0:
+        return 0.0
+    pr_score = (minutes / 90.0) * player_prob["prob_score"]
+    pr_assist = (minutes / 90.0) * player_prob["prob_assist"]
+    probs = (pr_score, pr_assist, 1.0 - pr_score - pr_assist)
+    goal_points = {"DEF": 6, "MID": 5, "FWD": 4}[position]
+    exp_points = 0.0
+    for ngoals, score_n_prob in team_score_prob.items():
+        if ngoals > 0:
+            for i in range(ngoals + 1):
+                for j in range(ngoals - i + 1):
+                    pmf = multinomial.pmf([i, j, ngoals - i - j], n=ngoals, p=probs)
+                    exp_points += (goal_points * i + 3 * j) * pmf * score_n_prob
+    return exp_points
+
+
+def test_partition_tensor():
+    """
+    Each number of goals should be partitioned into every combination of goals,
+    assists and neither, with multinomial coefficients summing to 3^n.
+    """
+    partitions, coefficients = get_partition_tensor(4)
+    assert partitions.shape == (5, 15, 3)
+    for n in range(5):
+        valid = coefficients[n] > 0
+        assert valid.sum() == (n + 1) * (n + 2) // 2
+        assert (partitions[n][valid].sum(axis=1) == n).all()
+        assert coefficients[n].sum() == 3**n
+
+
+def test_attacking_points_array_matches_reference():
+    """
+    The vectorised attacking points for arrays of players x fixtures x minutes
+    should match evaluating each combination separately.
+    """
+    rng = np.random.RandomState(42)
+    positions = np.array(["GK", "DEF", "MID", "FWD"])
+    prob_score = rng.uniform(0, 0.5, size=4)
+    prob_assist = rng.uniform(0, 0.5, size=4)
+    minutes = np.array([0, 30, 60, 90])
+    team_score_prob = rng.dirichlet(np.ones(11), size=3)  # 3 fixtures
+
+    points = get_attacking_points_array(
+        positions[:, None, None],
+        minutes[None, None, :],
+        team_score_prob[None, :, None, :],
+        prob_score[:, None, None],
+        prob_assist[:, None, None],
+    )
+    assert points.shape == (4, 3, 4)
+    for i, pos in enumerate(positions):
+        player_prob = {"prob_score": prob_score[i], "prob_assist": prob_assist[i]}
+        for j in range(3):
+            score_prob = dict(enumerate(team_score_prob[j]))
+            for k, mins in enumerate(minutes):
+                expected = reference_attacking_points(
+                    pos, mins, score_prob, player_prob
+                )
+                assert points[i, j, k] == pytest.approx(expected, rel=1e-12, abs=1e-15)
+                assert get_attacking_points(
+                    pos, mins, score_prob, player_prob
+                ) == pytest.approx(expected, rel=1e-12, abs=1e-15)
+
+
+def test_defending_and_appearance_points_arrays():
+    """
+    The vectorised defending and appearance points should match the scalar
+    functions for every position and number of minutes.
+    """
+    rng = np.random.RandomState(42)
+    positions = np.array(["GK", "DEF", "MID", "FWD"])
+    minutes = np.array([0, 1, 30, 59, 60, 90])
+    team_concede_prob = rng.dirichlet(np.ones(11), size=3)  # 3 fixtures
+
+    defending = get_defending_points_array(
+        positions[:, None, None],
+        minutes[None, None, :],
+        team_concede_prob[None, :, None, :],
+    )
+    appearance = get_appearance_points_array(minutes)
+    for k, mins in enumerate(minutes):
+        assert appearance[k] == get_appearance_points(mins)
+        for i, pos in enumerate(positions):
+            for j in range(3):
+                concede_prob = dict(enumerate(team_concede_prob[j]))
+                assert defending[i, j, k] == pytest.approx(
+                    get_defending_points(pos, mins, concede_prob), abs=1e-12
+                )
+
+
 def test_get_bonus_points():
     """Test correct bonus points returned for players from fitted (average) bonus"""
     df_90 = pd.Series({1: 1, 2: 2})
@@ -223,6 +342,18 @@ def test_get_fitted_player_model():
         assert len(fpm) > 0
 
 
+def test_get_fitted_player_model_svi():
+    with test_past_data_session_scope() as ts:
+        fpm = fit_player_data(
+            "FWD", "1819", 12, ts, fit_method="svi", num_steps=500, num_samples=100
+        )
+        assert isinstance(fpm, pd.DataFrame)
+        assert len(fpm) > 0
+        probs = fpm[["prob_score", "prob_assist", "prob_neither"]]
+        assert (probs >= 0).all().all()
+        assert np.allclose(probs.sum(axis=1), 1)
+
+
 def test_get_result_dict():
     with test_past_data_session_scope() as ts:
         d = get_result_dict("1819", 10, ts)
@@ -247,6 +378,82 @@ def test_get_fitted_team_model():
         )
 
 
+def test_team_model_cache(tmp_path):
+    """
+    Cached team models should be keyed by the training data, and only the most
+    recently used models should be kept.
+    """
+    training_data = {
+        "home_team": np.array(["ARS", "CHE"]),
+        "away_team": np.array(["CHE", "ARS"]),
+        "home_goals": np.array([2, 1]),
+        "away_goals": np.array([0, 1]),
+        "team_covariates": {
+            "ARS": np.array([80, 80, 80, 80]),
+            "CHE": np.array([81, 81, 81, 81]),
+        },
+    }
+    key = get_training_data_hash(training_data)
+    assert get_training_data_hash(dict(training_data)) == key
+    new_result = dict(training_data, home_goals=np.array([2, 2]))
+    assert get_training_data_hash(new_result) != key
+    new_ratings = dict(
+        training_data,
+        team_covariates=dict(training_data["team_covariates"], CHE=np.zeros(4)),
+    )
+    assert get_training_data_hash(new_ratings) != key
+
+    cache_dir = str(tmp_path)
+    assert load_cached_team_model(key, cache_dir) is None
+    for i in range(4):
+        save_cached_team_model({"model": i}, str(i), cache_dir, max_size=3)
+        # make sure modification times are distinct
+        os.utime(os.path.join(cache_dir, "team_model_{}.pkl".format(i)), (i + 1, i + 1))
+    assert load_cached_team_model("0", cache_dir) is None
+    assert load_cached_team_model("1", cache_dir) == {"model": 1}
+    # "1" was just used so "2" is evicted next
+    save_cached_team_model({"model": 4}, "4", cache_dir, max_size=3)
+    assert load_cached_team_model("1", cache_dir) == {"model": 1}
+    assert load_cached_team_model("2", cache_dir) is None
+
+
+def test_goal_probability_tensor():
+    """
+    Goal probabilities for all fixtures should be calculated from one call to the
+    team model, and match the marginal probabilities for each team.
+    """
+
+    class PoissonTeamModel:
+        rates = {"ARS": 2.0, "CHE": 1.5, "LIV": 1.0, "MUN": 0.5}
+        n_calls = 0
+
+        def predict_score_proba(self, home_team, away_team, home_goals, away_goals):
+            self.n_calls += 1
+            home_rate = np.array([self.rates[t] for t in home_team])
+            away_rate = np.array([self.rates[t] for t in away_team])
+            return poisson.pmf(home_goals, home_rate) * poisson.pmf(
+                away_goals, away_rate
+            )
+
+    FakeFixture = namedtuple("FakeFixture", ["fixture_id", "home_team", "away_team"])
+    fixtures = [FakeFixture(10, "ARS", "CHE"), FakeFixture(11, "MUN", "LIV")]
+    model = PoissonTeamModel()
+    probs, fixture_index = get_goal_probability_tensor(fixtures, model, max_goals=8)
+    assert model.n_calls == 1
+    assert probs.shape == (2, 2, 9)
+    assert fixture_index == {10: 0, 11: 1}
+    goals = np.arange(9)
+    for f in fixtures:
+        for i, team in enumerate([f.home_team, f.away_team]):
+            expected = poisson.pmf(goals, model.rates[team])
+            assert probs[fixture_index[f.fixture_id], i] == pytest.approx(
+                expected, abs=1e-4
+            )
+    probs_dict = get_goal_probabilities_dict(fixtures, probs, fixture_index)
+    assert set(probs_dict[11].keys()) == {"MUN", "LIV"}
+    assert probs_dict[11]["LIV"][2] == probs[1, 1, 2]
+
+
 def test_fixture_probabilities():
     with test_past_data_session_scope() as ts:
         df = fixture_probabilities(20, "1819", dbsession=ts)
@@ -285,6 +492,12 @@ def test_get_player_scores():
         df = get_player_scores(season="1819", gameweek=12, max_minutes=10, dbsession=ts)
         assert len(df) > 0
         assert all(df["minutes"] <= 10)
+        # filtering rows that were already loaded gives the same result
+        df_scores = load_player_scores(season="1819", gameweek=12, dbsession=ts)
+        df_loaded = get_player_scores(
+            season="1819", gameweek=12, max_minutes=10, df_scores=df_scores
+        )
+        pd.testing.assert_frame_equal(df_loaded, df)
 
 
 def test_mean_group_min_count():
@@ -326,3 +539,93 @@ def test_fit_cards():
         assert len(df_cards) > 0
         assert all(df_cards <= 0)
         assert all(df_cards >= -3)
+
+
+def test_calc_predicted_points_no_players():
+    """
+    With no players there are no predictions to make.
+    """
+    with test_session_scope() as ts:
+        assert (
+            calc_predicted_points_for_players(
+                [], {}, None, None, None, None, "1819", gw_range=[1], dbsession=ts
+            )
+            == []
+        )
+
+
+def test_write_predictions():
+    """
+    Predictions given as (player_id, fixture_id, points) tuples should all be
+    written to the player_prediction table with the given tag.
+    """
+    predictions = [(pid, fid, 0.5 * pid) for pid in range(1, 51) for fid in [1, 2]]
+    with test_session_scope() as ts:
+        n_rows = write_predictions(predictions, "TESTWRITE", ts, batch_size=30)
+        assert n_rows == 100
+        rows = ts.query(PlayerPrediction).filter_by(tag="TESTWRITE").all()
+        assert len(rows) == 100
+        assert sorted(
+            (r.player_id, r.fixture_id, r.predicted_points) for r in rows
+        ) == (sorted(predictions))
+        ts.query(PlayerPrediction).filter_by(tag="TESTWRITE").delete()
+
+
+def test_player_model_warm_start_state(tmp_path):
+    """
+    Saved player model states should only be loaded for the same season, and
+    the same or previous gameweek.
+    """
+
+    class FittedModel:
+        def get_warm_start(self):
+            return {
+                "player_ids": np.array([1, 2]),
+                "probs": np.array([[0.2, 0.3, 0.5], [0.1, 0.1, 0.8]]),
+                "step_size": 0.1,
+                "inverse_mass_matrix": np.ones((2, 2)),
+            }
+
+    state_file = str(tmp_path / "player_model_FWD.npz")
+    assert load_player_model_state(state_file, "1819", 10) is None
+    save_player_model_state(FittedModel(), state_file, "1819", 10)
+    state = load_player_model_state(state_file, "1819", 11)
+    assert state is not None
+    assert np.allclose(state["probs"], FittedModel().get_warm_start()["probs"])
+    assert load_player_model_state(state_file, "1819", 10) is not None
+    assert load_player_model_state(state_file, "1819", 12) is None
+    assert load_player_model_state(state_file, "1819", 9) is None
+    assert load_player_model_state(state_file, "1920", 11) is None
+
+
+def test_player_model_warm_start_fit(tmp_path):
+    """
+    A NUTS fit should save its state, and the next fit for the same position,
+    season and database should start from it with fewer warmup steps.
+    """
+    with test_past_data_session_scope() as ts:
+        data = process_player_data("FWD", "1819", 12, ts)
+        state_file = get_player_model_state_file(
+            "FWD", "1819", ts.bind.url, state_dir=str(tmp_path)
+        )
+    assert state_file != get_player_model_state_file(
+        "FWD", "1920", ts.bind.url, state_dir=str(tmp_path)
+    )
+    assert state_file != get_player_model_state_file(
+        "FWD", "1819", "sqlite:///other.db", state_dir=str(tmp_path)
+    )
+    fit_kwargs = {"num_warmup": 20, "num_samples": 20}
+    with mock.patch.object(
+        PlayerModel, "fit", autospec=True, side_effect=PlayerModel.fit
+    ) as fit:
+        fit_player_model("FWD", data, warm_start_file=state_file, **fit_kwargs)
+        assert os.path.exists(state_file)
+        assert fit.call_args[1].get("warm_start") is None
+        df = fit_player_model(
+            "FWD", data, warm_start_file=state_file, warm_start_warmup=5, **fit_kwargs
+        )
+        assert fit.call_args[1]["warm_start"] is not None
+        assert fit.call_args[1]["num_warmup"] == 5
+    assert len(df) == data["nplayer"]
+    probs = df[["prob_score", "prob_assist", "prob_neither"]]
+    assert np.allclose(probs.sum(axis=1), 1)
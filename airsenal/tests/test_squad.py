@@ -2,11 +2,17 @@
 test various methods of the Team class.
 """
 
+import sys
+
 import pytest
 
 from airsenal.conftest import test_session_scope
 
-from airsenal.framework.squad import Squad
+from airsenal.framework.compact_squad import CompactSquad
+from airsenal.framework.squad import Squad, select_formation
+from airsenal.framework.player import CandidatePlayer
+from airsenal.framework.player_catalog import PlayerCatalog, get_player_catalog
+from airsenal.framework.schema import Player
 from airsenal.framework.utils import CURRENT_SEASON
 
 TEST_SEASON = CURRENT_SEASON
@@ -173,6 +179,7 @@ def test_get_expected_points():
             is_captain,
             is_vice_captain,
         ):
+            self.player_id = name
             self.name = name
             self.squad = squad
             self.position = position
@@ -215,3 +222,97 @@ def test_get_expected_points():
     assert t.get_expected_points(0, 0, bench_boost=True) == 30
     # triple captain
     assert t.get_expected_points(0, 0, triple_captain=True) == 29
+
+
+def test_player_catalog(fill_players):
+    """
+    Players created from the player catalog should have the same details as
+    players created from the database.
+    """
+    with test_session_scope() as ts:
+        catalog = get_player_catalog(TEST_SEASON, 1, dbsession=ts)
+        players = ts.query(Player).all()
+        assert len(catalog) == len(players)
+        for p in players:
+            assert p.player_id in catalog
+            from_catalog = CandidatePlayer(p.player_id, TEST_SEASON, 1, dbsession=ts)
+            from_db = CandidatePlayer(p, TEST_SEASON, 1, dbsession=ts)
+            for attr in ["player_id", "name", "team", "position", "purchase_price"]:
+                assert getattr(from_catalog, attr) == getattr(from_db, attr)
+        assert 10000 not in catalog
+        assert catalog.get(10000) is None
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="shared memory requires Python 3.8 or later"
+)
+def test_player_catalog_share(fill_players):
+    """
+    Player catalogs can be shared with other processes without copying them.
+    """
+    with test_session_scope() as ts:
+        catalog = get_player_catalog(TEST_SEASON, 1, dbsession=ts)
+        shm, handle = catalog.share()
+        try:
+            shared_catalog = PlayerCatalog.attach(handle)
+            assert len(shared_catalog) == len(catalog)
+            for p in ts.query(Player).all():
+                assert shared_catalog.get(p.player_id) == catalog.get(p.player_id)
+            shared_catalog._shm.close()
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+def test_compact_squad(fill_players):
+    """
+    CompactSquad should apply the same constraints as Squad, and convert to and
+    from Squads.
+    """
+    with test_session_scope() as ts:
+        catalog = get_player_catalog(TEST_SEASON, 1, dbsession=ts)
+        t = CompactSquad(catalog)
+        # three players from the same team
+        for pid in [1, 21, 41]:
+            assert t.add_player(catalog.index[pid])
+        assert not t.add_player(catalog.index[61])
+        assert not t.add_player(catalog.index[1])
+        assert list(t.player_ids) == [1, 21, 41]
+        assert t.budget == 1000 - sum(catalog.get(pid)[3] for pid in [1, 21, 41])
+        # copies are independent
+        t2 = t.copy()
+        assert t2.remove_player(catalog.index[21], 50)
+        assert list(t2.player_ids) == [1, 41]
+        assert t2.budget == t.budget + 50
+        assert list(t.player_ids) == [1, 21, 41]
+        assert t2.add_player(catalog.index[61])
+        # convert to a Squad and back again
+        players = {
+            pid: CandidatePlayer(pid, TEST_SEASON, 1, dbsession=ts)
+            for pid in t2.player_ids.tolist()
+        }
+        squad = t2.to_squad(TEST_SEASON, 1, players)
+        assert [p.player_id for p in squad.players] == [1, 41, 61]
+        # the purchase prices are set on copies of the players
+        assert squad.players[2].purchase_price == t2.purchase_prices[2]
+        for p in squad.players:
+            assert p is not players[p.player_id]
+        assert squad.budget == t2.budget
+        assert squad.num_position == {"GK": 2, "DEF": 0, "MID": 1, "FWD": 0}
+        t3 = CompactSquad.from_squad(squad, catalog)
+        assert list(t3.indices) == list(t2.indices)
+        assert t3.budget == t2.budget
+
+
+def test_select_formation():
+    """
+    Fill the starting 11 with the highest scoring players, choosing the last
+    formation in FORMATIONS if several have the same points.
+    """
+    points = {"DEF": [5, 4, 3, 2, 1], "MID": [5, 4, 3, 2, 1], "FWD": [5, 4, 3]}
+    # (3, 4, 3) and (4, 3, 3) have the same points
+    assert select_formation(points) == ((4, 3, 3), 38)
+    points = {"DEF": [9, 9, 9, 9, 9], "MID": [1, 1, 1, 1, 1], "FWD": [2, 0, 0]}
+    assert select_formation(points) == ((5, 4, 1), 51)
+    points = {"DEF": [0] * 5, "MID": [0] * 5, "FWD": [0] * 3}
+    assert select_formation(points) == ((5, 3, 2), 0)
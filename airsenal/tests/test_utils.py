@@ -2,9 +2,37 @@
 test some db access helper functions
 """
 
-from airsenal.conftest import test_session_scope
-from airsenal.framework.utils import get_player_name, get_player_id, get_player
-from airsenal.framework.schema import Player
+import sys
+
+import pytest
+
+from airsenal.conftest import test_session_scope, test_past_data_session_scope
+from airsenal.framework.utils import (
+    get_player_name,
+    get_player_id,
+    get_player,
+    is_future_gameweek,
+    is_future_gameweek_clause,
+    list_players,
+    get_recent_playerscore_rows,
+    get_recent_minutes_for_players,
+    estimate_minutes_from_prev_season,
+    get_predicted_points_for_player,
+    get_predicted_points,
+    clear_player_lists,
+    CURRENT_SEASON,
+)
+from airsenal.framework.prediction_matrix import (
+    PredictionMatrix,
+    get_prediction_matrix,
+    clear_prediction_matrices,
+)
+from airsenal.framework.schema import (
+    Player,
+    PlayerAttributes,
+    Fixture,
+    PlayerPrediction,
+)
 
 
 def test_get_player_name(fill_players):
@@ -31,3 +59,152 @@ def test_get_player(fill_players):
         p = get_player("Bob", tsession)
         assert isinstance(p, Player)
         assert p.player_id == 1
+
+
+def test_is_future_gameweek_clause():
+    """
+    The SQL version of is_future_gameweek should select the same fixtures as the
+    python version.
+    """
+    fixtures = [
+        Fixture(
+            date="", gameweek=gw, home_team="A", away_team="B", season=season, tag="x"
+        )
+        for season in ["1718", "1819", "1920"]
+        for gw in [None, 1, 11, 12, 13, 38]
+    ]
+    with test_session_scope() as tsession:
+        tsession.add_all(fixtures)
+        tsession.flush()
+        fixture_ids = [f.fixture_id for f in fixtures]
+        for season, gameweek in [("1819", 12), ("1718", 1), ("1920", 38)]:
+            future = {
+                f.fixture_id
+                for f in tsession.query(Fixture)
+                .filter(Fixture.fixture_id.in_(fixture_ids))
+                .filter(is_future_gameweek_clause(season, gameweek))
+            }
+            assert future == {
+                f.fixture_id
+                for f in fixtures
+                if is_future_gameweek(f.season, f.gameweek, season, gameweek)
+            }
+        tsession.rollback()
+
+
+def test_get_recent_minutes_for_players():
+    """
+    Recent minutes for all players at once should be the same as the minutes from
+    each player's recent playerscore rows (or last season's estimate).
+    """
+    with test_past_data_session_scope() as ts:
+        players = list_players(season="1819", gameweek=12, dbsession=ts)
+        minutes = get_recent_minutes_for_players(
+            players, num_match_to_use=3, season="1819", last_gw=11, dbsession=ts
+        )
+        assert set(minutes.keys()) == {p.player_id for p in players}
+        for p in players[:50]:
+            rows = get_recent_playerscore_rows(p, 3, "1819", 11, dbsession=ts)
+            expected = [r.minutes for r in rows] if rows else []
+            if not expected:
+                expected = estimate_minutes_from_prev_season(p, "1819", dbsession=ts)
+            assert minutes[p.player_id] == expected
+
+
+def test_prediction_matrix():
+    """
+    The prediction matrix should have the predicted points for each player and
+    gameweek, summed over fixtures in double gameweeks.
+    """
+    fixtures = [
+        Fixture(
+            date="", gameweek=gw, home_team="A", away_team="B", season="9899", tag="x"
+        )
+        for gw in [1, 2, 2, 3]
+    ]
+    with test_session_scope() as tsession:
+        tsession.add_all(fixtures)
+        tsession.flush()
+        tsession.add_all(
+            [
+                PlayerPrediction(
+                    player_id=pid,
+                    fixture_id=f.fixture_id,
+                    predicted_points=pts,
+                    tag=tag,
+                )
+                for tag, pid, f, pts in [
+                    ("TESTMATRIX", 1, fixtures[0], 2.0),
+                    ("TESTMATRIX", 1, fixtures[1], 3.0),
+                    ("TESTMATRIX", 1, fixtures[2], 4.0),
+                    ("TESTMATRIX", 2, fixtures[3], 5.0),
+                    ("OTHERTAG", 2, fixtures[0], 6.0),
+                ]
+            ]
+        )
+        tsession.flush()
+        matrix = get_prediction_matrix("TESTMATRIX", "9899", tsession)
+        assert matrix.points.shape == (2, 3)
+        assert matrix.get_player_points(1) == {1: 2.0, 2: 7.0, 3: 0.0}
+        assert matrix.get_player_points(3) == {1: 0.0, 2: 0.0, 3: 0.0}
+        assert list(matrix.get_points([1, 2, 3], [1, 2, 3])) == [9.0, 5.0, 0.0]
+        assert list(matrix.get_points([2, 1], 2)) == [0.0, 7.0]
+        assert get_predicted_points_for_player(
+            2, "TESTMATRIX", season="9899", dbsession=tsession
+        ) == {1: 0.0, 2: 0.0, 3: 5.0}
+        clear_prediction_matrices()
+        tsession.rollback()
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="shared memory requires Python 3.8 or later"
+)
+def test_prediction_matrix_share():
+    """
+    Prediction matrices can be shared with other processes without copying them.
+    """
+    matrix = PredictionMatrix("TESTMATRIX", "9899", [1, 2], [[2.0, 7.0], [0.0, 5.0]])
+    shm, handle = matrix.share()
+    try:
+        shared_matrix = PredictionMatrix.attach(handle)
+        assert (shared_matrix.points == matrix.points).all()
+        assert shared_matrix.get_player_points(1) == {1: 2.0, 2: 7.0}
+        assert list(shared_matrix.get_points([2, 3], 2)) == [5.0, 0.0]
+        shared_matrix._shm.close()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_get_predicted_points_player_lists(fill_players):
+    """
+    get_predicted_points should keep using the players it listed until
+    clear_player_lists is called, loading them in the session it's given.
+    """
+    clear_player_lists()
+    with test_session_scope() as ts:
+        expected = {p.player_id for p in list_players("MID", dbsession=ts)}
+        points = get_predicted_points(1, "TESTNOTAG", position="MID", dbsession=ts)
+        assert {p.player_id for p, _ in points} == expected
+        assert all(p in ts for p, _ in points)
+    with test_session_scope() as ts:
+        ts.add(Player(player_id=10000, fpl_api_id=10000, name="New Player"))
+        ts.add(
+            PlayerAttributes(
+                player_id=10000,
+                season=CURRENT_SEASON,
+                gameweek=1,
+                team="ARS",
+                position="MID",
+                price=50,
+            )
+        )
+        ts.flush()
+        points = get_predicted_points(1, "TESTNOTAG", position="MID", dbsession=ts)
+        assert {p.player_id for p, _ in points} == expected
+        assert all(p in ts for p, _ in points)
+        clear_player_lists()
+        points = get_predicted_points(1, "TESTNOTAG", position="MID", dbsession=ts)
+        assert {p.player_id for p, _ in points} == expected | {10000}
+        ts.rollback()
+    clear_player_lists()